@@ -1,3 +1,4 @@
+import logging
 import os
 import pathlib
 import multiprocessing
@@ -6,14 +7,21 @@ import threading
 import time
 import sys
 
-from func.encode import encoder
+from func.cache import PruneCache
+from func.distributed import COORDINATOR, WORKER, StartCoordinator, worker
+from func.encode import PARTIAL_PREFIX, OutputPath, encoder
+from func.jobs import DONE, FAILED, JobQueue, NeedsAttention
 from func.settings import CreateSettings, ReadSettings
 from func.temp import cleanup
+from func.watch import DirectoryWatcher, FilePriority, StableFiles
 from func.logger import listener_process, create_logger
 from func.manager import queue_manager, NamedQueue, ExceptionHandler
 
 settings = None
 
+# The job queue is stored in the output folder, next to the converted files
+JOBS_DATABASE = 'jobs.sqlite'
+
 # Create a queue for the manager to receive exceptions
 manager_queue = multiprocessing.Queue()
 # Create a queue for logs
@@ -25,6 +33,7 @@ sys.excepthook = handler.handle_exception
 
 
 # Signal handler that catches SIGINTs (CTRL + C) and terminates all child processes before exiting.
+# Only the user interrupts the script this way. A file that fails raises an exception, so the rest of the files are still converted.
 # Since the data we create isn't critical, we don't need to worry about data loss, so we can just terminate everything.
 def signal_handler(sig, frame):
     logger = create_logger(log_queue, 'SignalHandler')
@@ -34,11 +43,169 @@ def signal_handler(sig, frame):
         logger.debug(f'Terminated {proc.name}')
         proc.join()
     time.sleep(1)
-    cleanup(settings['tmp_folder'], settings['keep_tmp_files'], log_queue)
+    # The temporary folder of a worker is shared with the coordinator, which cleans it up
+    if settings['distributed_mode'] != WORKER:
+        cleanup(settings['tmp_folder'], settings['keep_tmp_files'], log_queue)
     manager_queue.put(None)
     exit(1)
 
 
+def converted_stems(output_dir: str) -> set[str]:
+    """
+    List the filename stems that already have a file in the output folder.
+
+    Every prefix of an output filename that ends before a dot is included, so checking a stem against the set
+    matches the same files as globbing the output folder for "stem.*", but only lists the folder once.
+
+    Args:
+        output_dir (str): The path to the output folder.
+
+    Returns:
+        set[str]: The stems of the converted files.
+    """
+    stems = set()
+    for output_file in pathlib.Path(output_dir).iterdir():
+        # The job queue and its journal, and outputs that are still being written, are not converted files
+        if output_file.name.startswith(JOBS_DATABASE) or output_file.name.startswith(PARTIAL_PREFIX):
+            continue
+        parts = output_file.name.split('.')
+        for i in range(1, len(parts)):
+            stems.add('.'.join(parts[:i]))
+    return stems
+
+
+def convert_file(settings: dict, file: pathlib.Path, logger: logging.Logger) -> float:
+    """
+    Convert a single file with the encoder.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        file (pathlib.Path): The path to the input file.
+        logger (logging.Logger): The logger object used for logging messages.
+
+    Returns:
+        float: How long the conversion took, in seconds.
+    """
+    settings['crf_value'] = settings['initial_crf_value']
+    start = time.time()
+    encoder(settings, file)
+    end = time.time()
+    logger.info(f'Took {end - start} seconds to convert {pathlib.Path(file).name}')
+    return end - start
+
+
+def add_files(settings: dict, jobs: JobQueue, files: list[pathlib.Path], logger: logging.Logger) -> int:
+    """
+    Add the files that aren't in the job queue yet to it.
+
+    Files that already have a file with the same filename in the output folder are assumed to have been converted
+    before the job queue existed, and are added as done. The output folder is only listed if there are new files.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        jobs (JobQueue): The job queue.
+        files (list[pathlib.Path]): The files to add.
+        logger (logging.Logger): The logger object used for logging messages.
+
+    Returns:
+        int: The number of files queued for conversion.
+    """
+    converted = None
+    queued = 0
+    for file in files:
+        if jobs.state(file) is not None:
+            continue
+        if converted is None:
+            converted = converted_stems(settings['output_dir'])
+        if file.stem in converted:
+            jobs.add(file, FilePriority(settings, file), DONE)
+            logger.info(f'Already converted {file.name}. Skipping...')
+        else:
+            jobs.add(file, FilePriority(settings, file))
+            logger.info(f'Queued {file.name}')
+            queued += 1
+    return queued
+
+
+def convert_job(settings: dict, jobs: JobQueue, file: pathlib.Path, logger: logging.Logger) -> None:
+    """
+    Convert a file taken from the job queue, and store the result in it.
+
+    A file that could not be converted is recorded as failed, and the next file is converted as usual.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        jobs (JobQueue): The job queue.
+        file (pathlib.Path): The path to the input file.
+        logger (logging.Logger): The logger object used for logging messages.
+
+    Returns:
+        None
+    """
+    try:
+        if not file.exists():
+            raise FileNotFoundError(f'{file} no longer exists')
+        duration = convert_file(settings, file, logger)
+    except NeedsAttention as e:
+        jobs.defer(file, str(e))
+        logger.warning(f'{e}. Set {file.name} aside, and continuing with the next file.')
+        return
+    except Exception as e:
+        state = jobs.fail(file, str(e))
+        logger.error(f'Failed to convert {file.name}: {e}. {"Giving up on it." if state == FAILED else "Trying again later."}')
+        return
+    outputs = {OutputPath(settings, file, rendition).name: OutputPath(settings, file, rendition).stat().st_size
+               for rendition in settings['renditions'] if OutputPath(settings, file, rendition).exists()}
+    jobs.finish(file, {'duration': round(duration, 2), 'outputs': outputs})
+    # Keep the cache from growing without limit, e.g. in watch mode
+    PruneCache(settings, logger)
+
+
+def input_files(settings: dict) -> list[pathlib.Path]:
+    """
+    List the files in the input folder that end with the input extension.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+
+    Returns:
+        list[pathlib.Path]: The absolute paths of the files, which are also their keys in the job queue.
+    """
+    return [file.resolve() for file in pathlib.Path(settings['input_dir']).glob(f'*.{settings["input_extension"]}')]
+
+
+def watch(settings: dict, jobs: JobQueue, logger: logging.Logger) -> None:
+    """
+    Keep converting files as they are added to the input folder, until interrupted.
+
+    Files are only queued once their size and modification time have stopped changing for watch_settle_time seconds,
+    so files that are still being copied are left alone. The folder is checked again after each file,
+    so a new file with a higher priority is converted next.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        jobs (JobQueue): The job queue new files are added to, and converted from.
+        logger (logging.Logger): The logger object used for logging messages.
+
+    Returns:
+        None
+    """
+    watcher = DirectoryWatcher(settings['input_dir'], logger)
+    stable_files = StableFiles(settings['watch_settle_time'])
+    logger.info(f'Watching {settings["input_dir"]} for files with the extension {settings["input_extension"]}. Press CTRL + C to stop.')
+
+    while True:
+        add_files(settings, jobs, stable_files.update([file for file in input_files(settings) if jobs.state(file) is None]), logger)
+
+        file = jobs.next()
+        if file is not None:
+            convert_job(settings, jobs, file, logger)
+            continue
+
+        # Check again sooner while files are still being written to
+        watcher.wait(min(settings['watch_interval'], settings['watch_settle_time']) if stable_files.pending else settings['watch_interval'])
+
+
 def main():
     # Make settings global, so they can be accessed from anywhere in the script
     global settings
@@ -48,19 +215,9 @@ def main():
 
     logger = create_logger(log_queue, 'main')
 
+    # Queues added to this list are closed by the queue manager on exit
     queue_list = []
 
-    # Create queues used to pass data between the chunk calculator, chunk generator, chunk converter and concatenator
-    # Chunk calculator > Chunk generator
-    chunk_calculate_queue = NamedQueue('chunk_calculate_queue')
-    queue_list.append(chunk_calculate_queue)
-    # Chunk generator > Chunk converter
-    chunk_generator_queue = NamedQueue('chunk_generator_queue')
-    queue_list.append(chunk_generator_queue)
-    # Chunk converter > Concatenator
-    chunk_concat_queue = NamedQueue('chunk_concat_queue')
-    queue_list.append(chunk_concat_queue)
-
     qman = threading.Thread(target=queue_manager,
                             args=(queue_list, manager_queue, log_queue),
                             daemon=False,
@@ -75,7 +232,22 @@ def main():
         logger.debug('Creating settings.ini')
         CreateSettings(log_queue)
         settings = ReadSettings(log_queue, manager_queue)
-        input('New settings.ini has been created. Press enter when ready to continue...')
+        if settings['interactive']:
+            input('New settings.ini has been created. Press enter when ready to continue...')
+        else:
+            logger.info('New settings.ini has been created. Continuing with the default settings.')
+
+    # Create queues used to pass data between the chunk calculator, chunk generator, chunk converter and concatenator
+    # Each is bounded by queue_size, so a stage that runs ahead blocks until the next stage has caught up
+    # Chunk calculator > Chunk generator
+    chunk_calculate_queue = NamedQueue('chunk_calculate_queue', settings['queue_size'])
+    queue_list.append(chunk_calculate_queue)
+    # Chunk generator > Chunk converter
+    chunk_generator_queue = NamedQueue('chunk_generator_queue', settings['queue_size'])
+    queue_list.append(chunk_generator_queue)
+    # Chunk converter > Concatenator
+    chunk_concat_queue = NamedQueue('chunk_concat_queue', settings['queue_size'])
+    queue_list.append(chunk_concat_queue)
 
     # Add the queues to the settings dictionary, so they can be accessed from anywhere in the script.
     settings['chunk_calculate_queue'] = chunk_calculate_queue
@@ -93,30 +265,44 @@ def main():
 
     # Get the physical core count, used in the VMAF library.
     settings['physical_cores'] = int(os.cpu_count() / 2)
+    settings['log_queue'] = log_queue
+
+    # A worker converts the chunks handed out by a coordinator, instead of looking for files itself
+    if settings['distributed_mode'] == WORKER:
+        logger.info(f'Starting {settings["chunk_threads"]} worker(s) for the coordinator on {settings["coordinator_address"]}')
+        worker(settings)
+        manager_queue.put(None)
+        return
 
-    # Iterate through each file that ends with an extension matching the specified extension.
-    files = list(pathlib.Path(settings['input_dir']).glob(f'*.{settings["input_extension"]}'))
-    if len(files) > 0:
-        logger.debug(f'Found {len(files)} files with the extension {settings["input_extension"]}')
-        for file in files:
-            settings['crf_value'] = settings['initial_crf_value']
-            # Check if a file with the same filename already exists in the output folder, and assume it has already been converted.
-            if not list(pathlib.Path(settings['output_dir']).glob(f'{pathlib.Path(file).stem}.*')):
-                settings['log_queue'] = log_queue
-                start = time.time()
-                encoder(settings, file)
-                end = time.time()
-                logger.info(f'Took {end - start} seconds to convert {pathlib.Path(file).name}')
-                # TODO: Implement intro and outro, or consider removing the option from the settings.
-                #   Doesn't seem like it's really worth it to implement.
-                if settings['use_intro'] or settings['use_outro']:
-                    raise NotImplementedError('Intro and outro not yet implemented')
-            else:
-                logger.info(f'Already converted {pathlib.Path(file).name}. Skipping...')
-                continue
+    if settings['distributed_mode'] == COORDINATOR:
+        coordinator = StartCoordinator(settings)
+
+    # The files to convert are kept in a job queue in the output folder, so a new run continues where the last one stopped
+    jobs = JobQueue(pathlib.Path(settings['output_dir']) / JOBS_DATABASE, settings['file_attempts'])
+    interrupted = jobs.recover()
+    if interrupted:
+        logger.info(f'Resuming {interrupted} file(s) that were being converted when the last run stopped')
+
+    if settings['watch']:
+        watch(settings, jobs, logger)
     else:
-        logger.info(f'No files found with the extension {settings["input_extension"]} in the input directory.')
+        files = input_files(settings)
+        if len(files) > 0:
+            logger.debug(f'Found {len(files)} files with the extension {settings["input_extension"]}')
+            add_files(settings, jobs, files, logger)
+        else:
+            logger.info(f'No files found with the extension {settings["input_extension"]} in the input directory.')
+
+        # Convert the queued files in order of priority, including any left over from an earlier run
+        while (file := jobs.next()) is not None:
+            convert_job(settings, jobs, file, logger)
+        logger.info(f'Job queue: {", ".join(f"{count} {state}" for state, count in jobs.counts().items())}')
+        for file, reason in jobs.needing_attention():
+            logger.warning(f'Needs attention: {file}: {reason}')
+    jobs.close()
 
+    if settings['distributed_mode'] == COORDINATOR:
+        coordinator.shutdown()
     cleanup(settings['tmp_folder'], settings['keep_tmp_files'], log_queue)
     manager_queue.put(None)
 
@@ -0,0 +1,152 @@
+from hashlib import sha1
+from json import dumps, loads
+from pathlib import Path
+from shutil import rmtree
+import logging
+import os
+
+# The folder in the cache folder holding the encoded intros and outros, which don't belong to a single file
+SEGMENTS_FOLDER = 'segments'
+
+
+def CacheKey(file: str) -> str:
+    """
+    Create a key identifying a specific version of a file.
+
+    The key changes whenever the file is moved, resized or modified, which invalidates anything cached for it.
+
+    Args:
+        file (str): The path to the file.
+
+    Returns:
+        str: The key of the file.
+    """
+    stat = os.stat(file)
+    return sha1(f'{Path(file).resolve()}|{stat.st_size}|{stat.st_mtime_ns}'.encode()).hexdigest()
+
+
+def ReadCache(settings: dict, file: str, name: str) -> dict | list | None:
+    """
+    Read previously cached data for a file.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        file (str): The path to the file the data belongs to.
+        name (str): The name of the cached data.
+
+    Returns:
+        dict | list | None: The cached data, or None if nothing is cached for the current version of the file.
+    """
+    cache_file = Path(settings['cache_dir']) / CacheKey(file) / f'{name}.json'
+    try:
+        with open(cache_file) as f:
+            data = loads(f.read())
+    except (FileNotFoundError, ValueError):
+        return None
+    # Mark the file's cached data as recently used, so it is the last to be pruned
+    try:
+        os.utime(cache_file.parent)
+    except FileNotFoundError:  # Pruned in the meantime
+        pass
+    return data
+
+
+def WriteCache(settings: dict, file: str, name: str, data: dict | list) -> None:
+    """
+    Cache data for a file, so it can be reused as long as the file is unchanged.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        file (str): The path to the file the data belongs to.
+        name (str): The name of the cached data.
+        data (dict | list): The JSON serializable data to cache.
+
+    Returns:
+        None
+    """
+    cache_folder = Path(settings['cache_dir']) / CacheKey(file)
+    cache_folder.mkdir(parents=True, exist_ok=True)
+    # Record which version of the file the data belongs to, so it can be pruned once the file changes or is deleted
+    if not (cache_folder / 'source.json').exists():
+        stat = os.stat(file)
+        source = {'path': str(Path(file).resolve()), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        tmp_file = cache_folder / f'source.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(dumps(source))
+        os.replace(tmp_file, cache_folder / 'source.json')
+    # Write to a temporary file first and then rename it, so other processes never read a partially written file
+    tmp_file = cache_folder / f'{name}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(dumps(data))
+    os.replace(tmp_file, cache_folder / f'{name}.json')
+
+
+def PruneCache(settings: dict, logger: logging.Logger) -> None:
+    """
+    Remove the cached data of files that have changed or been deleted, and then the least recently used data, until the cache fits in cache_size.
+
+    Encoded intros and outros are pruned by how recently they were used as well, except the ones of the current run.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        logger (logging.Logger): The logger object used for logging messages.
+
+    Returns:
+        None
+    """
+    cache_dir = Path(settings['cache_dir'])
+    if not cache_dir.exists():
+        return
+    entries = []
+    for cache_folder in cache_dir.iterdir():
+        if not cache_folder.is_dir():
+            continue
+        if cache_folder.name == SEGMENTS_FOLDER:
+            # Each encoded intro or outro is an entry of its own. The ones of the current run are counted, but never removed
+            in_use = {Path(segment_file) for segment_file in settings.get('intro_streams', []) + settings.get('outro_streams', [])}
+            for segment_file in cache_folder.glob('*.obu'):
+                try:
+                    stat = segment_file.stat()
+                except FileNotFoundError:  # Pruned by another process in the meantime
+                    continue
+                entries.append((float('inf') if segment_file in in_use else stat.st_mtime, stat.st_size, segment_file))
+            continue
+        try:
+            with open(cache_folder / 'source.json') as f:
+                source = loads(f.read())
+        except FileNotFoundError:
+            # Data cached before its source was recorded can only be pruned by age
+            source = None
+        except ValueError:
+            source = {}
+        try:
+            stat = os.stat(source['path']) if source is not None else None
+            stale = stat is not None and (stat.st_size, stat.st_mtime_ns) != (source['size'], source['mtime_ns'])
+        except (FileNotFoundError, KeyError):
+            stale = True
+        if stale:
+            logger.debug(f'Removing the cached data of a changed or deleted file from {cache_folder.name}')
+            rmtree(cache_folder, ignore_errors=True)
+            continue
+        try:
+            size = sum(cache_file.stat().st_size for cache_file in cache_folder.iterdir())
+            entries.append((cache_folder.stat().st_mtime, size, cache_folder))
+        except FileNotFoundError:  # Pruned by another process in the meantime
+            continue
+
+    if not settings['cache_size']:
+        return
+    entries.sort()
+    used = sum(size for _, size, _ in entries)
+    while entries and entries[0][0] != float('inf') and used > settings['cache_size'] * 1024 * 1024:
+        _, size, cache_entry = entries.pop(0)
+        logger.debug(f'Removing the least recently used cached data from {cache_entry.name}')
+        if cache_entry.is_dir():
+            rmtree(cache_entry, ignore_errors=True)
+        else:
+            cache_entry.unlink(missing_ok=True)
+        used -= size
+
+
+if __name__ == '__main__':
+    print('This file should not be run as a standalone script!')
@@ -1,6 +1,8 @@
 from argparse import ArgumentTypeError
 from pathlib import Path
 
+from func.intermediate import AUTO, INTERMEDIATE_FORMATS
+
 
 def IntOrFloat(s: str) -> int | float:
     """
@@ -86,3 +88,107 @@ def ParentExists(s: str) -> str:
     if p.exists():
         return str(s)
     raise ArgumentTypeError(f"{s}'s parent folder does not exist")
+
+
+def Ladder(s: str) -> list[dict[str, int | float | None]]:
+    """
+    Convert a comma separated list of rendition targets to a list of dictionaries.
+
+    Each target is written as WIDTHxHEIGHT, optionally followed by @MIN-MAX to give it its own VMAF range,
+    e.g. "1920x1080@90.5-93,1280x720@90-92.5,854x480". An empty string disables the ladder.
+
+    Args:
+        s (str): The string to be converted.
+
+    Returns:
+        list[dict[str, int | float | None]]: A dictionary for each target, containing the output_width, output_height,
+            vmaf_min_value and vmaf_max_value keys. The VMAF values are None if no range was given.
+
+    Raises:
+        ArgumentTypeError: If one of the targets is not a valid rendition.
+    """
+    renditions = []
+    for target in filter(None, (target.strip() for target in s.split(','))):
+        resolution, _, vmaf_range = target.partition('@')
+        try:
+            width, height = (int(value) for value in resolution.lower().split('x'))
+            vmaf_min_value, vmaf_max_value = (IntOrFloat(value) for value in vmaf_range.split('-')) if vmaf_range else (None, None)
+        except (ValueError, ArgumentTypeError):
+            raise ArgumentTypeError(f'{target} is not a valid rendition. Use WIDTHxHEIGHT or WIDTHxHEIGHT@MIN-MAX')
+        renditions.append({'output_width': width, 'output_height': height, 'vmaf_min_value': vmaf_min_value, 'vmaf_max_value': vmaf_max_value})
+    return renditions
+
+
+def Address(s: str) -> str:
+    """
+    Check if the given string is a valid HOST:PORT network address.
+
+    Args:
+        s (str): The string to check.
+
+    Returns:
+        str: The validated address.
+
+    Raises:
+        ArgumentTypeError: If the string is not a HOST:PORT address, or the port is not a valid port number.
+    """
+    host, _, port = s.rpartition(':')
+    if host and port.isnumeric() and 0 < int(port) < 65536:
+        return s
+    raise ArgumentTypeError(f'{s} is not a valid address. Use HOST:PORT, e.g. 127.0.0.1:50000')
+
+
+def Patterns(s: str) -> list[str]:
+    """
+    Convert a comma separated list of filename patterns to a list.
+
+    Args:
+        s (str): The string to be converted. An empty string gives an empty list.
+
+    Returns:
+        list[str]: The patterns, in the order they were given.
+    """
+    return [pattern.strip() for pattern in s.split(',') if pattern.strip()]
+
+
+def ChunkLength(s: str) -> tuple[int | float, str]:
+    """
+    Convert a chunk length to a value and a unit.
+
+    The length is given in seconds, or in frames if it ends with an f, e.g. "10", "2.5" or "240f".
+
+    Args:
+        s (str): The string to be converted.
+
+    Returns:
+        tuple[int | float, str]: The length, and its unit, either "seconds" or "frames". A length of 0 means no limit.
+
+    Raises:
+        ArgumentTypeError: If the string is not a valid length.
+    """
+    value, unit = (s[:-1], 'frames') if s.lower().endswith('f') else (s, 'seconds')
+    try:
+        value = IntOrFloat(value.strip())
+    except ArgumentTypeError:
+        raise ArgumentTypeError(f'{s} is not a valid chunk length. Use a number of seconds, e.g. 10, or a number of frames, e.g. 240f')
+    if value < 0:
+        raise ArgumentTypeError(f'{s} is not a valid chunk length. It can\'t be negative')
+    return value, unit
+
+
+def IntermediateFormat(s: str) -> str:
+    """
+    Check if the given string is the name of an intermediate format, or auto.
+
+    Args:
+        s (str): The string to check.
+
+    Returns:
+        str: The validated name, in lowercase.
+
+    Raises:
+        ArgumentTypeError: If the string is not an intermediate format.
+    """
+    if s.lower() in INTERMEDIATE_FORMATS or s.lower() == AUTO:
+        return s.lower()
+    raise ArgumentTypeError(f'{s} is not a valid intermediate format. Use {", ".join(INTERMEDIATE_FORMATS)} or {AUTO}')
@@ -1,15 +1,19 @@
-from json import loads
-from math import floor
+from bisect import bisect_left
+from fractions import Fraction
+from math import ceil, floor
+import logging
 import multiprocessing
 from pathlib import Path
 import subprocess
 from time import sleep
 import sys
 import os
-import signal
 
+from func.complexity import AnalyseComplexity, ChunkComplexity
+from func.index import LoadPacketIndex, SeekArgs
+from func.intermediate import IntermediateArgs, IntermediateExtension
 from func.logger import create_logger
-from func.vmaf import CheckVMAF, VMAFError
+from func.vmaf import AdjustCRF, ScoreVMAFBatch, ScoreVMAFSegmented, VMAFError
 from func.manager import ExceptionHandler
 
 EQUAL_SIZE_CHUNKS = 1
@@ -17,6 +21,103 @@ FIXED_LENGTH_CHUNKS = 2
 KEYFRAME_BASED_CHUNKS = 3
 
 
+def ChunkPath(settings: dict, folder: str, i: int, rendition: dict) -> Path:
+    """
+    Create the path of a chunk inside one of the temporary folders.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        folder (str): The name of the temporary folder, e.g. prepared or converted.
+        i (int): The chunk number.
+        rendition (dict): The rendition the chunk belongs to. Named renditions have their name added to the filename.
+
+    Returns:
+        Path: The path of the chunk.
+    """
+    suffix = f'.{rendition["name"]}' if rendition['name'] else ''
+    # Prepared chunks use the container of the intermediate format, and the rest the container of the output
+    extension = IntermediateExtension(settings) if folder == 'prepared' else settings['output_extension']
+    return Path(settings['tmp_folder']) / folder / f'chunk{i}{suffix}.{extension}'
+
+
+def CoalesceKeyframes(index: dict, total_frames: int, min_length: tuple[int | float, str], max_length: tuple[int | float, str]) -> list[int]:
+    """
+    Merge consecutive GOPs into chunks that are cut on keyframes, and are within a minimum and maximum length.
+
+    Each chunk grows by whole GOPs until it reaches the minimum length. If the GOP that would get it there takes it past
+    the maximum length, the chunk is cut before that GOP instead, and a single GOP longer than the maximum length becomes
+    a chunk of its own. A last chunk shorter than the minimum length is merged into the one before it, if that doesn't
+    take it past the maximum length.
+
+    Args:
+        index (dict): The packet index of the video.
+        total_frames (int): The total number of frames in the video.
+        min_length (tuple[int | float, str]): The minimum chunk length, and its unit, either "seconds" or "frames". 0 means no minimum.
+        max_length (tuple[int | float, str]): The maximum chunk length, and its unit, either "seconds" or "frames". 0 means no maximum.
+
+    Returns:
+        list[int]: The frame after the last frame of each chunk, in order. The last one is always total_frames.
+    """
+    pts = index['pts']
+    time_base = Fraction(index['time_base'])
+    # The last frame lasts as long as the one before it
+    end_pts = pts[-1] + (pts[-1] - pts[-2] if len(pts) > 1 else 0)
+
+    def length(start_frame: int, end_frame: int, unit: str) -> int | Fraction:
+        if unit == 'frames':
+            return end_frame - start_frame
+        return ((pts[end_frame] if end_frame < len(pts) else end_pts) - pts[start_frame]) * time_base
+
+    def too_short(start_frame: int, end_frame: int) -> bool:
+        return length(start_frame, end_frame, min_length[1]) < min_length[0]
+
+    def too_long(start_frame: int, end_frame: int) -> bool:
+        return bool(max_length[0]) and length(start_frame, end_frame, max_length[1]) > max_length[0]
+
+    end_frames = []
+    start_frame = 0
+    previous = None  # The last keyframe the current chunk could have ended at, while it was still too short
+    for keyframe in [keyframe for keyframe in index['keyframes'] if 0 < keyframe < total_frames]:
+        # Keep within the maximum length by cutting at the previous keyframe, even if the chunk is still too short
+        if previous is not None and too_long(start_frame, keyframe):
+            end_frames.append(previous)
+            start_frame, previous = previous, None
+        if too_short(start_frame, keyframe):
+            previous = keyframe
+        else:
+            end_frames.append(keyframe)
+            start_frame, previous = keyframe, None
+
+    if previous is not None and too_long(start_frame, total_frames):
+        end_frames.append(previous)
+        start_frame = previous
+    # Merge a last chunk that is too short into the one before it, if it fits
+    if end_frames and too_short(start_frame, total_frames) and not too_long(end_frames[-2] if len(end_frames) > 1 else 0, total_frames):
+        end_frames.pop()
+    end_frames.append(total_frames)
+    return end_frames
+
+
+def LongestChunk(settings: dict) -> int:
+    """
+    Estimate the number of frames in the longest chunk the chunk calculator will create.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings, including the frame rate and total number of frames.
+
+    Returns:
+        int: The number of frames in the longest chunk, or the whole video for a chunk mode without chunks.
+    """
+    if settings['chunk_mode'] == EQUAL_SIZE_CHUNKS:
+        return ceil(settings['total_frames'] / settings['chunk_size'])
+    if settings['chunk_mode'] == FIXED_LENGTH_CHUNKS:
+        return min(ceil(settings['chunk_length'] * Fraction(settings['fps'])), settings['total_frames'])
+    if settings['chunk_mode'] == KEYFRAME_BASED_CHUNKS:
+        end_frames = CoalesceKeyframes(LoadPacketIndex(settings['packet_index']), settings['total_frames'], settings['min_chunk_length'], settings['max_chunk_length'])
+        return max(end_frame - start_frame for start_frame, end_frame in zip([0] + end_frames, end_frames))
+    return settings['total_frames']
+
+
 def calculate(settings: dict,
               file: str,
               chunk_range: multiprocessing.Value,
@@ -41,21 +142,21 @@ def calculate(settings: dict,
     start_frame = 0
     chunk_count = 0
     try:
+        # Score the complexity of every frame, so each chunk can be seeded with a starting CRF value fitting its content
+        complexity = AnalyseComplexity(settings, file, logger) if settings['complexity_analysis'] else None
         while not process_failure.is_set():
             if settings['chunk_mode'] == EQUAL_SIZE_CHUNKS:  # GENERATE TIMINGS FOR ENCODING WITH VIDEO SPLIT INTO n EQUAL SIZED CHUNKS
                 logger.debug(f'Calculating {settings["chunk_size"]} chunks')
                 # Iterate through the chunk_size shifted by 1, to start iter from 1
-                for chunk in range(1, settings['chunk_size'] + 1):
+                for chunk_count in range(1, settings['chunk_size'] + 1):
                     # Calculate end_frame by dividing it by the chunk_size and multiply with iter
                     # For example if the video has 3600 frames and the chunk_size is 5:
                     # 3600 / 5 = 720, so the loop will iterate from 0 to 720, 720 to 1440, 1440 to 2160, 2160 to 2880 and 2880 to 3600
-                    end_frame = floor((settings['total_frames']) / (settings['chunk_size']) * chunk)
+                    end_frame = floor((settings['total_frames']) / (settings['chunk_size']) * chunk_count)
 
-                    # Create chunk variable with the folder structure and filename
-                    # and put it, alongside start_frame, end_frame and iter, in the queue for the chunk generator to use
-                    chunk = Path(settings['tmp_folder']) / 'prepared' / f'chunk{chunk}.{settings["output_extension"]}'
-                    logger.debug(f'Adding chunk {chunk} to queue with start_frame {start_frame} and end_frame {end_frame}')
-                    settings['chunk_calculate_queue'].put((start_frame, end_frame, chunk, chunk))
+                    # Put the start_frame, end_frame, iter and complexity in the queue for the chunk generator to use
+                    logger.debug(f'Adding chunk {chunk_count} to queue with start_frame {start_frame} and end_frame {end_frame}')
+                    settings['chunk_calculate_queue'].put((start_frame, end_frame, chunk_count, ChunkComplexity(complexity, start_frame, end_frame)))
 
                     # Turn new start_frame into the old end_frame value, if end frame has not yet reached the end of the video
                     if not end_frame == settings['total_frames']:
@@ -68,29 +169,22 @@ def calculate(settings: dict,
 
             elif settings['chunk_mode'] == FIXED_LENGTH_CHUNKS:  # GENERATE TIMINGS FOR ENCODING WITH VIDEO SPLIT INTO n LONG CHUNKS
                 logger.debug(f'Calculating chunks with length {settings["chunk_length"]} seconds')
-                # Convert the total frames into seconds and iterate through them, with the step being the length of each chunk in seconds
-                # For example if the video has 3600 frames, is 60fps and the chunk length is 10 seconds:
-                # 3600 / 60 = 60 seconds, so the loop will iterate from 0 to 60 with a step of 10 and create 6 chunks that are 10 seconds long
-                for chunk_length in range(0, int(settings['total_frames'] / settings['fps']), settings['chunk_length']):
+                # Find the chunk boundaries from the presentation timestamps in the packet index, in the stream's exact time base,
+                # so fractional frame rates like 24000/1001, and variable frame rates, still give chunks of the right duration.
+                # For example with a time base of 1/24000, 24000/1001 fps and a chunk length of 10 seconds:
+                # each chunk ends at the first frame at least 240000 ticks after its first frame, which is 240 frames later
+                index = LoadPacketIndex(settings['packet_index'])
+                chunk_ticks = Fraction(settings['chunk_length']) / Fraction(index['time_base'])
+                while start_frame < settings['total_frames']:
                     chunk_count += 1
-                    # Calculate current iter + chunk length
-                    # If it exceeds or is equal to the total duration in decimal seconds
-                    # that will be the final chunk, and end_frame will instead be the last/total frames
-                    # This avoids end_frame stepping over the total amount of frames there are
-                    if not chunk_length + settings['chunk_length'] >= (settings['total_frames'] / settings['fps']):
-                        end_frame = start_frame + (settings['chunk_length'] * settings['fps'])
-                    else:
-                        end_frame = settings['total_frames']
-
-                    # Create chunk variable with the folder structure and filename
-                    # and put it, alongside start_frame, end_frame and iter, in the queue for the chunk generator to use
-                    chunk = Path(settings['tmp_folder']) / 'prepared' / f'chunk{chunk_count}.{settings["output_extension"]}'
-                    logger.debug(f'Adding chunk {chunk_count} to queue with start_frame {start_frame} and end_frame {end_frame}')
-                    settings['chunk_calculate_queue'].put((start_frame, end_frame, chunk_count, chunk))
+                    boundary = index['pts'][start_frame] + chunk_ticks
+                    # The last chunk ends at the last frame, so end_frame never steps over the total amount of frames there are
+                    end_frame = max(min(bisect_left(index['pts'], boundary), settings['total_frames']), start_frame + 1)
 
-                    # Turn new start_frame into the old end_frame value, if end frame has not yet reached the end of the video
-                    if not end_frame == settings['total_frames']:
-                        start_frame = end_frame
+                    # Put the start_frame, end_frame, iter and complexity in the queue for the chunk generator to use
+                    logger.debug(f'Adding chunk {chunk_count} to queue with start_frame {start_frame} and end_frame {end_frame}')
+                    settings['chunk_calculate_queue'].put((start_frame, end_frame, chunk_count, ChunkComplexity(complexity, start_frame, end_frame)))
+                    start_frame = end_frame
 
                     # Increase calculated chunks by one
                     with chunk_range.get_lock():
@@ -98,68 +192,34 @@ def calculate(settings: dict,
                 break
 
             elif settings['chunk_mode'] == KEYFRAME_BASED_CHUNKS:  # GENERATE TIMINGS FOR ENCODING WITH VIDEO SPLIT BY EVERY KEYFRAME
-                # Use ffprobe to read each frame and it's flags. A flag of "K" means it's a keyframe.
-                # By far the most computationally expensive method, and takes longer to finish, as it reads every frame.
-                # However the multiprocessing aspect should help.
-                logger.debug('Calculating chunks based on keyframes')
-                arg = ['ffprobe', '-v', 'quiet', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags', '-of', 'json', file]
-                try:
-                    p = subprocess.Popen(arg, capture_output=True)
-                    p.wait()
-                except KeyboardInterrupt:
-                    p.terminate()
-                    process_failure.set()
-                if p.returncode != 0:
-                    logger.error(f'Error calculating keyframes: {p.stderr.decode()} with command: {" ".join(str(item) for item in arg)}')
-                    process_failure.set()
-                    os.kill(os.getpid(), signal.SIGINT)
-
-                frames = loads(p.stdout.decode())
-                # Iterate through each frame
-                for frame in frames['packets']:
-                    # If the frame has the keyframe flag and is not the first keyframe
-                    if 'K' in frame['flags'] and float(frame['pts_time']) > 0:
-                        logger.debug(f'Found keyframe at {frame["pts_time"]}')
-                        chunk_count += 1
-                        # Convert decimal seconds to frames
-                        end_frame = int(float(frame['pts_time']) * settings['fps'])
-
-                        # Create chunk variable with the folder structure and filename
-                        # and put it, alongside start_frame, end_frame and iter, in the queue for the chunk generator to use
-                        chunk = Path(settings['tmp_folder']) / 'prepared' / f'chunk{chunk_count}.{settings["output_extension"]}'
-                        logger.debug(f'Adding chunk {chunk_count} to queue with start_frame {start_frame} and end_frame {end_frame}')
-                        settings['chunk_calculate_queue'].put((start_frame, end_frame, chunk_count, chunk))
-
-                        # Set new start_frame as old end_frame.
-                        # No check is done since the iterator will exit on the last keyframe regardless
-                        start_frame = end_frame
+                # Use the packet index, which already holds the frame number of every keyframe in the video.
+                # Consecutive GOPs are merged into chunks between the minimum and maximum chunk length, which are always cut on a keyframe
+                logger.debug(f'Calculating chunks based on keyframes, between {settings["min_chunk_length"]} and {settings["max_chunk_length"]} long')
+                index = LoadPacketIndex(settings['packet_index'])
+                for end_frame in CoalesceKeyframes(index, settings['total_frames'], settings['min_chunk_length'], settings['max_chunk_length']):
+                    chunk_count += 1
+
+                    # Put the start_frame, end_frame, iter and complexity in the queue for the chunk generator to use
+                    logger.debug(f'Adding chunk {chunk_count} to queue with start_frame {start_frame} and end_frame {end_frame}')
+                    settings['chunk_calculate_queue'].put((start_frame, end_frame, chunk_count, ChunkComplexity(complexity, start_frame, end_frame)))
+                    start_frame = end_frame
 
-                        # Increase calculated chunks by one
-                        with chunk_range.get_lock():
-                            chunk_range.value += 1
-
-                chunk_count += 1
-                end_frame = settings['total_frames']
-                chunk = Path(settings['tmp_folder']) / 'prepared' / f'chunk{chunk_count}.{settings["output_extension"]}'
-                # Put the last chunk in the queue for the chunk generator to use
-                logger.debug(f'Adding chunk {chunk_count} to queue with start_frame {start_frame} and end_frame {end_frame}')
-                settings['chunk_calculate_queue'].put((start_frame, end_frame, chunk_count, chunk))
-                with chunk_range.get_lock():
-                    chunk_range.value += 1
+                    # Increase calculated chunks by one
+                    with chunk_range.get_lock():
+                        chunk_range.value += 1
                 break
         else:
             if process_failure.is_set():
-                os.kill(os.getpid(), signal.SIGINT)
+                return
 
     except Exception as e:
         logger.error(f'Error calculating chunks: {e}')
         # Set a global event indicating an error has occurred across a process
         process_failure.set()
-        os.kill(os.getpid(), signal.SIGINT)
+        return
     else:
-        # Ensure each chunk generator process is stopped
-        for _ in range(settings['chunk_threads']):
-            settings['chunk_calculate_queue'].put(None)
+        # End the stream, which stops each chunk generator process once it has taken the remaining chunks
+        settings['chunk_calculate_queue'].finish()
         logger.info('Finished calculating chunks')
         return
 
@@ -189,21 +249,28 @@ def generate(settings: dict,
 
     logger.info('Generating chunk')
     try:
-        while not process_failure.is_set():
-            item = settings['chunk_calculate_queue'].get(block=True)
+        # Iterate through the chunks until the chunk calculator has ended the stream
+        for item in settings['chunk_calculate_queue']:
+            if process_failure.is_set():
+                return
             if isinstance(item, tuple) and len(item) == 4:
                 logger.debug(f'Received item {item}')
-                start_frame, end_frame, i, chunk = item
-            elif isinstance(item, None.__class__):
-                settings['chunk_generator_queue'].put(None)
-                logger.info(f'Stopping {multiprocessing.current_process().name}: No more chunks to generate')
-                break
+                start_frame, end_frame, i, complexity = item
             else:
                 logger.error(f'Invalid item received from chunk_calculate_queue: {item}')
                 process_failure.set()
-                os.kill(os.getpid(), signal.SIGINT)
-
-            arg = ['ffmpeg', '-nostdin', '-n', '-ss', str(start_frame / settings['fps']), '-to', str(end_frame / settings['fps']), '-i', str(file), '-vf', f'scale={str(settings["output_width"])}:{str(settings["output_height"])}', '-c:v', 'libx264', '-preset', 'ultrafast', '-qp', '0', '-an', str(chunk)]
+                return
+
+            # Decode the exact frames of the source segment once, and split them into a lossless prepared chunk for each rendition
+            input_args, seek_filters, output_args = SeekArgs(settings, start_frame, end_frame)
+            filter_graph = f'[0:v]{seek_filters},split={len(settings["renditions"])}' + ''.join(f'[s{r}]' for r in range(len(settings['renditions'])))
+            outputs = []
+            for r, rendition in enumerate(settings['renditions']):
+                filter_graph += f';[s{r}]scale={str(rendition["output_width"])}:{str(rendition["output_height"])}[o{r}]'
+                outputs += ['-map', f'[o{r}]', '-fps_mode', 'passthrough'] + output_args + IntermediateArgs(settings) + ['-an', str(ChunkPath(settings, 'prepared', i, rendition))]
+            arg = ['ffmpeg', '-nostdin', '-n'] + input_args + ['-i', str(file), '-filter_complex', filter_graph] + outputs
+            # Wait until the converters have caught up, if the temporary folder has reached its budget
+            settings['temp_storage'].wait_for_space(i, process_failure)
             try:
                 p = subprocess.Popen(arg, stderr=subprocess.DEVNULL)
                 p.wait()
@@ -215,29 +282,383 @@ def generate(settings: dict,
                 logger.error(f'Error generating chunk {i} with command: {" ".join(str(item) for item in arg)}')
                 # Set a global event indicating an error has occurred across a process
                 process_failure.set()
-                os.kill(os.getpid(), signal.SIGINT)
+                return
+            for rendition in settings['renditions']:
+                settings['temp_storage'].add(ChunkPath(settings, 'prepared', i, rendition))
 
             logger.info(f'Finished generating chunk {i} out of {chunk_range.value}')
 
-            # Combine folder paths to create chunk path and name for the original and converted chunk
-            # and add them to the queue alongside the start_frame, end_frame and iter
-            original_chunk = Path(settings['tmp_folder']) / 'prepared' / f'chunk{i}.{settings["output_extension"]}'
-            converted_chunk = Path(settings['tmp_folder']) / 'converted' / f'chunk{i}.{settings["output_extension"]}'
-            logger.debug(f'Adding chunk {i} to queue with start_frame {start_frame} and end_frame {end_frame}')
-            settings['chunk_generator_queue'].put((start_frame, end_frame, i, original_chunk, converted_chunk))
-        else:
-            if process_failure.is_set():
-                os.kill(os.getpid(), signal.SIGINT)
+            # Combine folder paths to create chunk path and name for the original and converted chunk of each rendition
+            # and add them to the queue alongside the start_frame, end_frame, iter, complexity and rendition number
+            for r, rendition in enumerate(settings['renditions']):
+                original_chunk = ChunkPath(settings, 'prepared', i, rendition)
+                converted_chunk = ChunkPath(settings, 'converted', i, rendition)
+                logger.debug(f'Adding chunk {i} of rendition {r} to queue with start_frame {start_frame} and end_frame {end_frame}')
+                settings['chunk_generator_queue'].put((start_frame, end_frame, i, original_chunk, converted_chunk, complexity, r))
+
+        # Tell the chunk converters that this generator won't send any more chunks
+        settings['chunk_generator_queue'].finish()
+        logger.info(f'Stopping {multiprocessing.current_process().name}: No more chunks to generate')
 
     except Exception as e:
         logger.error(f'Error generating chunks: {e}')
         # Set a global event indicating an error has occurred across a process
         process_failure.set()
-        os.kill(os.getpid(), signal.SIGINT)
+        return
     else:
         return
 
 
+def segment(settings: dict,
+            file: str,
+            chunk_range: multiprocessing.Value,
+            process_failure: multiprocessing.Event) -> None:
+    """
+    Generates every prepared chunk from a single decode of the video file, in place of the chunk generators.
+
+    Once the chunk calculator has finished, a single FFmpeg process decodes the source from start to end,
+    forces a keyframe on the first frame of each chunk, and splits each rendition into its chunks with the segment muxer.
+    Each chunk is queued for the chunk converters as soon as FFmpeg has moved on to the next one.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        file (str): The path to the video file.
+        chunk_range (multiprocessing.Value): A shared value representing the total number of chunks.
+        process_failure (multiprocessing.Event): An event indicating if a failure has occurred in the process.
+
+    Returns:
+        None
+    """
+    handler = ExceptionHandler(settings['log_queue'], settings['manager_queue'])
+    sys.excepthook = handler.handle_exception
+
+    logger = create_logger(settings['log_queue'], 'chunk_segmenter')
+
+    try:
+        # The segment muxer needs every chunk boundary up front
+        chunks = list(settings['chunk_calculate_queue'])
+        if process_failure.is_set():
+            return
+        logger.info(f'Generating {len(chunks)} chunks in a single pass')
+
+        # Every chunk but the first starts on a forced keyframe, where the segment muxer can cut it
+        split_frames = [start_frame for start_frame, _, _, _ in chunks[1:]]
+        keyframe_args = ['-force_key_frames', f'expr:{"+".join(f"eq(n,{frame})" for frame in split_frames)}'] if split_frames else []
+        segment_args = ['-segment_frames', ','.join(str(frame) for frame in split_frames)] if split_frames else []
+
+        filter_graph = f'[0:v]split={len(settings["renditions"])}' + ''.join(f'[s{r}]' for r in range(len(settings['renditions'])))
+        outputs = []
+        for r, rendition in enumerate(settings['renditions']):
+            filter_graph += f';[s{r}]scale={str(rendition["output_width"])}:{str(rendition["output_height"])}[o{r}]'
+            # Pass every frame through as is, so the frame numbers of each output match the ones in the packet index
+            outputs += (['-map', f'[o{r}]', '-fps_mode', 'passthrough'] + IntermediateArgs(settings) + ['-an'] + keyframe_args
+                        + ['-f', 'segment'] + segment_args + ['-segment_start_number', '1', '-reset_timestamps', '1', str(ChunkPath(settings, 'prepared', '%d', rendition))])
+        arg = ['ffmpeg', '-nostdin', '-n', '-i', str(file), '-filter_complex', filter_graph] + outputs
+        logger.debug(f'Segmenting with command: {" ".join(str(item) for item in arg)}')
+
+        try:
+            p = subprocess.Popen(arg, stderr=subprocess.DEVNULL)
+            for n, (start_frame, end_frame, i, complexity) in enumerate(chunks):
+                # A chunk is complete once the segment muxer has opened the next chunk of every rendition, or FFmpeg has exited.
+                # The last chunk has no next chunk, so it is only complete once FFmpeg has exited
+                next_chunks = [ChunkPath(settings, 'prepared', i + 1, rendition) for rendition in settings['renditions']] if n + 1 < len(chunks) else []
+                while p.poll() is None and not (next_chunks and all(next_chunk.exists() for next_chunk in next_chunks)):
+                    if process_failure.is_set():
+                        p.terminate()
+                        return
+                    sleep(0.1)
+                if p.poll() is not None and p.returncode != 0:
+                    break
+                # The muxer writes fewer chunks than planned if the forced keyframes don't land on the planned frames, or the source is shorter than its index
+                missing = [ChunkPath(settings, 'prepared', i, rendition).name for rendition in settings['renditions'] if not ChunkPath(settings, 'prepared', i, rendition).exists()]
+                if missing:
+                    logger.error(f'Segmenting {Path(file).name} did not write {", ".join(missing)}')
+                    p.terminate()
+                    p.wait()
+                    # Set a global event indicating an error has occurred across a process
+                    process_failure.set()
+                    return
+
+                logger.info(f'Finished generating chunk {i} out of {chunk_range.value}')
+                for r, rendition in enumerate(settings['renditions']):
+                    original_chunk = ChunkPath(settings, 'prepared', i, rendition)
+                    converted_chunk = ChunkPath(settings, 'converted', i, rendition)
+                    settings['temp_storage'].add(original_chunk)
+                    logger.debug(f'Adding chunk {i} of rendition {r} to queue with start_frame {start_frame} and end_frame {end_frame}')
+                    settings['chunk_generator_queue'].put((start_frame, end_frame, i, original_chunk, converted_chunk, complexity, r))
+            p.wait()
+        except KeyboardInterrupt:
+            p.terminate()
+            process_failure.set()
+
+        if p.returncode != 0:
+            logger.error(f'Error segmenting {Path(file).name} with command: {" ".join(str(item) for item in arg)}')
+            # Set a global event indicating an error has occurred across a process
+            process_failure.set()
+            return
+
+        # Tell the chunk converters that no more chunks will be sent
+        settings['chunk_generator_queue'].finish()
+        logger.info(f'Stopping {multiprocessing.current_process().name}: No more chunks to generate')
+
+    except Exception as e:
+        logger.error(f'Error generating chunks: {e}')
+        # Set a global event indicating an error has occurred across a process
+        process_failure.set()
+        return
+    else:
+        return
+
+
+class ChunkError(Exception):
+    pass
+
+
+def AttemptPath(converted_chunk: str, crf_value: int) -> Path:
+    """
+    Create the path of a chunk's attempt at a CRF value, in a folder of its own next to the converted chunk.
+
+    Args:
+        converted_chunk (str): The path to the converted chunk.
+        crf_value (int): The CRF value of the attempt.
+
+    Returns:
+        Path: The path of the attempt, e.g. converted/chunk1/crf44.mp4.
+    """
+    converted_chunk = Path(converted_chunk)
+    return converted_chunk.with_suffix('') / f'crf{crf_value}{converted_chunk.suffix}'
+
+
+def BestAttempt(settings: dict, attempts: dict[int, float | None]) -> int:
+    """
+    Pick the attempt to keep, out of every attempt of a chunk.
+
+    Attempts within the VMAF range are preferred, and out of those, the one with the highest CRF value, as it is the smallest.
+    Otherwise the attempt closest to the VMAF range is picked, preferring the one above it on a tie.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings, including the VMAF range of the chunk's rendition.
+        attempts (dict[int, float | None]): The VMAF value of each attempt, by CRF value, in the order they were made. None if it couldn't be measured.
+
+    Returns:
+        int: The CRF value of the attempt to keep. If no attempt could be measured, the last one.
+    """
+    scored = {crf_value: vmaf_value for crf_value, vmaf_value in attempts.items() if vmaf_value is not None}
+    if not scored:
+        return list(attempts)[-1]
+    in_range = [crf_value for crf_value, vmaf_value in scored.items() if settings['vmaf_min_value'] <= vmaf_value <= settings['vmaf_max_value']]
+    if in_range:
+        return max(in_range)
+    return min(scored, key=lambda crf_value: (max(settings['vmaf_min_value'] - scored[crf_value], scored[crf_value] - settings['vmaf_max_value']), scored[crf_value] < settings['vmaf_min_value']))
+
+
+def StartAttempt(settings: dict, source_args: list[str], crf_value: int, attempt_file: Path) -> tuple[subprocess.Popen, list[str]]:
+    """
+    Start encoding a single attempt of a chunk, without waiting for it to finish.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        source_args (list[str]): The FFmpeg arguments that read the chunk's frames.
+        crf_value (int): The CRF value to encode with.
+        attempt_file (Path): The path the attempt is written to.
+
+    Returns:
+        tuple[subprocess.Popen, list[str]]: The FFmpeg process, and the command it was started with.
+    """
+    # TODO: Longer/Larger chunks, or a high preset, can cause the process to take a very long time.
+    # Maybe add some code that occasionally prints the progress of the conversion process?
+    # Keep the timestamps of the frames, so chunks of variable frame rate files keep their timing
+    arg = ['ffmpeg', '-nostdin'] + source_args + ['-fps_mode', 'passthrough', '-c:v', 'libsvtav1', '-crf', str(crf_value), '-b:v', '0', '-an', '-g', str(settings['keyframe_interval']), '-preset', str(settings['av1_preset']), '-pix_fmt', settings['pixel_format'], '-svtav1-params', f'tune={str(settings["tune_mode"])}', str(attempt_file)]
+    if settings['ffmpeg_verbose_level'] == 0:
+        p = subprocess.Popen(arg, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    else:
+        arg[1:1] = settings['ffmpeg_print']
+        p = subprocess.Popen(arg)
+    return p, arg
+
+
+def SpeculativeCandidates(crf_value: int, next_crf_value: int, attempts: dict[int, float | None], count: int) -> list[int]:
+    """
+    Pick extra CRF values to encode alongside the next attempt, one on each side of it.
+
+    Args:
+        crf_value (int): The CRF value of the previous attempt.
+        next_crf_value (int): The CRF value of the next attempt.
+        attempts (dict[int, float | None]): The attempts that have already been made, by CRF value.
+        count (int): The maximum number of extra CRF values.
+
+    Returns:
+        list[int]: The extra CRF values, which are all within 1-63 and haven't been tried yet.
+    """
+    # Bracket the next attempt by half the distance the search just moved, so one side likely lands in the range if the next attempt misses
+    step = max(abs(next_crf_value - crf_value) // 2, 1)
+    candidates = [next_crf_value - step, next_crf_value + step]
+    return [candidate for candidate in candidates if 1 <= candidate <= 63 and candidate not in attempts][:count]
+
+
+def EncodeChunk(settings: dict,
+                file: str,
+                start_frame: int,
+                end_frame: int,
+                original_chunk: str,
+                converted_chunk: str,
+                crf_value: int,
+                chunk_name: str,
+                logger: logging.Logger,
+                vmaf_logger: logging.Logger) -> tuple[int, float | None]:
+    """
+    Encodes a single chunk, adjusting the CRF value until its VMAF value is within range, or the maximum attempts are used.
+
+    This is the unit of work of a chunk converter, and only depends on the chunk's files, so it can run on any machine that can reach them.
+    Every attempt is kept, with its VMAF value, until the chunk is done, so the search never encodes the same CRF value twice,
+    and the best attempt is kept in the end, instead of the last one.
+
+    When other converters are idle, each attempt after the first is encoded alongside speculative candidates on either side of it.
+    The candidates that have finished are scored together in one VMAF run, and as soon as one of them lands in the VMAF range,
+    the ones still encoding are cancelled. Otherwise the search continues from the closest one.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings, including the resolution and VMAF range of the chunk's rendition.
+        file (str): The path to the input video file.
+        start_frame (int): The first frame of the chunk.
+        end_frame (int): The frame after the last frame of the chunk.
+        original_chunk (str): The path to the prepared chunk, used as the VMAF reference.
+        converted_chunk (str): The path the converted chunk is written to.
+        crf_value (int): The CRF value of the first attempt.
+        chunk_name (str): The name of the chunk, used in log messages.
+        logger (logging.Logger): The logger object used for logging messages.
+        vmaf_logger (logging.Logger): The logger object passed to the VMAF check.
+
+    Returns:
+        tuple[int, float | None]: The CRF value of the kept attempt, and its VMAF value, or None if it wasn't measured.
+
+    Raises:
+        ChunkError: If FFmpeg failed to encode the chunk.
+    """
+    crf_step = settings['initial_crf_step']
+    input_args, seek_filters, output_args = SeekArgs(settings, start_frame, end_frame)
+    # The attempts count towards the temporary folder budget, and borrow idle encoder slots,
+    # except on distributed workers, which don't have either
+    temp_storage = settings.get('temp_storage')
+    encoder_slots = settings.get('encoder_slots')
+    attempts = {}  # The VMAF value of each attempt, by CRF value
+    crf_values = [crf_value]  # The CRF values to encode in the current attempt
+    attempt = 0
+
+    # Decode the chunk once into the raw frame cache, so every attempt and VMAF comparison can read it instead of decoding the source again
+    raw_file = settings['raw_cache'].store(settings, file, start_frame, end_frame, Path(converted_chunk).stem, logger) if settings['use_raw_frame_cache'] else None
+    try:
+        while True:
+            attempt += 1
+            speculative = f' and speculatively with {", ".join(str(candidate) for candidate in crf_values[1:])}' if len(crf_values) > 1 else ''
+            logger.info(f'Converting chunk {chunk_name} with CRF value {crf_values[0]}{speculative} on attempt {attempt} out of {settings["max_attempts"]}')
+
+            # Fall back to decoding the source if the cached frames have been evicted
+            cached_frames = settings['raw_cache'].get(raw_file) if raw_file is not None else None
+            if cached_frames is not None:
+                source_args = ['-i', str(cached_frames)]
+            else:
+                source_args = input_args + ['-i', str(file), '-vf', f'{seek_filters},scale={str(settings["output_width"])}:{str(settings["output_height"])}'] + output_args
+
+            # The cached frames stay pinned until every candidate has been encoded and scored, so they can't be evicted while they are read
+            try:
+                processes = {}
+                running = {}
+                landed = False
+                vmaf_failed = False
+                try:
+                    for candidate in crf_values:
+                        attempt_file = AttemptPath(converted_chunk, candidate)
+                        attempt_file.parent.mkdir(parents=True, exist_ok=True)
+                        # Remove what a lost distributed worker may have left behind, so FFmpeg doesn't refuse to overwrite it
+                        attempt_file.unlink(missing_ok=True)
+                        processes[candidate] = StartAttempt(settings, source_args, candidate, attempt_file)
+                    running = dict(processes)
+
+                    while running and not landed:
+                        finished = [candidate for candidate, (p, _) in running.items() if p.poll() is not None]
+                        if not finished:
+                            sleep(0.1)
+                            continue
+                        for candidate in finished:
+                            p, arg = running.pop(candidate)
+                            if p.returncode != 0:
+                                raise ChunkError(f'Error converting chunk {chunk_name} with command: {" ".join(str(item) for item in arg)}')
+                            if temp_storage is not None:
+                                temp_storage.add(AttemptPath(converted_chunk, candidate))
+
+                        try:
+                            # Score every candidate that has finished against a single decode of the reference.
+                            # The cached frames are identical to the prepared chunk, and faster to decode, so prefer them as the reference
+                            reference_chunk = cached_frames or original_chunk
+                            if len(crf_values) == 1 and settings['vmaf_segments'] > 1:
+                                # A single long attempt, e.g. of a whole file, is compared faster in parallel segments
+                                vmaf_values = [ScoreVMAFSegmented(settings, reference_chunk, AttemptPath(converted_chunk, candidate), end_frame - start_frame, vmaf_logger)['harmonic_mean'] for candidate in finished]
+                            else:
+                                vmaf_values = ScoreVMAFBatch(settings, reference_chunk, [AttemptPath(converted_chunk, candidate) for candidate in finished], vmaf_logger)
+                            attempts.update(zip(finished, vmaf_values))
+                        except VMAFError:
+                            logger.error(f'Error calculating VMAF for chunk {chunk_name} with CRF value {", ".join(str(candidate) for candidate in finished)}. Keeping the best attempt...')
+                            attempts.update((candidate, None) for candidate in finished)
+                            vmaf_failed = True
+                            break
+                        # The candidates that are still encoding are no longer needed, once one of them lands in the VMAF range
+                        landed = any(attempts[candidate] is not None and settings['vmaf_min_value'] <= attempts[candidate] <= settings['vmaf_max_value'] for candidate in finished)
+                finally:
+                    # Cancel the candidates that are still encoding, after a hit, or if one of them failed
+                    for candidate, (p, _) in running.items():
+                        if p.poll() is None:
+                            p.terminate()
+                            p.wait()
+                        AttemptPath(converted_chunk, candidate).unlink(missing_ok=True)
+                    if encoder_slots is not None:
+                        encoder_slots.release(len(crf_values) - 1)
+            finally:
+                if cached_frames is not None:
+                    settings['raw_cache'].unpin(cached_frames)
+            if vmaf_failed:
+                break
+
+            # Continue the search from the candidate closest to the range
+            crf_value = BestAttempt(settings, {candidate: attempts[candidate] for candidate in crf_values if candidate in attempts})
+            retry, next_crf_value = AdjustCRF(settings, crf_value, crf_step, attempts[crf_value], AttemptPath(converted_chunk, crf_value), attempt, vmaf_logger)
+            if landed or not retry:
+                break
+            if next_crf_value in attempts:
+                # The search is bouncing between CRF values it has already tried, so none of them will land in the range
+                logger.info(f'Chunk {chunk_name} has already been converted with CRF value {next_crf_value}. Keeping the best attempt...')
+                break
+            if attempt >= settings['max_attempts']:
+                logger.error(f'Failed to convert chunk {chunk_name} after {settings["max_attempts"]} attempts. Keeping the best attempt...')
+                break
+
+            crf_values = [next_crf_value]
+            if encoder_slots is not None and settings['speculative_candidates']:
+                candidates = SpeculativeCandidates(crf_value, next_crf_value, attempts, settings['speculative_candidates'])
+                crf_values += candidates[:encoder_slots.borrow(len(candidates))]
+
+        # Move the best attempt in place of the converted chunk, and discard the rest
+        crf_value = BestAttempt(settings, attempts)
+        for attempt_crf_value in attempts:
+            if attempt_crf_value != crf_value:
+                if temp_storage is not None:
+                    temp_storage.remove(AttemptPath(converted_chunk, attempt_crf_value))
+                elif not settings['keep_tmp_files']:
+                    AttemptPath(converted_chunk, attempt_crf_value).unlink(missing_ok=True)
+        if temp_storage is not None:
+            temp_storage.release(AttemptPath(converted_chunk, crf_value))
+        os.replace(AttemptPath(converted_chunk, crf_value), converted_chunk)
+        try:
+            AttemptPath(converted_chunk, crf_value).parent.rmdir()
+        except OSError:  # Discarded attempts are kept with keep_tmp_files
+            pass
+    finally:
+        if raw_file is not None:
+            settings['raw_cache'].release(raw_file)
+
+    return crf_value, attempts[crf_value]
+
+
 def convert(settings: dict,
             file: str,
             chunk_range: multiprocessing.Value,
@@ -262,73 +683,82 @@ def convert(settings: dict,
     vmaf_logger = create_logger(settings['log_queue'], f'VMAF({i})')  # Create a new logger for VMAF and pass it to avoid duplicate log messages
 
     try:
-        while not process_failure.is_set():
-            attempt = 0
-            crf_value = settings['initial_crf_value']
-            item = settings['chunk_generator_queue'].get(block=True)
-            if isinstance(item, tuple) and len(item) == 5:
-                start_frame, end_frame, i, original_chunk, converted_chunk = item
-            elif isinstance(item, None.__class__):
-                logger.info(f'Stopping {multiprocessing.current_process().name}: No more chunks to convert')
-                break
+        # Iterate through the chunks until every chunk generator has finished
+        for item in settings['chunk_generator_queue']:
+            if process_failure.is_set():
+                return
+            if isinstance(item, tuple) and len(item) == 7:
+                start_frame, end_frame, i, original_chunk, converted_chunk, complexity, r = item
             else:
                 logger.error(f'Invalid item received from chunk_generator_queue: {item}')
                 process_failure.set()
-                os.kill(os.getpid(), signal.SIGINT)
-
-            crf_step = settings['initial_crf_step']
-            while True:
-                logger.info(f'Converting chunk {i} with CRF value {crf_value} on attempt {attempt + 1} out of {settings["max_attempts"]}')
-
-                # TODO: Longer/Larger chunks, or a high preset, can cause the process to take a very long time.
-                # Maybe add some code that occasionally prints the progress of the conversion process?
-                arg = ['ffmpeg', '-nostdin', '-ss', str(start_frame / int(settings['fps'])), '-to', str(end_frame / int(settings['fps'])), '-i', file, '-vf', f'scale={str(settings["output_width"])}:{str(settings["output_height"])}', '-c:v', 'libsvtav1', '-crf', str(crf_value), '-b:v', '0', '-an', '-g', str(settings['keyframe_interval']), '-preset', str(settings['av1_preset']), '-pix_fmt', settings['pixel_format'], '-svtav1-params', f'tune={str(settings["tune_mode"])}', converted_chunk]
-                try:
-                    if settings['ffmpeg_verbose_level'] == 0:
-                        p = subprocess.Popen(arg, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
-                    else:
-                        arg[1:1] = settings['ffmpeg_print']
-                        p = subprocess.Popen(arg)
-                    p.wait()
-                except KeyboardInterrupt:
-                    p.terminate()
-                    process_failure.set()
+                return
 
-                if p.returncode != 0:
-                    logger.error(f'Error converting chunk {i} with command: {" ".join(str(item) for item in arg)}')
-                    process_failure.set()
-                    os.kill(os.getpid(), signal.SIGINT)
+            # Use the resolution and VMAF range of the chunk's rendition in place of the global ones
+            rendition_settings = {**settings, **settings['renditions'][r]}
+            chunk_name = f'{i} ({rendition_settings["name"]})' if rendition_settings['name'] else f'{i}'
 
-                if attempt >= settings['max_attempts']:
-                    logger.error(f'Failed to convert chunk {i} after {settings["max_attempts"]} attempts. Skipping...')
-                    sleep(2)
-                    break
-                attempt += 1
+            # Start from the CRF value that previously finished chunks of the same rendition, with a similar complexity, settled on
+            crf_value = settings['crf_priors'][r].predict(complexity)
+            logger.debug(f'Starting chunk {chunk_name} with complexity {complexity} from predicted CRF value {crf_value}')
 
-                try:
-                    retry, crf_value = CheckVMAF(settings, crf_value, crf_step, original_chunk, converted_chunk, attempt, vmaf_logger)
-                except VMAFError:
-                    logger.error(f'Error calculating VMAF for chunk {i} with CRF value {crf_value}. Skipping...')
-                    break
-                if retry is False:
-                    logger.info(f'Finished converting chunk {i} out of {chunk_range.value} with CRF value {crf_value}')
-                    # Add a dictionary containing the iter and the chunk path and filename combined
-                    # Using the iter as the key allows for an easy way to use them in the correct order later on
-                    settings['chunk_concat_queue'].put({i: converted_chunk})
-                    break
-                else:
-                    continue
-        else:
-            if process_failure.is_set():
-                os.kill(os.getpid(), signal.SIGINT)
+            # Hold an encoder slot while converting, so speculative candidates only borrow the slots of idle converters
+            settings['encoder_slots'].hold()
+            try:
+                crf_value, vmaf_value = EncodeChunk(rendition_settings, file, start_frame, end_frame, original_chunk, converted_chunk, crf_value, chunk_name, logger, vmaf_logger)
+            finally:
+                settings['encoder_slots'].release()
+            logger.info(f'Finished converting chunk {chunk_name} out of {chunk_range.value} with CRF value {crf_value}')
+            FinishChunk(settings, r, i, original_chunk, converted_chunk, crf_value, vmaf_value, complexity)
+
+        # Tell the stream concatenator that this converter won't send any more chunks
+        settings['chunk_concat_queue'].finish()
+        logger.info(f'Stopping {multiprocessing.current_process().name}: No more chunks to convert')
     except Exception as e:
         logger.error(f'Error converting chunks: {e}')
         # Set a global event indicating an error has occurred across a process
         process_failure.set()
-        os.kill(os.getpid(), signal.SIGINT)
+        return
     else:
         return
 
 
+def FinishChunk(settings: dict,
+                r: int,
+                i: int,
+                original_chunk: str,
+                converted_chunk: str,
+                crf_value: int,
+                vmaf_value: float | None,
+                complexity: float | None) -> None:
+    """
+    Records the result of a converted chunk, and passes it on to the stream concatenator.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        r (int): The rendition number of the chunk.
+        i (int): The chunk number.
+        original_chunk (str): The path to the prepared chunk, which is no longer needed.
+        converted_chunk (str): The path to the converted chunk.
+        crf_value (int): The CRF value the chunk was converted with.
+        vmaf_value (float | None): The VMAF value of the chunk, or None if it wasn't measured.
+        complexity (float | None): The complexity score of the chunk, if it has been analysed.
+
+    Returns:
+        None
+    """
+    rendition = settings['renditions'][r]
+    # Only chunks that landed inside the VMAF range are useful to predict the CRF value of the next chunks
+    if vmaf_value is not None and rendition['vmaf_min_value'] <= vmaf_value <= rendition['vmaf_max_value']:
+        settings['crf_priors'][r].post(crf_value, vmaf_value, complexity)
+
+    # The prepared chunk is no longer needed, once the chunk is done
+    settings['temp_storage'].remove(original_chunk)
+    settings['temp_storage'].add(converted_chunk)
+    # Add a dictionary containing the rendition number and iter, and the chunk path and filename combined
+    # Using the rendition number and iter as the key allows for an easy way to use them in the correct order later on
+    settings['chunk_concat_queue'].put({(r, i): converted_chunk})
+
+
 if __name__ == '__main__':
     print('This file should not be run as a standalone script!')
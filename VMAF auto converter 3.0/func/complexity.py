@@ -0,0 +1,95 @@
+from math import log2
+from pathlib import Path
+import logging
+import subprocess
+import os
+import signal
+
+from func.cache import ReadCache, WriteCache
+
+# Width the frames are downscaled to before being analysed. Small enough to make the filters cheap,
+# while still keeping enough detail for the spatial and temporal information to be meaningful.
+ANALYSIS_WIDTH = 256
+
+
+def AnalyseComplexity(settings: dict, file: str, logger: logging.Logger) -> list[float] | None:
+    """
+    Calculate a complexity score for every frame in a video file.
+
+    The frames are heavily downscaled and run through FFmpeg's entropy and signalstats filters.
+    The entropy of the luma plane is used as the spatial information, and the average difference
+    to the previous frame as the temporal information. The result is cached, so it can be reused
+    as long as the file is unchanged.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        file (str): The path to the video file.
+        logger (logging.Logger): The logger object used for logging messages.
+
+    Returns:
+        list[float] | None: The complexity score of each frame, or None if the analysis failed.
+    """
+    complexity = ReadCache(settings, file, 'complexity')
+    if complexity is not None:
+        logger.debug(f'Using cached complexity analysis of {Path(file).name}')
+        return complexity
+
+    logger.info(f'Analysing the complexity of {Path(file).name}...')
+    metadata_file = Path(settings['tmp_folder']) / 'complexity.txt'
+    # FFmpeg is run from the temporary folder, to avoid having to escape the metadata file path inside the filter graph
+    arg = ['ffmpeg', '-nostdin', '-y', '-i', str(Path(file).resolve()), '-an', '-vf', f'scale={ANALYSIS_WIDTH}:-2,format=yuv420p,signalstats,entropy,metadata=mode=print:file={metadata_file.name}', '-f', 'null', '-']
+    logger.debug(f'Running command: {" ".join(str(item) for item in arg)}')
+    try:
+        p = subprocess.Popen(arg, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL, cwd=settings['tmp_folder'])
+        p.wait()
+    except KeyboardInterrupt:
+        p.terminate()
+        os.kill(os.getpid(), signal.SIGINT)
+
+    if p.returncode != 0 or not metadata_file.exists():
+        logger.warning(f'Could not analyse the complexity of {Path(file).name}. Continuing without it.')
+        return None
+
+    complexity = []
+    spatial = temporal = 0.0
+    with open(metadata_file) as f:
+        for line in f:
+            # Each frame starts with a "frame:N pts:N pts_time:N" line, followed by one line per metadata key
+            if line.startswith('frame:'):
+                if line.split()[0] != 'frame:0':
+                    complexity.append(spatial + log2(1 + temporal))
+                spatial = temporal = 0.0
+            elif line.startswith('lavfi.entropy.entropy.normal.Y='):
+                spatial = float(line.split('=', 1)[1])
+            elif line.startswith('lavfi.signalstats.YDIF='):
+                temporal = float(line.split('=', 1)[1])
+    complexity.append(spatial + log2(1 + temporal))
+    metadata_file.unlink()
+
+    WriteCache(settings, file, 'complexity', complexity)
+    logger.debug(f'Analysed the complexity of {len(complexity)} frames')
+    return complexity
+
+
+def ChunkComplexity(complexity: list[float] | None, start_frame: int, end_frame: int) -> float | None:
+    """
+    Calculate the complexity score of a chunk, as the average complexity of its frames.
+
+    Args:
+        complexity (list[float] | None): The complexity score of each frame, as returned by AnalyseComplexity.
+        start_frame (int): The first frame of the chunk.
+        end_frame (int): The frame after the last frame of the chunk.
+
+    Returns:
+        float | None: The complexity score of the chunk, or None if no analysis is available.
+    """
+    if not complexity:
+        return None
+    frames = complexity[start_frame:end_frame]
+    if not frames:
+        return None
+    return sum(frames) / len(frames)
+
+
+if __name__ == '__main__':
+    print('This file should not be run as a standalone script!')
@@ -0,0 +1,380 @@
+from multiprocessing.managers import BaseManager
+from pathlib import Path
+from queue import Empty, Queue
+from threading import Event, Thread
+from time import monotonic, sleep
+from uuid import uuid4
+import ipaddress
+import multiprocessing
+import secrets
+import socket
+import sys
+import os
+
+from func.chunking import ChunkError, EncodeChunk, FinishChunk
+from func.logger import create_logger
+from func.manager import EndOfStream, ExceptionHandler
+
+DISTRIBUTED_OFF = 0
+COORDINATOR = 1
+WORKER = 2
+
+# How often a worker tells the coordinator it is still working on its chunk, in seconds
+HEARTBEAT_INTERVAL = 5
+# How long a worker waits before connecting to the coordinator again, in seconds
+RECONNECT_INTERVAL = 5
+# How many times a chunk is handed out again, after the worker converting it was lost or failed
+MAX_RETRIES = 3
+# The authkey in a new settings file, which is public, so it is never used by a coordinator other machines can reach
+DEFAULT_AUTHKEY = 'change me'
+
+# Settings that only exist in the processes of this machine, and are never sent to a worker
+PROCESS_LOCAL_SETTINGS = ('log_queue', 'manager_queue', 'chunk_calculate_queue', 'chunk_generator_queue', 'chunk_concat_queue', 'crf_priors', 'raw_cache', 'temp_storage', 'encoder_slots')
+
+# The queues served by the coordinator. They only exist in the coordinator's server process.
+work_queue = Queue()
+result_queue = Queue()
+
+
+def GetWorkQueue() -> Queue:
+    return work_queue
+
+
+def GetResultQueue() -> Queue:
+    return result_queue
+
+
+class ChunkManager(BaseManager):
+    """
+    Serves the queues chunks are distributed through over TCP.
+
+    The coordinator puts a work unit on the work queue for each chunk, which the workers take, convert and answer
+    on the result queue. Work units only contain paths, so the temporary folder and the input files must be reachable
+    from every worker at the same path, e.g. through a network share mounted at the same location.
+    """
+
+
+ChunkManager.register('get_work_queue', callable=GetWorkQueue)
+ChunkManager.register('get_result_queue', callable=GetResultQueue)
+
+
+def CreateChunkManager(settings: dict) -> ChunkManager:
+    """
+    Create a manager for the coordinator address in the settings.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+
+    Returns:
+        ChunkManager: The manager, which is neither started nor connected.
+    """
+    host, _, port = settings['coordinator_address'].rpartition(':')
+    return ChunkManager(address=(host, int(port)), authkey=settings['coordinator_authkey'].encode())
+
+
+def StartCoordinator(settings: dict) -> ChunkManager:
+    """
+    Start serving the work and result queues on the coordinator address, for workers to connect to.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+
+    Returns:
+        ChunkManager: The started manager, which should be shut down when every file has been converted.
+    """
+    logger = create_logger(settings['log_queue'], 'coordinator')
+    # The queues are served with pickle, so anyone with the authkey can run code on the coordinator
+    host, _, _ = settings['coordinator_address'].rpartition(':')
+    if settings['coordinator_authkey'] == DEFAULT_AUTHKEY and not IsLoopback(host):
+        settings['coordinator_authkey'] = secrets.token_urlsafe(24)
+        logger.warning(f'The coordinator listens on {host}, which other machines can reach, so the default authkey is not used. '
+                       f'Start the workers with --coordinator-authkey {settings["coordinator_authkey"]}, or set coordinator_authkey in settings.ini')
+    manager = CreateChunkManager(settings)
+    manager.start()
+    logger.info(f'Waiting for workers on {settings["coordinator_address"]}')
+    return manager
+
+
+def IsLoopback(host: str) -> bool:
+    """
+    Check if a host name or address only accepts connections from this machine.
+
+    Args:
+        host (str): The host name or address.
+
+    Returns:
+        bool: True if the host resolves to a loopback address.
+    """
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def WorkerSettings(settings: dict) -> dict:
+    """
+    Create a copy of the settings that can be sent to a worker.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+
+    Returns:
+        dict: The settings, without the queues and shared objects that only exist on this machine.
+    """
+    return {key: value for key, value in settings.items() if key not in PROCESS_LOCAL_SETTINGS}
+
+
+def coordinate(settings: dict,
+               file: str,
+               chunk_range: multiprocessing.Value,
+               process_failure: multiprocessing.Event) -> None:
+    """
+    Takes the place of the chunk converters, by handing each prepared chunk to a worker, and collecting the results.
+
+    The starting CRF value of each chunk is predicted here, so every worker shares the same model.
+    A worker holds a lease on the chunk it is converting, from when it takes it, which it renews with a heartbeat.
+    If the lease runs out, or the worker reports a failure, the chunk is handed out again.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        file (str): The path to the input video file.
+        chunk_range (multiprocessing.Value): A shared value representing the total number of chunks.
+        process_failure (multiprocessing.Event): An event indicating if the conversion process has failed.
+
+    Returns:
+        None
+    """
+    logger = create_logger(settings['log_queue'], 'coordinator')
+    manager = CreateChunkManager(settings)
+    manager.connect()
+    chunks = manager.get_work_queue()
+    results = manager.get_result_queue()
+    # Nothing an earlier file left in the queues belongs to this one
+    Drain(chunks)
+    Drain(results)
+
+    # Results of an earlier file, or of a lease that has since run out, are recognised by their id, and ignored.
+    # The token is also part of the converted path, so a worker still converting a chunk of an earlier file can't overwrite a chunk of this one
+    token = uuid4().hex
+    units = {}  # Chunks that have been handed out, but are not done yet, by id
+    leases = {}  # The worker converting each chunk, and when its lease runs out, by id
+    stream_ended = False
+
+    try:
+        while not process_failure.is_set() and not (stream_ended and not units):
+            if not stream_ended:
+                try:
+                    item = settings['chunk_generator_queue'].get(timeout=0.1)
+                except Empty:
+                    item = None
+                if isinstance(item, EndOfStream):
+                    stream_ended = True
+                elif item is not None:
+                    start_frame, end_frame, i, original_chunk, converted_chunk, complexity, r = item
+                    rendition_settings = {**settings, **settings['renditions'][r]}
+                    unit = {'id': (token, r, i, 0),
+                            'file': str(file),
+                            'start_frame': start_frame,
+                            'end_frame': end_frame,
+                            'original_chunk': str(original_chunk),
+                            'converted_chunk': str(Path(converted_chunk).with_suffix(f'.{token}{Path(converted_chunk).suffix}')),
+                            'crf_value': settings['crf_priors'][r].predict(complexity),
+                            'chunk_name': f'{i} ({rendition_settings["name"]})' if rendition_settings['name'] else f'{i}',
+                            'complexity': complexity,
+                            'settings': WorkerSettings(rendition_settings)}
+                    units[unit['id']] = unit
+                    chunks.put(unit)
+                    logger.debug(f'Queued chunk {unit["chunk_name"]} with predicted CRF value {unit["crf_value"]}')
+
+            try:
+                message = results.get(timeout=0.1 if stream_ended else 0)
+            except Empty:
+                message = None
+
+            if message is not None:
+                kind, unit_id, worker_name = message[:3]
+                if unit_id not in units:
+                    logger.debug(f'Ignoring {kind} message from {worker_name} for a chunk that is no longer handed out')
+                elif kind in ('started', 'heartbeat'):
+                    leases[unit_id] = (worker_name, monotonic() + settings['worker_timeout'])
+                elif kind == 'done':
+                    unit = units.pop(unit_id)
+                    leases.pop(unit_id, None)
+                    crf_value, vmaf_value = message[3:]
+                    _, r, i, _ = unit_id
+                    logger.info(f'{worker_name} finished converting chunk {unit["chunk_name"]} out of {chunk_range.value} with CRF value {crf_value}')
+                    FinishChunk(settings, r, i, unit['original_chunk'], unit['converted_chunk'], crf_value, vmaf_value, unit['complexity'])
+                elif kind == 'failed':
+                    logger.warning(f'{worker_name} failed to convert chunk {units[unit_id]["chunk_name"]}: {message[3]}')
+                    Requeue(units, leases, unit_id, chunks, process_failure, logger)
+
+            # Chunks leave the work queue in the order they were put on it, so every chunk without a lease, beyond the ones still queued,
+            # has been taken by a worker. Their lease starts now, so a worker that is lost before it reports back doesn't stall the file
+            waiting = [unit_id for unit_id in units if unit_id not in leases]
+            for unit_id in waiting[:max(len(waiting) - chunks.qsize(), 0)]:
+                leases[unit_id] = ('a worker', monotonic() + settings['worker_timeout'])
+
+            for unit_id, (worker_name, deadline) in list(leases.items()):
+                if monotonic() > deadline:
+                    logger.warning(f'Lost {worker_name} while it was converting chunk {units[unit_id]["chunk_name"]}')
+                    Requeue(units, leases, unit_id, chunks, process_failure, logger)
+    finally:
+        # Take back the chunks no worker has taken yet, so they aren't converted after the file has finished or failed
+        Drain(chunks)
+
+    # Tell the stream concatenator that no more chunks will be sent
+    settings['chunk_concat_queue'].finish()
+    logger.info(f'Stopping coordinator: No more chunks to convert for {Path(file).name}')
+
+
+def Requeue(units: dict, leases: dict, unit_id: tuple, chunks: Queue, process_failure: multiprocessing.Event, logger) -> None:
+    """
+    Hand a chunk out again, under a new id and converted path, so a lost worker that turns out to still be running can't overwrite the new attempt.
+
+    Args:
+        units (dict): The chunks that have been handed out, by id.
+        leases (dict): The worker converting each chunk, and when its lease runs out, by id.
+        unit_id (tuple): The id of the chunk to hand out again.
+        chunks (Queue): The work queue served by the coordinator.
+        process_failure (multiprocessing.Event): Set if the chunk has been retried too many times.
+        logger (logging.Logger): The logger object used for logging messages.
+
+    Returns:
+        None
+    """
+    unit = units.pop(unit_id)
+    leases.pop(unit_id, None)
+    token, r, i, retry = unit_id
+    if retry >= MAX_RETRIES:
+        logger.error(f'Chunk {unit["chunk_name"]} could not be converted after {MAX_RETRIES} retries')
+        process_failure.set()
+        return
+
+    converted_chunk = Path(unit['converted_chunk'])
+    unit['id'] = (token, r, i, retry + 1)
+    unit['converted_chunk'] = str(converted_chunk.with_name(f'{converted_chunk.stem.split(".retry")[0]}.retry{retry + 1}{converted_chunk.suffix}'))
+    units[unit['id']] = unit
+    chunks.put(unit)
+    logger.info(f'Handing out chunk {unit["chunk_name"]} again, retry {retry + 1} out of {MAX_RETRIES}')
+
+
+def Drain(queue: Queue) -> None:
+    """
+    Discard every item in a queue served by the coordinator.
+
+    Args:
+        queue (Queue): The queue.
+
+    Returns:
+        None
+    """
+    while True:
+        try:
+            queue.get_nowait()
+        except Empty:
+            return
+
+
+def worker(settings: dict) -> None:
+    """
+    Run a worker node, with a worker process for each chunk thread, until it is interrupted.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+
+    Returns:
+        None
+    """
+    processlist = []
+    for i in range(1, settings['chunk_threads'] + 1):
+        worker_process = multiprocessing.Process(target=work, args=(settings, i))
+        worker_process.start()
+        processlist.append(worker_process)
+    for p in processlist:
+        p.join()
+
+
+def work(settings: dict, i: int) -> None:
+    """
+    Converts chunks handed out by the coordinator, reconnecting whenever the connection is lost.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings of this machine.
+        i (int): The process number.
+
+    Returns:
+        None
+    """
+    handler = ExceptionHandler(settings['log_queue'], settings['manager_queue'])
+    sys.excepthook = handler.handle_exception
+    logger = create_logger(settings['log_queue'], f'worker({i})')
+    vmaf_logger = create_logger(settings['log_queue'], f'VMAF({i})')
+    worker_name = f'{socket.gethostname()}:{os.getpid()}'
+
+    while True:
+        try:
+            manager = CreateChunkManager(settings)
+            manager.connect()
+            chunks = manager.get_work_queue()
+            results = manager.get_result_queue()
+        except OSError:
+            logger.info(f'Waiting for the coordinator on {settings["coordinator_address"]}...')
+            sleep(RECONNECT_INTERVAL)
+            continue
+        logger.info(f'Connected to the coordinator on {settings["coordinator_address"]}')
+
+        try:
+            while True:
+                unit = chunks.get()
+                ConvertUnit(settings, unit, results, worker_name, logger, vmaf_logger)
+        except (OSError, EOFError):
+            logger.warning('Lost the connection to the coordinator')
+            sleep(RECONNECT_INTERVAL)
+
+
+def ConvertUnit(settings: dict, unit: dict, results: Queue, worker_name: str, logger, vmaf_logger) -> None:
+    """
+    Convert a single chunk handed out by the coordinator, and send the result back.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings of this machine.
+        unit (dict): The work unit, containing the chunk's frames and files, its starting CRF value and the coordinator's settings.
+        results (Queue): The result queue served by the coordinator.
+        worker_name (str): The name the coordinator knows this worker by.
+        logger (logging.Logger): The logger object used for logging messages.
+        vmaf_logger (logging.Logger): The logger object passed to the VMAF check.
+
+    Returns:
+        None
+    """
+    # Use the coordinator's encoder settings, with the core count of this machine.
+    # The raw frame cache is shared between the converters of a single machine, so it is not used by workers.
+    unit_settings = {**unit['settings'], 'physical_cores': settings['physical_cores'], 'use_raw_frame_cache': False}
+    results.put(('started', unit['id'], worker_name))
+
+    # Renew the lease while the chunk is being converted
+    converting = Event()
+
+    def heartbeat():
+        while not converting.wait(HEARTBEAT_INTERVAL):
+            results.put(('heartbeat', unit['id'], worker_name))
+
+    HeartbeatThread = Thread(target=heartbeat, daemon=True)
+    HeartbeatThread.start()
+    try:
+        # Remove what a lost worker may have left behind, so FFmpeg doesn't refuse to overwrite it
+        Path(unit['converted_chunk']).unlink(missing_ok=True)
+        crf_value, vmaf_value = EncodeChunk(unit_settings, unit['file'], unit['start_frame'], unit['end_frame'], unit['original_chunk'], unit['converted_chunk'], unit['crf_value'], unit['chunk_name'], logger, vmaf_logger)
+    except ChunkError as e:
+        logger.error(e)
+        results.put(('failed', unit['id'], worker_name, str(e)))
+    else:
+        logger.info(f'Finished converting chunk {unit["chunk_name"]} with CRF value {crf_value}')
+        results.put(('done', unit['id'], worker_name, crf_value, vmaf_value))
+    finally:
+        converting.set()
+        HeartbeatThread.join()
+
+
+if __name__ == '__main__':
+    print('This file should not be run as a standalone script!')
@@ -1,5 +1,10 @@
-from multiprocessing import Event, Process, Value
+from fractions import Fraction
+from multiprocessing import Event, Lock, Manager, Process, Value
 from pathlib import Path
+from io import BufferedWriter
+from queue import Empty
+from shutil import copyfileobj
+import logging
 import subprocess
 from threading import Thread
 from time import sleep
@@ -7,15 +12,37 @@ import sys
 import os
 import signal
 
-from func.chunking import calculate, generate, convert
-from func.extractor import ExtractAudio, GetAudioMetadata, GetVideoMetadata
-from func.temp import CreateTempFolder
-from func.vmaf import CheckVMAF, VMAFError
+from func.chunking import ChunkError, ChunkPath, EncodeChunk, LongestChunk, calculate, generate, segment, convert
+from func.distributed import COORDINATOR, coordinate
+from func.index import BuildPacketIndex, IsVariableFrameRate, LoadPacketIndex
+from func.intermediate import AUTO, BenchmarkIntermediate
+from func.intro import CachedSegment, SegmentDuration, SegmentFrames
+from func.extractor import AudioPath, TranscodeAudio, GetAudioMetadata, GetVideoMetadata
+from func.temp import CreateTempFolder, TempStorage
 from func.logger import create_logger
-from func.manager import ExceptionHandler
+from func.manager import EncoderSlots, EndOfStream, ExceptionHandler
+from func.prior import CRFPrior
+from func.rawcache import RawFrameCache
 
 NO_CHUNK = 0
 
+# Outputs are written under this prefix in the output folder, and renamed once they are complete
+PARTIAL_PREFIX = '.partial-'
+# Containers written by the MP4/MOV muxer, which can reserve space for the index at the start of the file
+MOV_EXTENSIONS = ('mp4', 'm4v', 'mov')
+# Upper estimates of the index size of each video frame and audio frame in an MP4 file, in bytes, and of the rest of the index
+MOOV_BYTES_PER_VIDEO_FRAME = 16
+MOOV_BYTES_PER_AUDIO_FRAME = 8
+MOOV_OVERHEAD = 64 * 1024
+# AAC frames per second at the highest common sample rate, 96 kHz, with 1024 samples per frame
+AAC_FRAMES_PER_SECOND = 94
+# The queues chunks are passed through, between the chunk processes
+CHUNK_QUEUES = ('chunk_calculate_queue', 'chunk_generator_queue', 'chunk_concat_queue')
+
+
+class EncodeError(Exception):
+    """Raised when a file could not be converted. Its processes have been stopped, so the next file can be converted."""
+
 
 def encoder(settings: dict, file: str) -> None:
     handler = ExceptionHandler(settings['log_queue'], settings['manager_queue'])
@@ -23,54 +50,85 @@ def encoder(settings: dict, file: str) -> None:
 
     logger = create_logger(settings['log_queue'], 'encoder')
 
-    settings['attempt'] = 0
     # Get and add metadata from the input file, to settings
     settings.update(GetAudioMetadata(file, settings))
     settings.update(GetVideoMetadata(file, settings))
 
-    if settings['chunk_mode'] == NO_CHUNK:  # ENCODING WITHOUT CHUNKS
-        crf_value = settings['initial_crf_value']
-
-        # Run infinite loop that only breaks if the quality is within range
-        # max attempts has exceeded, or an error has occurred
-        while True:
-            logger.info(f'Converting {Path(file).stem}...')
-            crf_step = settings['initial_crf_step']
-            arg = ['ffmpeg', '-nostdin', '-i', file, '-vf', f'scale={str(settings["output_width"])}:{str(settings["output_height"])}', '-c:a', 'aac', '-c:v', 'libsvtav1', '-crf', str(crf_value), '-b:v', '0', '-b:a', str(settings['audio_bitrate']), '-g', str(settings['keyframe_interval']), '-preset', str(settings['av1_preset']), '-pix_fmt', settings['pixel_format'], '-svtav1-params', f'tune={str(settings["tune_mode"])}', '-movflags', '+faststart', f'{Path(settings["output_dir"]) / Path(file).stem}.{settings["output_extension"]}']
-            try:
-                if settings['ffmpeg_verbose_level'] == 0:
-                    p = subprocess.Popen(arg, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
-                else:
-                    arg[1:1] = settings['ffmpeg_print']
-                    p = subprocess.Popen(arg)
-                p.wait()
-            except KeyboardInterrupt:
-                p.terminate()
-                os.kill(os.getpid(), signal.SIGINT)
+    # Get the intro and outro of each rendition, which are only encoded once for every file they are attached to
+    try:
+        settings['intro_streams'] = [CachedSegment(settings, settings['intro_file'], rendition, logger) for rendition in settings['renditions']] if settings['use_intro'] else []
+        settings['outro_streams'] = [CachedSegment(settings, settings['outro_file'], rendition, logger) for rendition in settings['renditions']] if settings['use_outro'] else []
+        # Every rendition of a segment has the same frames, so the first one is counted
+        settings['segment_frames'] = sum(SegmentFrames(streams[0]) for streams in (settings['intro_streams'], settings['outro_streams']) if streams)
+    except (OSError, ValueError) as e:
+        raise EncodeError(f'Error preparing the intro or outro: {e}') from e
 
-            if p.returncode != 0:
-                logger.error(f'Error converting {Path(file).stem} with arguments: {arg}')
-                os.kill(os.getpid(), signal.SIGINT)
-            print('\nVideo encoding finished!')
+    if settings['chunk_mode'] == NO_CHUNK:  # ENCODING WITHOUT CHUNKS
+        CreateTempFolder(settings['tmp_folder'], settings['log_queue'])
+        # The whole file is converted as a single chunk, so it goes through the same CRF search as the chunks do
+        settings['packet_index'] = BuildPacketIndex(file, settings)
+        settings['total_frames'] = len(LoadPacketIndex(settings['packet_index'])['pts'])
+        # Raw AV1 streams have no timestamps, so variable frame rate files are joined by a concat list instead
+        settings['variable_frame_rate'] = IsVariableFrameRate(LoadPacketIndex(settings['packet_index']))
+        settings['raw_cache'] = RawFrameCache(settings, Lock())
+        vmaf_logger = create_logger(settings['log_queue'], 'VMAF')
 
-            if settings['attempt'] >= settings['max_attempts']:
-                logger.info(f'Maximum amount of allowed attempts exceeded for {Path(file).stem}. Skipping...')
-                sleep(2)
-                return
-            settings['attempt'] += 1
+        process_failure = Event()
 
-            converted_file = Path(settings['output_dir']) / f'{Path(file).stem}.{settings["output_extension"]}'
+        # Transcode the audio once, alongside the video-only attempts, instead of on every attempt
+        if settings['detected_audio_stream']:
+            AudioTranscodeThread = Thread(target=TranscodeAudio,
+                                          args=(settings,
+                                                file,
+                                                process_failure))
+            AudioTranscodeThread.start()
+
+        for r, rendition in enumerate(settings['renditions']):
+            rendition_settings = {**settings, **rendition}
+            name = f'{Path(file).stem} ({rendition["name"]})' if rendition['name'] else Path(file).stem
+            converted_file = ChunkPath(settings, 'converted', 1, rendition)
+            logger.info(f'Converting {name}...')
             try:
-                retry = CheckVMAF(settings, crf_value, crf_step, file, converted_file, settings['attempt'])
-                if not retry:
-                    logger.info(f'Finished converting file {Path(converted_file).stem}')
+                crf_value, vmaf_value = EncodeChunk(rendition_settings, file, 0, settings['total_frames'], file, converted_file, settings['initial_crf_value'], name, logger, vmaf_logger)
+            except ChunkError as e:
+                logger.error(e)
+                process_failure.set()
+                break
+            logger.info(f'Finished converting {name} with CRF value {crf_value}')
+
+            # Write the video to the same stream the chunks are appended to, between the intro and outro
+            with open(StreamPath(settings, r), 'wb') as stream:
+                if settings['intro_streams'] and not AppendSegment(settings, stream, settings['intro_streams'][r], logger):
+                    process_failure.set()
                     break
+                if settings['variable_frame_rate']:
+                    appended = AppendConcatList(settings, stream, converted_file, 0, logger) is not None
                 else:
-                    continue
-            except VMAFError:
-                break
+                    appended = AppendStream(settings, stream, converted_file, logger)
+                if not appended or settings['outro_streams'] and not AppendSegment(settings, stream, settings['outro_streams'][r], logger):
+                    process_failure.set()
+                    break
+
+        # Wait for the audio transcoding to finish before combining the video and audio
+        if settings['detected_audio_stream'] and AudioTranscodeThread.is_alive():
+            logger.info('Waiting for audio transcoding to finish...')
+            AudioTranscodeThread.join()
+
+        if process_failure.is_set():
+            raise EncodeError(f'An error occurred while converting {Path(file).stem}')
+
+        concat(settings, file)
     else:
         CreateTempFolder(settings['tmp_folder'], settings['log_queue'])
+        # Index every frame once, so each chunk stage can seek to the exact frames of its chunk
+        settings['packet_index'] = BuildPacketIndex(file, settings)
+        # The index counts the actual frames, which is more reliable than the frame count stored in the container
+        settings['total_frames'] = len(LoadPacketIndex(settings['packet_index'])['pts'])
+        # Benchmark the intermediate formats on the first file, and keep the fastest that fits in the temporary folder for the rest of the run
+        if settings['intermediate_format'] == AUTO:
+            settings['intermediate_format'] = BenchmarkIntermediate(settings, file, LongestChunk(settings), logger)
+        # Raw AV1 streams have no timestamps, so variable frame rate files are joined by a concat list instead
+        settings['variable_frame_rate'] = IsVariableFrameRate(LoadPacketIndex(settings['packet_index']))
         # Create empty list for starting and joining processes
         processlist = []
 
@@ -80,14 +138,39 @@ def encoder(settings: dict, file: str) -> None:
         # Create process-safe int variable for storing the amount of calculated chunks
         chunk_range = Value('i', 0)
 
+        # Start a new stream in each queue, with the number of processes producing it
+        settings['chunk_calculate_queue'].reset(producers=1)
+        settings['chunk_generator_queue'].reset(producers=1 if settings['one_pass_segmenting'] else settings['chunk_threads'])
+        # In distributed mode, the coordinator sends the converted chunks in place of the chunk converters
+        settings['chunk_concat_queue'].reset(producers=1 if settings['distributed_mode'] == COORDINATOR else settings['chunk_threads'])
+
+        # Create a manager-backed model for each rendition, shared by all chunk converters, used to predict the starting CRF value of each chunk
+        manager = Manager()
+        settings['crf_priors'] = [CRFPrior(manager, settings['initial_crf_value']) for _ in settings['renditions']]
+
+        # Create the raw frame cache shared by all chunk converters, used if use_raw_frame_cache is enabled
+        settings['raw_cache'] = RawFrameCache(settings, Lock())
+
+        # Create the byte budget of the prepared and converted chunks, shared by all chunk processes
+        settings['temp_storage'] = TempStorage(settings['tmp_budget'] * 1024 * 1024, settings['keep_tmp_files'], settings['chunk_threads'])
+
+        # Create the count of running encodes shared by all chunk converters, so idle ones can lend their slot to speculative CRF candidates
+        settings['encoder_slots'] = EncoderSlots(settings['chunk_threads'])
+
         while not process_failure.is_set():
-            # If audio is detected, run separate thread that extracts the audio
+            # Run separate thread that appends the converted chunks to the output streams, as soon as they are done
+            StreamConcatThread = Thread(target=stream_concat,
+                                        args=(settings,
+                                              process_failure))
+            StreamConcatThread.start()
+
+            # If audio is detected, run separate thread that transcodes the audio, alongside the chunk processes
             if settings['detected_audio_stream']:
-                AudioExtractThread = Thread(target=ExtractAudio,
-                                            args=(settings,
-                                                  file,
-                                                  process_failure))
-                AudioExtractThread.start()
+                AudioTranscodeThread = Thread(target=TranscodeAudio,
+                                              args=(settings,
+                                                    file,
+                                                    process_failure))
+                AudioTranscodeThread.start()
 
             # Create, start and add chunk calculator process to process list
             chunk_calculate_process = Process(target=calculate,
@@ -98,48 +181,377 @@ def encoder(settings: dict, file: str) -> None:
             chunk_calculate_process.start()
             processlist.append(chunk_calculate_process)
 
-            # Create, start and add N chunk generator processes to the process list
-            for i in range(1, settings['chunk_threads'] + 1):
-                chunk_generator_process = Process(target=generate,
-                                                  args=(settings,
-                                                        file,
-                                                        chunk_range,
-                                                        process_failure,
-                                                        i))
-                chunk_generator_process.start()
-                processlist.append(chunk_generator_process)
-
-            # create, start and add N chunk converter processes to the process list
-            for i in range(1, settings['chunk_threads'] + 1):
-                chunk_converter_process = Process(target=convert,
-                                                  args=(settings,
-                                                        file,
-                                                        chunk_range,
-                                                        process_failure,
-                                                        i))
-                chunk_converter_process.start()
-                processlist.append(chunk_converter_process)
-
-            # Join and wait for all processes to finish
+            if settings['one_pass_segmenting']:
+                # Create, start and add a chunk segmenter process, which generates every chunk from a single decode, to the process list
+                chunk_segment_process = Process(target=segment,
+                                                args=(settings,
+                                                      file,
+                                                      chunk_range,
+                                                      process_failure))
+                chunk_segment_process.start()
+                processlist.append(chunk_segment_process)
+            else:
+                # Create, start and add N chunk generator processes to the process list
+                for i in range(1, settings['chunk_threads'] + 1):
+                    chunk_generator_process = Process(target=generate,
+                                                      args=(settings,
+                                                            file,
+                                                            chunk_range,
+                                                            process_failure,
+                                                            i))
+                    chunk_generator_process.start()
+                    processlist.append(chunk_generator_process)
+
+            if settings['distributed_mode'] == COORDINATOR:
+                # Run separate thread that hands the prepared chunks to the workers, and collects the converted chunks
+                CoordinatorThread = Thread(target=coordinate,
+                                           args=(settings,
+                                                 file,
+                                                 chunk_range,
+                                                 process_failure))
+                CoordinatorThread.start()
+            else:
+                # create, start and add N chunk converter processes to the process list
+                for i in range(1, settings['chunk_threads'] + 1):
+                    chunk_converter_process = Process(target=convert,
+                                                      args=(settings,
+                                                            file,
+                                                            chunk_range,
+                                                            process_failure,
+                                                            i))
+                    chunk_converter_process.start()
+                    processlist.append(chunk_converter_process)
+
+            # Wait for all processes to finish, or stop them if one of them failed
+            JoinProcesses(settings, processlist, process_failure)
+            if settings['distributed_mode'] == COORDINATOR:
+                CoordinatorThread.join()
+            manager.shutdown()
+            StreamConcatThread.join()
+            settings['temp_storage'].report(logger)
+            for queue in CHUNK_QUEUES:
+                settings[queue].report(logger)
+
+            # Wait for the audio transcoding to finish before combining the chunks and audio
+            if settings['detected_audio_stream'] and AudioTranscodeThread.is_alive():
+                logger.info('Waiting for audio transcoding to finish...')
+                AudioTranscodeThread.join()
+            break
+
+        if process_failure.is_set():
+            raise EncodeError(f'An error occurred while converting the chunks of {Path(file).stem}')
+
+        concat(settings, file)
+
+
+def JoinProcesses(settings: dict, processlist: list[Process], process_failure: Event) -> None:
+    """
+    Wait for the chunk processes of a file to finish.
+
+    Once one of them has failed, the others are stopped, as they could otherwise wait forever for chunks that never come.
+    A process stopped while it was using a queue can leave the queue locked, so the chunk queues are renewed for the next file.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings, including the chunk queues.
+        processlist (list[Process]): The chunk processes.
+        process_failure (Event): An event indicating if an error has occurred across a process.
+
+    Returns:
+        None
+    """
+    while any(p.is_alive() for p in processlist):
+        if process_failure.is_set():
             for p in processlist:
+                p.terminate()
                 p.join()
+            for queue in CHUNK_QUEUES:
+                settings[queue].renew()
+            return
+        sleep(0.5)
+    for p in processlist:
+        p.join()
 
-            # Wait for the audio extraction to finish before combining the chunks and audio
-            if AudioExtractThread.is_alive():
-                logger.info('Waiting for audio extraction to finish...')
-                AudioExtractThread.join()
-            break
-        else:
-            if process_failure.is_set():
-                logger.error('An error occurred during chunking. Exiting...')
-                os.kill(os.getpid(), signal.SIGINT)
 
-        concat(settings, file)
+def OutputPath(settings: dict, file: str, rendition: dict) -> Path:
+    """
+    Create the path of the output file of a rendition.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        file (str): The path to the input file.
+        rendition (dict): The rendition. Named renditions have their name added to the filename.
+
+    Returns:
+        Path: The path of the output file.
+    """
+    suffix = f'.{rendition["name"]}' if rendition['name'] else ''
+    return Path(settings['output_dir']) / f'{Path(file).stem}{suffix}.{settings["output_extension"]}'
+
+
+def PartialPath(output_file: Path) -> Path:
+    """
+    Create the path an output file is written to, before it is complete.
+
+    It is in the same folder, so the complete file can be renamed into place atomically.
+
+    Args:
+        output_file (Path): The path of the output file.
+
+    Returns:
+        Path: The path of the partial output file.
+    """
+    return output_file.with_name(f'{PARTIAL_PREFIX}{output_file.name}')
+
+
+def RemovePartials(settings: dict, file: str, logger: logging.Logger) -> None:
+    """
+    Remove the partial outputs of a file that an interrupted or failed run left in the output folder.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        file (str): The path to the input file.
+        logger (logging.Logger): The logger object used for logging messages.
+
+    Returns:
+        None
+    """
+    prefix = f'{PARTIAL_PREFIX}{Path(file).stem}.'
+    for partial_file in Path(settings['output_dir']).iterdir():
+        if partial_file.name.startswith(prefix):
+            logger.debug(f'Removing the partial output {partial_file.name}, left behind by an earlier run')
+            partial_file.unlink(missing_ok=True)
+
+
+def LayoutArgs(settings: dict, faststart: bool = False) -> list[str]:
+    """
+    Create the muxer arguments that place the index of an MP4 output at the start of the file, without writing the file twice.
+
+    By default, space for the index is reserved up front, based on the number of frames. With fragmented_output,
+    a fragmented MP4 is written instead, which never needs the index moved. +faststart, which rewrites the whole file
+    to move the index, is only used if asked for, as a fallback for when the reserved space turns out too small.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings, including the frame count and audio streams of the file,
+            and the frame count of the intro and outro.
+        faststart (bool): Move the index with +faststart instead of reserving space for it.
+
+    Returns:
+        list[str]: The FFmpeg output arguments. Empty for containers that aren't written by the MP4/MOV muxer.
+    """
+    if settings['output_extension'].lower() not in MOV_EXTENSIONS:
+        return []
+    if settings['fragmented_output']:
+        return ['-movflags', '+frag_keyframe+empty_moov+default_base_moof']
+    if faststart:
+        return ['-movflags', '+faststart']
+    duration = settings['total_frames'] / settings['fps']
+    audio_frames = int(duration * AAC_FRAMES_PER_SECOND) * len(settings['audio_streams']) if settings['detected_audio_stream'] else 0
+    # The intro and outro are part of the video stream, but not of the audio
+    video_frames = settings['total_frames'] + settings['segment_frames']
+    return ['-moov_size', str(video_frames * MOOV_BYTES_PER_VIDEO_FRAME + audio_frames * MOOV_BYTES_PER_AUDIO_FRAME + MOOV_OVERHEAD)]
+
+
+def StreamPath(settings: dict, r: int) -> Path:
+    """
+    Create the path of the stream a rendition's chunks are appended to.
+
+    This is a raw AV1 (OBU) stream, or for variable frame rate files, a concat list of the converted chunks, which keeps their timestamps.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        r (int): The rendition number.
+
+    Returns:
+        Path: The path of the stream.
+    """
+    return Path(settings['tmp_folder']) / f'video{r}.{"txt" if settings["variable_frame_rate"] else "obu"}'
+
+
+def stream_concat(settings: dict, process_failure: Event) -> None:
+    """
+    Appends the converted chunks of each rendition to a raw AV1 (OBU) stream, while the remaining chunks are still being converted.
+
+    Chunks are appended in order, as soon as every chunk before them is done, so most of the work
+    of combining the chunks overlaps with the encoding, and only a copy into the output container is left at the end.
+    For variable frame rate files, each chunk is added to a concat list instead, and kept until the output is written.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        process_failure (Event): An event indicating if an error has occurred across a process.
+
+    Returns:
+        None
+    """
+    logger = create_logger(settings['log_queue'], 'stream_concat')
+
+    # Converted chunks that are done, but still wait for an earlier chunk, and the next chunk to append, for each rendition
+    pending = [{} for _ in settings['renditions']]
+    next_chunk = [1 for _ in settings['renditions']]
+    # The number of frames appended so far, for each rendition, used to find the duration of the next chunk in a concat list
+    appended_frames = [0 for _ in settings['renditions']]
+
+    streams = [open(StreamPath(settings, r), 'wb') for r in range(len(settings['renditions']))]
+    try:
+        # The intro goes before the first chunk
+        for r, intro_stream in enumerate(settings['intro_streams']):
+            if not AppendSegment(settings, streams[r], intro_stream, logger):
+                process_failure.set()
+                return
+
+        # The stream ends once every chunk converter has finished, after they have sent all of their chunks
+        while not process_failure.is_set():
+            try:
+                item = settings['chunk_concat_queue'].get(timeout=1)
+            except Empty:
+                continue
+            if isinstance(item, EndOfStream):
+                break
+
+            for (r, i), converted_chunk in item.items():
+                pending[r][i] = converted_chunk
+                while next_chunk[r] in pending[r]:
+                    converted_chunk = pending[r].pop(next_chunk[r])
+                    if settings['variable_frame_rate']:
+                        frames = AppendConcatList(settings, streams[r], converted_chunk, appended_frames[r], logger)
+                        appended = frames is not None
+                        appended_frames[r] += frames or 0
+                    else:
+                        appended = AppendStream(settings, streams[r], converted_chunk, logger)
+                    if not appended:
+                        process_failure.set()
+                        return
+                    next_chunk[r] += 1
+                    if settings['variable_frame_rate']:
+                        # The concat list reads the chunk when the output is written, so it is only released from the budget
+                        settings['temp_storage'].release(converted_chunk)
+                    else:
+                        # The chunk is now part of the stream, so it no longer takes up space in the temporary folder
+                        settings['temp_storage'].remove(converted_chunk)
+                    settings['temp_storage'].advance(min(next_chunk) - 1)
+
+        for r in range(len(settings['renditions'])):
+            if pending[r]:
+                logger.error(f'Chunk {next_chunk[r]} is missing, so chunks {sorted(pending[r])} could not be appended')
+                process_failure.set()
+            elif settings['outro_streams'] and not process_failure.is_set():
+                # The outro goes after the last chunk
+                if not AppendSegment(settings, streams[r], settings['outro_streams'][r], logger):
+                    process_failure.set()
+    finally:
+        for stream in streams:
+            stream.close()
+
+
+def AppendStream(settings: dict, stream: BufferedWriter, video_file: Path, logger: logging.Logger) -> bool:
+    """
+    Appends the video of a converted file to an open raw AV1 (OBU) stream, by copying it.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        stream (BufferedWriter): The stream, opened for writing in binary mode.
+        video_file (Path): The path to the converted file.
+        logger (logging.Logger): The logger object used for logging messages.
+
+    Returns:
+        bool: True if the video was appended, False if FFmpeg failed.
+    """
+    arg = ['ffmpeg', '-nostdin', '-i', str(video_file), '-map', '0:v', '-c:v', 'copy', '-f', 'obu', '-']
+    logger.debug(f'Appending {Path(video_file).name} to {Path(stream.name).name}')
+    # Flush before FFmpeg starts writing to the same file descriptor
+    stream.flush()
+    if settings['ffmpeg_verbose_level'] == 0:
+        p = subprocess.Popen(arg, stdout=stream, stderr=subprocess.DEVNULL)
+    else:
+        arg[1:1] = settings['ffmpeg_print']
+        p = subprocess.Popen(arg, stdout=stream)
+    p.wait()
+
+    if p.returncode != 0:
+        logger.error(f'Error appending {Path(video_file).name} with command: {" ".join(str(item) for item in arg)}')
+        return False
+    return True
+
+
+def AppendConcatList(settings: dict, concat_list: BufferedWriter, video_file: Path, start_frame: int, logger: logging.Logger) -> int | None:
+    """
+    Adds a converted file to an open concat list, with the duration of its frames in the source, so its timestamps are kept.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings, including the path of the packet index.
+        concat_list (BufferedWriter): The concat list, opened for writing in binary mode.
+        video_file (Path): The path to the converted file.
+        start_frame (int): The frame of the source the converted file starts on.
+        logger (logging.Logger): The logger object used for logging messages.
+
+    Returns:
+        int | None: The number of frames in the converted file, or None if ffprobe couldn't count them.
+    """
+    # Count the packets, rather than trusting the container, as not every container stores the number of frames
+    arg = ['ffprobe', '-v', 'quiet', '-select_streams', 'v:0', '-count_packets', '-show_entries', 'stream=nb_read_packets', '-of', 'csv=p=0', str(video_file)]
+    p = subprocess.run(arg, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    if p.returncode != 0 or not p.stdout.strip().isnumeric():
+        logger.error(f'Could not count the frames of {Path(video_file).name} with command: {" ".join(str(item) for item in arg)}')
+        return None
+    frames = int(p.stdout.strip())
+
+    logger.debug(f'Adding {Path(video_file).name} to {Path(concat_list.name).name}')
+    entry = f"file '{ConcatListEscape(video_file)}'\n"
+    end_frame = start_frame + frames
+    # The last frame of the file has no next frame to take its duration from, so the concat demuxer keeps its own
+    if end_frame < settings['total_frames']:
+        index = LoadPacketIndex(settings['packet_index'])
+        entry += f'duration {float((index["pts"][end_frame] - index["pts"][start_frame]) * Fraction(index["time_base"])):.6f}\n'
+    concat_list.write(entry.encode())
+    return frames
+
+
+def ConcatListEscape(path: Path) -> str:
+    """
+    Escape a path for a file line in a concat list.
+
+    Args:
+        path (Path): The path to escape.
+
+    Returns:
+        str: The absolute path, with its single quotes escaped.
+    """
+    return Path(path).resolve().as_posix().replace("'", "'\\''")
+
+
+def AppendSegment(settings: dict, stream: BufferedWriter, cached_file: Path, logger: logging.Logger) -> bool:
+    """
+    Appends a cached intro or outro to an open stream.
+
+    Both are encoded with the same settings as the chunks, so they are joined to a raw AV1 (OBU) stream by copying their bytes.
+    For a concat list, they are first copied into a container with timestamps, in the temporary folder.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        stream (BufferedWriter): The stream, opened for writing in binary mode.
+        cached_file (Path): The path of the cached intro or outro.
+        logger (logging.Logger): The logger object used for logging messages.
+
+    Returns:
+        bool: True if the segment was appended, False if FFmpeg failed.
+    """
+    if not settings['variable_frame_rate']:
+        with open(cached_file, 'rb') as f:
+            copyfileobj(f, stream)
+        return True
+
+    segment_file = Path(settings['tmp_folder']) / f'{cached_file.stem}.mp4'
+    if not segment_file.exists():
+        arg = ['ffmpeg', '-nostdin', '-y', '-f', 'obu', '-framerate', str(settings['fps']), '-i', str(cached_file), '-c:v', 'copy', str(segment_file)]
+        if subprocess.run(arg, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+            logger.error(f'Error preparing {cached_file.name} for the concat list with command: {" ".join(str(item) for item in arg)}')
+            return False
+    stream.write(f"file '{ConcatListEscape(segment_file)}'\n".encode())
+    return True
 
 
 def concat(settings: dict, file: str) -> None:
     """
-    Concatenates video chunks into a single video file.
+    Combines the video stream of each rendition, and the audio, into a single video file per rendition.
 
     Args:
         settings (dict): A dictionary containing various settings for the concatenation process.
@@ -149,48 +561,57 @@ def concat(settings: dict, file: str) -> None:
         None
     """
     logger = create_logger(settings['log_queue'], 'concat')
+    RemovePartials(settings, file, logger)
 
-    # Create empty dictionary for storing the iter as key and filename as value, from queue
-    file_list = {}
-
-    logger.info('Getting the chunks from the queue...')
-    # As long as the queue is not empty, grab the next item in the queue
-    while not settings['chunk_concat_queue'].empty():
-        _file_list = settings['chunk_concat_queue'].get()
-        file_list.update(_file_list)
-        logger.debug(f'Added {_file_list} to file list')
-
-    logger.info('Creating file list...')
-    # Create a file that contains the list of files to concatenate
-    concat_file = open(Path(settings['tmp_folder']) / 'concatlist.txt', 'a')
-    for i in range(1, len(file_list) + 1):
-        concat_file.write(f"file '{file_list[i]}'\n")
-        logger.debug(f'Wrote {file_list[i]} to concatlist.txt')
-    concat_file.close()
-
-    if settings['detected_audio_stream']:
-        arg = ['ffmpeg', '-nostdin', '-safe', '0', '-f', 'concat', '-i', Path(settings['tmp_folder']) / 'concatlist.txt', '-i', Path(settings['tmp_folder']) / f'audio.{settings["audio_codec_name"]}', '-map', '0:v', '-map', '1:a', '-c:v', 'copy', '-c:a', 'aac', '-b:a', str(settings['audio_bitrate']), '-movflags', '+faststart', f'{Path(settings["output_dir"]) / Path(file).stem}.{settings["output_extension"]}']
-    else:
-        arg = ['ffmpeg', '-nostdin', '-safe', '0', '-f', 'concat', '-i', Path(settings['tmp_folder']) / 'concatlist.txt', '-c:v', 'copy', '-an', '-movflags', '+faststart', f'{Path(settings["output_dir"]) / Path(file).stem}.{settings["output_extension"]}']
+    for r, rendition in enumerate(settings['renditions']):
+        if settings['variable_frame_rate']:
+            video_input = ['-f', 'concat', '-safe', '0', '-i', StreamPath(settings, r)]
+        else:
+            # The raw stream has no timestamps, so the frame rate is given to the demuxer
+            video_input = ['-f', 'obu', '-framerate', str(settings['fps']), '-i', StreamPath(settings, r)]
+        # The audio of the file starts after the intro
+        audio_offset = ['-itsoffset', str(float(SegmentDuration(settings, settings['intro_streams'][r])))] if settings['intro_streams'] else []
+        output_file = OutputPath(settings, file, rendition)
+        # Write to a partial file first, so an interrupted output is never mistaken for a converted file
+        partial_file = PartialPath(output_file)
+        logger.info(f'Combining video into {output_file.name}...')
+
+        for faststart in (False, True):
+            # ffmpeg_print always contains -n, which can't be combined with -y, so what an earlier run or attempt left behind is removed instead
+            partial_file.unlink(missing_ok=True)
+            if settings['detected_audio_stream']:
+                # Both the video and the audio are already encoded, so they are only copied into the output container
+                arg = ['ffmpeg', '-nostdin'] + video_input + audio_offset + ['-i', AudioPath(settings), '-map', '0:v', '-map', '1:a', '-c', 'copy'] + LayoutArgs(settings, faststart) + [partial_file]
+            else:
+                arg = ['ffmpeg', '-nostdin'] + video_input + ['-c:v', 'copy', '-an'] + LayoutArgs(settings, faststart) + [partial_file]
 
-    logger.info('Combining chunks...')
+            try:
+                if settings['ffmpeg_verbose_level'] == 0:
+                    p = subprocess.Popen(arg, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+                else:
+                    arg[1:1] = settings['ffmpeg_print']
+                    p = subprocess.Popen(arg)
+                p.wait()
+            except KeyboardInterrupt:
+                p.terminate()
+                p.wait()
+                partial_file.unlink(missing_ok=True)
+                os.kill(os.getpid(), signal.SIGINT)
 
-    try:
-        if settings['ffmpeg_verbose_level'] == 0:
-            p = subprocess.Popen(arg, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
-        else:
-            arg[1:1] = settings['ffmpeg_print']
-            p = subprocess.Popen(arg)
-        p.wait()
-    except KeyboardInterrupt:
-        p.terminate()
-        os.kill(os.getpid(), signal.SIGINT)
+            if p.returncode == 0:
+                break
+            partial_file.unlink(missing_ok=True)
+            if '-moov_size' in arg:
+                logger.warning(f'Could not fit the index of {output_file.name} in the reserved space. Retrying with +faststart...')
+                continue
+            break
 
-    if p.returncode != 0:
-        logger.error(f'Error combining chunks with arguments: {arg}')
-        os.kill(os.getpid(), signal.SIGINT)
+        if p.returncode != 0:
+            raise EncodeError(f'Error combining video with arguments: {arg}')
+        else:
+            os.replace(partial_file, output_file)
 
-    logger.info('Chunks successfully combined!')
+    logger.info('Video successfully combined!')
     sleep(3)
 
 
@@ -1,5 +1,9 @@
+from fractions import Fraction
 from json import loads
 from pathlib import Path
+from statistics import median
+from func.cache import ReadCache, WriteCache
+from func.jobs import NeedsAttention
 from func.logger import create_logger
 from func.manager import ExceptionHandler
 import subprocess
@@ -8,108 +12,205 @@ import multiprocessing
 import os
 import signal
 
+# How many packets are read to estimate the frame rate, when the container doesn't store it
+FRAME_RATE_SAMPLE = 240
 
-def GetAudioMetadata(file: str, settings: dict) -> dict[str, int | str | bool]:
+
+def ProbeFile(file: str, settings: dict) -> dict:
+    """
+    Retrieves the streams and format of a file with a single ffprobe call.
+
+    The result is cached, keyed by the file's path, size and modification time,
+    so unchanged files are never probed again.
+
+    Args:
+        file (str): Path to the input file.
+        settings (dict): A dictionary containing the configuration settings.
+
+    Returns:
+        dict: The parsed ffprobe output, containing the 'streams' and 'format' keys.
+
+    Raises:
+        ValueError: If ffprobe could not read the file.
+    """
+    logger = create_logger(settings['log_queue'], 'probe')
+
+    probe = ReadCache(settings, file, 'probe')
+    if probe is not None:
+        logger.debug(f'Using cached metadata of {Path(file).name}')
+        return probe
+
+    arg = ['ffprobe', '-v', 'quiet', '-show_streams', '-show_format', '-of', 'json', file]
+    logger.debug(f'Running command: {" ".join(str(item) for item in arg)}')
+    p = subprocess.Popen(arg, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        raise ValueError(f'Could not read the metadata of {file}')
+
+    probe = loads(stdout)
+    WriteCache(settings, file, 'probe', probe)
+    return probe
+
+
+def GetAudioMetadata(file: str, settings: dict) -> dict[str, list | bool]:
     """
     Retrieves audio metadata from a given file.
 
     Args:
-        detect_audio_bitrate (bool): Flag indicating whether to detect audio bitrate.
         file (str): Path to the input file.
-        log_queue (Queue): Queue for logging messages.
+        settings (dict): A dictionary containing the configuration settings.
 
     Returns:
-        dict[str, int | str | bool]: Dictionary containing audio metadata settings.
+        dict[str, list | bool]: Dictionary containing audio metadata settings.
             - 'detected_audio_stream' (bool): Flag indicating whether an audio stream was detected.
-            - 'audio_codec_name' (str): Name of the audio codec.
-            - 'audio_bitrate' (int): Bitrate of the audio stream (if detect_audio_bitrate is True).
+            - 'audio_streams' (list[dict]): The codec name and bitrate of each audio stream. The bitrate is the one
+              detected in the stream if detect_audio_bitrate is True, and audio_bitrate otherwise.
 
     """
     handler = ExceptionHandler(settings['log_queue'], settings['manager_queue'])
     sys.excepthook = handler.handle_exception
     logger = create_logger(settings['log_queue'], 'audio_metadata')
 
-    audio_metadata_settings = {}
-    try:
-        arg = ['ffprobe', '-v', 'quiet', '-show_streams', '-select_streams', 'a:0', '-of', 'json', file]
-        logger.debug(f'Running command: {" ".join(str(item) for item in arg)}')
-        audio_stream = subprocess.Popen(arg, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        audio_stream.wait()
-        stdout, _ = audio_stream.communicate()
-        audio_metadata = loads(stdout)['streams'][0]
-    except IndexError:
-        audio_metadata_settings["detected_audio_stream"] = False
+    audio_metadata_settings = {'audio_streams': []}
+    audio_streams = [stream for stream in ProbeFile(file, settings).get('streams', []) if stream['codec_type'] == 'audio']
+    for audio_metadata in audio_streams:
+        bitrate = settings['audio_bitrate']
+        # Not every container stores the bitrate of its streams, so fall back to audio_bitrate if it's missing
+        if settings['detect_audio_bitrate'] and 'bit_rate' in audio_metadata:
+            bitrate = audio_metadata['bit_rate']
+        audio_metadata_settings['audio_streams'].append({'codec_name': audio_metadata['codec_name'], 'bitrate': bitrate})
+        logger.debug(f'Found audio stream: {audio_metadata["codec_name"]}, encoding with {bitrate} bitrate.')
+
+    audio_metadata_settings['detected_audio_stream'] = bool(audio_metadata_settings['audio_streams'])
+    if not audio_metadata_settings['detected_audio_stream']:
         logger.debug('No audio stream detected.')
-    else:
-        audio_metadata_settings["detected_audio_stream"] = True
-        audio_metadata_settings['audio_codec_name'] = audio_metadata['codec_name']
-        logger.debug(f'Found audio stream: {audio_metadata["codec_name"]}')
-        if settings['detect_audio_bitrate']:
-            audio_metadata_settings['audio_bitrate'] = audio_metadata['bit_rate']
-            logger.debug(f'Found audio stream: {audio_metadata["codec_name"]}, with {audio_metadata["bit_rate"]} bitrate.')
 
     return audio_metadata_settings
 
 
-def GetVideoMetadata(file: str, settings: dict) -> dict[str, int]:
+def GetVideoMetadata(file: str, settings: dict) -> dict[str, int | Fraction]:
     """
     Retrieves metadata of a video file.
 
     Args:
         file (str): The path to the video file.
-        log_queue (Queue): The queue used for logging.
+        settings (dict): A dictionary containing the configuration settings.
 
     Returns:
-        dict[str, int]: A dictionary containing the video metadata, including the total number of frames and the average frame rate.
+        dict[str, int | Fraction]: A dictionary containing the video metadata, including the total number of frames,
+            and the average frame rate as an exact fraction, e.g. 24000/1001 for NTSC film.
     """
     handler = ExceptionHandler(settings['log_queue'], settings['manager_queue'])
     sys.excepthook = handler.handle_exception
     logger = create_logger(settings['log_queue'], 'video_metadata')
     video_metadata_settings = {}
-    arg = ['ffprobe', '-v', 'quiet', '-show_streams', '-select_streams', 'v:0', '-of', 'json', file]
-    logger.debug(f'Running command: {" ".join(str(item) for item in arg)}')
-    video_stream = subprocess.Popen(arg, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    video_stream.wait()
-    stdout, stderr = video_stream.communicate()
     try:
-        video_metadata = loads(stdout)['streams'][0]
+        video_metadata = [stream for stream in ProbeFile(file, settings).get('streams', []) if stream['codec_type'] == 'video'][0]
     except IndexError as e:
         raise IndexError(f'No video stream detected in {file}. Error: {e}')
     else:
-        video_metadata_settings['total_frames'] = int(video_metadata['nb_frames'])
-        fps = '0'
-        try:
-            fps = video_metadata['avg_frame_rate'].split('/', 1)[0]
-            if not fps.isnumeric() or int(fps) <= 0:
-                raise KeyError  # Force manual input
-        except KeyError:
-            logger.warning('Could not detect the video stream\'s average frame rate.')
-            while not fps.isnumeric() or int(fps) <= 0:
-                fps = input('\nManual input required: ')
-        video_metadata_settings['fps'] = int(fps)
+        video_metadata_settings['total_frames'] = int(video_metadata.get('nb_frames', 0))
+        fps = FrameRate(video_metadata.get('avg_frame_rate')) or FrameRate(video_metadata.get('r_frame_rate'))
+        if fps is None:
+            logger.warning('Could not detect the video stream\'s average frame rate. Estimating it from the packet timestamps...')
+            fps = EstimateFrameRate(file, settings)
+        if fps is None:
+            # Without a person to ask, set the file aside, so the rest of the files can still be converted
+            if not settings['interactive']:
+                raise NeedsAttention(f'Could not detect or estimate the frame rate of {file}')
+            logger.warning('Could not estimate the frame rate. Enter it as a number or a fraction, e.g. 25 or 30000/1001.')
+            while fps is None:
+                fps = FrameRate(input('\nManual input required: '))
+        video_metadata_settings['fps'] = fps
         logger.debug(f'Found video stream: {video_metadata["codec_name"]}, with {video_metadata_settings["total_frames"]} frames at {video_metadata_settings["fps"]} fps.')
     return video_metadata_settings
 
 
-def ExtractAudio(settings: dict, file: str, process_failure: multiprocessing.Event) -> None:
+def FrameRate(frame_rate: str | None) -> Fraction | None:
+    """
+    Convert a frame rate reported by ffprobe, e.g. 30000/1001, to an exact fraction.
+
+    Args:
+        frame_rate (str | None): The frame rate, as a whole number, decimal or fraction.
+
+    Returns:
+        Fraction | None: The frame rate, or None if it is missing or not positive.
+    """
+    try:
+        fps = Fraction(frame_rate.strip())
+    except (AttributeError, ValueError, ZeroDivisionError):  # Missing, malformed, or 0/0 when unknown
+        return None
+    return fps if fps > 0 else None
+
+
+def EstimateFrameRate(file: str, settings: dict) -> Fraction | None:
     """
-    Extracts audio from a video file using FFmpeg.
+    Estimate the frame rate of a video file from the timestamps of the first packets of its video stream.
 
     Args:
-        settings (dict): A dictionary containing various settings for the audio extraction process.
-        file (str): The path to the video file from which audio needs to be extracted.
-        process_failure (multiprocessing.Event): Event to signal that an error occurred during the audio extraction process.
+        file (str): The path to the video file.
+        settings (dict): A dictionary containing the configuration settings.
+
+    Returns:
+        Fraction | None: The estimated frame rate, or None if the packets have no usable timestamps.
+    """
+    logger = create_logger(settings['log_queue'], 'video_metadata')
+    arg = ['ffprobe', '-v', 'quiet', '-select_streams', 'v:0', '-read_intervals', f'%+#{FRAME_RATE_SAMPLE}', '-show_entries', 'stream=time_base:packet=pts,dts', '-of', 'json', file]
+    logger.debug(f'Running command: {" ".join(str(item) for item in arg)}')
+    p = subprocess.Popen(arg, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, _ = p.communicate()
+    if p.returncode != 0:
+        return None
+    probe = loads(stdout)
+
+    timestamps = sorted(int(timestamp) for timestamp in (next((packet[key] for key in ('pts', 'dts') if packet.get(key, 'N/A') != 'N/A'), None) for packet in probe.get('packets', [])) if timestamp is not None)
+    # The most common distance between two frames is the frame duration, even with a few dropped or duplicated frames
+    durations = [b - a for a, b in zip(timestamps, timestamps[1:]) if b > a]
+    if not durations or not probe.get('streams'):
+        return None
+    fps = 1 / (Fraction(median(durations)) * Fraction(probe['streams'][0]['time_base']))
+    logger.debug(f'Estimated a frame rate of {fps} fps from {len(timestamps)} packets')
+    return fps
+
+
+def AudioPath(settings: dict) -> Path:
+    """
+    Create the path of the transcoded audio.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+
+    Returns:
+        Path: The path of the transcoded audio. Matroska is used, as it can hold any number of audio streams.
+    """
+    return Path(settings['tmp_folder']) / 'audio.mka'
+
+
+def TranscodeAudio(settings: dict, file: str, process_failure: multiprocessing.Event) -> None:
+    """
+    Transcodes every audio stream of a video file to AAC using FFmpeg, while the video chunks are being encoded.
+
+    Args:
+        settings (dict): A dictionary containing various settings for the audio transcoding process.
+        file (str): The path to the video file from which audio needs to be transcoded.
+        process_failure (multiprocessing.Event): Event to signal that an error occurred during the audio transcoding process.
 
     Returns:
         None
     """
-    # TODO: Add support for multiple audio streams. Maybe dynamically create the FFmpeg mapping for the audio streams?
     handler = ExceptionHandler(settings['log_queue'], settings['manager_queue'])
     sys.excepthook = handler.handle_exception
-    logger = create_logger(settings['log_queue'], 'audio_extractor')
-
-    arg = ['ffmpeg', '-nostdin', '-i', str(file), '-vn', '-c:a', 'copy', str(Path(settings['tmp_folder']) / f'audio.{settings["audio_codec_name"]}')]
-    logger.debug(f'Extracting audio with command: {" ".join(str(item) for item in arg)}')
+    logger = create_logger(settings['log_queue'], 'audio_transcoder')
+
+    # Map every audio stream, and give each its own bitrate
+    stream_args = ['-map', '0:a', '-c:a', 'aac']
+    for stream, audio_stream in enumerate(settings['audio_streams']):
+        stream_args += [f'-b:a:{stream}', str(audio_stream['bitrate'])]
+    # The AAC encoder is single threaded, so limit FFmpeg to a single thread, to only take one core from the chunk converters
+    # ffmpeg_print always contains -n, which can't be combined with -y, so audio left behind by an earlier file is removed instead
+    AudioPath(settings).unlink(missing_ok=True)
+    arg = ['ffmpeg', '-nostdin', '-threads', '1', '-i', str(file), '-vn'] + stream_args + ['-threads', '1', str(AudioPath(settings))]
+    logger.debug(f'Transcoding audio with command: {" ".join(str(item) for item in arg)}')
     try:
         if settings['ffmpeg_verbose_level'] == 0:
             p = subprocess.Popen(arg, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
@@ -121,11 +222,11 @@ def ExtractAudio(settings: dict, file: str, process_failure: multiprocessing.Eve
         p.terminate()
         os.kill(os.getpid(), signal.SIGINT)
 
-    if not Path(Path(settings['tmp_folder']) / f'audio.{settings["audio_codec_name"]}').exists():
+    if p.returncode != 0 or not AudioPath(settings).exists():
         process_failure.set()
-        raise FileNotFoundError(f'Could not find audio file. Did audio extraction fail for {file}?')
+        raise FileNotFoundError(f'Could not find audio file. Did audio transcoding fail for {file}?')
 
-    logger.info(f'Extracted audio from {file}.')
+    logger.info(f'Transcoded {len(settings["audio_streams"])} audio stream(s) from {file}.')
     return
 
 
@@ -0,0 +1,137 @@
+from bisect import bisect_right
+from fractions import Fraction
+from functools import lru_cache
+from math import floor
+from json import dumps, loads
+from pathlib import Path
+import subprocess
+import os
+
+from func.cache import ReadCache, WriteCache
+from func.logger import create_logger
+
+
+def BuildPacketIndex(file: str, settings: dict) -> Path:
+    """
+    Build an index of every packet in the first video stream of a file, and store it in the temporary folder.
+
+    The index holds the presentation timestamp, byte offset and keyframe flag of every frame, in presentation order,
+    which lets every chunk stage seek to an exact frame, starting the decode at the closest preceding keyframe.
+    It is also cached, so the file only has to be read once as long as it is unchanged.
+
+    Args:
+        file (str): The path to the video file.
+        settings (dict): A dictionary containing the configuration settings.
+
+    Returns:
+        Path: The path of the stored index.
+
+    Raises:
+        ValueError: If ffprobe could not read the packets of the file.
+    """
+    logger = create_logger(settings['log_queue'], 'packet_index')
+
+    index = ReadCache(settings, file, 'index')
+    if index is not None:
+        logger.debug(f'Using cached packet index of {Path(file).name}')
+    else:
+        logger.info(f'Indexing the packets of {Path(file).name}...')
+        arg = ['ffprobe', '-v', 'quiet', '-select_streams', 'v:0', '-show_entries', 'stream=time_base:format=start_time:packet=pts,dts,pos,flags', '-of', 'json', file]
+        logger.debug(f'Running command: {" ".join(str(item) for item in arg)}')
+        p = subprocess.Popen(arg, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, _ = p.communicate()
+        if p.returncode != 0:
+            raise ValueError(f'Could not index the packets of {file}')
+        probe = loads(stdout)
+
+        # Packets are listed in decode order, so sort them by their presentation timestamp.
+        # Packets without a presentation timestamp fall back to their decode timestamp, and are skipped if neither is known.
+        packets = []
+        for packet in probe['packets']:
+            timestamp = next((packet[key] for key in ('pts', 'dts') if packet.get(key, 'N/A') != 'N/A'), None)
+            if timestamp is not None:
+                packets.append((int(timestamp), int(packet.get('pos', -1)), 'K' in packet.get('flags', '')))
+        packets.sort()
+        index = {'time_base': probe['streams'][0]['time_base'],
+                 # The format start time is stored in whole microseconds, which is also what FFmpeg uses when seeking
+                 'start_time': round(float(probe.get('format', {}).get('start_time', 0)) * 1000000),
+                 'pts': [pts for pts, _, _ in packets],
+                 'pos': [pos for _, pos, _ in packets],
+                 'keyframes': [frame for frame, (_, _, keyframe) in enumerate(packets) if keyframe]}
+        WriteCache(settings, file, 'index', index)
+        logger.debug(f'Indexed {len(index["pts"])} frames and {len(index["keyframes"])} keyframes')
+
+    index_file = Path(settings['tmp_folder']) / 'index.json'
+    with open(index_file, 'w') as f:
+        f.write(dumps(index))
+    return index_file
+
+
+def LoadPacketIndex(index_file: str) -> dict:
+    """
+    Load a packet index stored by BuildPacketIndex.
+
+    The index is only read once per process, unless the file changes.
+
+    Args:
+        index_file (str): The path of the stored index.
+
+    Returns:
+        dict: The packet index.
+    """
+    return _LoadPacketIndex(str(index_file), os.stat(index_file).st_mtime_ns)
+
+
+@lru_cache(maxsize=1)
+def _LoadPacketIndex(index_file: str, mtime_ns: int) -> dict:
+    with open(index_file) as f:
+        return loads(f.read())
+
+
+def IsVariableFrameRate(index: dict) -> bool:
+    """
+    Check if the frames in a packet index are spaced unevenly.
+
+    Differences of a single tick are ignored, as they come from rounding constant frame rates to the time base, e.g. 29.97 fps in milliseconds.
+
+    Args:
+        index (dict): The packet index.
+
+    Returns:
+        bool: True if the frame durations vary by more than a tick.
+    """
+    durations = [next_pts - pts for pts, next_pts in zip(index['pts'], index['pts'][1:])]
+    return bool(durations) and max(durations) - min(durations) > 1
+
+
+def SeekArgs(settings: dict, start_frame: int, end_frame: int) -> tuple[list[str], str, list[str]]:
+    """
+    Create the FFmpeg arguments needed to decode the exact frames of a chunk.
+
+    The input is seeked to the exact timestamp of the closest keyframe at or before start_frame, so no frames
+    before it have to be decoded, and the remaining frames are cut by their number with the trim filter,
+    which avoids rounding the start and end of the chunk to a timestamp.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings, including the path of the packet index.
+        start_frame (int): The first frame of the chunk.
+        end_frame (int): The frame after the last frame of the chunk.
+
+    Returns:
+        tuple[list[str], str, list[str]]: The arguments to place before the input, the filters to place
+            at the start of the input's filter chain, and the arguments to place before the output.
+    """
+    index = LoadPacketIndex(settings['packet_index'])
+    keyframes = index['keyframes'] or [0]
+    keyframe = keyframes[max(bisect_right(keyframes, start_frame) - 1, 0)]
+    # Floor the keyframe's timestamp to whole microseconds, so the seek never lands after the keyframe
+    seek_time = Fraction(index['pts'][keyframe]) * Fraction(index['time_base']) * 1000000 - index['start_time']
+    seek_time = max(floor(seek_time), 0)
+    input_args = ['-ss', f'{seek_time // 1000000}.{seek_time % 1000000:06d}']
+    filters = f'trim=start_frame={start_frame - keyframe}:end_frame={end_frame - keyframe},setpts=PTS-STARTPTS'
+    output_args = ['-frames:v', str(end_frame - start_frame)]
+    return input_args, filters, output_args
+
+
+if __name__ == '__main__':
+    print('This file should not be run as a standalone script!')
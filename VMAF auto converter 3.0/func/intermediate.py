@@ -0,0 +1,117 @@
+from fractions import Fraction
+from pathlib import Path
+from shutil import disk_usage
+from time import perf_counter
+import logging
+import subprocess
+
+# The lossless formats prepared chunks can be written in: the FFmpeg codec arguments, and the container extension.
+# Prepared chunks are written once, and decoded by every attempt and VMAF comparison of the chunk.
+INTERMEDIATE_FORMATS = {
+    # Small, but decoding is comparatively slow
+    'x264': (['-c:v', 'libx264', '-preset', 'ultrafast', '-qp', '0'], 'mp4'),
+    # Intra-only, with slices that are encoded and decoded in parallel
+    'ffv1': (['-c:v', 'ffv1', '-level', '3', '-g', '1', '-slices', '16', '-slicecrc', '0'], 'mkv'),
+    # Nothing to encode or decode, but by far the largest. Best with the temporary folder on a tmpfs
+    'raw': (['-c:v', 'rawvideo'], 'nut'),
+}
+# Picks the fastest of the intermediate formats with a benchmark, before the first chunked file is converted
+AUTO = 'auto'
+# How many seconds of the source the benchmark prepares and decodes with each format
+BENCHMARK_LENGTH = 2
+
+
+def IntermediateArgs(settings: dict) -> list[str]:
+    """
+    Get the FFmpeg codec arguments that prepared chunks are written with.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+
+    Returns:
+        list[str]: The codec arguments of the intermediate format.
+    """
+    return INTERMEDIATE_FORMATS[settings['intermediate_format']][0]
+
+
+def IntermediateExtension(settings: dict) -> str:
+    """
+    Get the container extension of prepared chunks.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+
+    Returns:
+        str: The extension of the intermediate format, without a dot.
+    """
+    return INTERMEDIATE_FORMATS[settings['intermediate_format']][1]
+
+
+def BenchmarkIntermediate(settings: dict, file: str, chunk_frames: int, logger: logging.Logger) -> str:
+    """
+    Pick the intermediate format that is fastest on this machine and temporary folder, out of the ones that fit in it.
+
+    The start of the source is prepared once in each format, and then decoded once per expected read,
+    i.e. an encode and a VMAF comparison for each attempt, as prepared chunks are written once and read many times.
+    The size of each benchmark file gives the bytes per frame of the format, and a format is skipped if the prepared chunks
+    of every chunk thread, in every rendition, would not fit in the temporary folder budget, or the free space of the temporary folder.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings, including the output resolution.
+        file (str): The path to the input video file, used as the benchmark source.
+        chunk_frames (int): The number of frames in the longest chunk.
+        logger (logging.Logger): The logger object used for logging messages.
+
+    Returns:
+        str: The name of the fastest intermediate format that fits. The smallest one if none of them fit, and x264 if none of them could be benchmarked.
+    """
+    reads = settings['max_attempts'] * 2
+    benchmark_frames = min(round(BENCHMARK_LENGTH * Fraction(settings['fps'])), settings['total_frames'])
+    # The benchmark is prepared at the output resolution, and each rendition is prepared at its own
+    rendition_scale = sum(rendition['output_width'] * rendition['output_height'] for rendition in settings['renditions']) / (settings['output_width'] * settings['output_height'])
+    timings = {}
+    chunk_sizes = {}  # The projected size of the prepared chunks of every chunk thread, by format
+    for name, (codec_args, extension) in INTERMEDIATE_FORMATS.items():
+        benchmark_file = Path(settings['tmp_folder']) / f'benchmark.{extension}'
+        prepare = ['ffmpeg', '-nostdin', '-y', '-t', str(BENCHMARK_LENGTH), '-i', str(file), '-vf', f'scale={settings["output_width"]}:{settings["output_height"]}', '-an'] + codec_args + [str(benchmark_file)]
+        decode = ['ffmpeg', '-nostdin', '-i', str(benchmark_file), '-f', 'null', '-']
+        try:
+            start = perf_counter()
+            if subprocess.run(prepare, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL).returncode != 0:
+                logger.debug(f'Could not benchmark the {name} intermediate format')
+                continue
+            prepared = perf_counter()
+            for _ in range(reads):
+                subprocess.run(decode, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=True)
+            timings[name] = perf_counter() - start
+            bytes_per_frame = benchmark_file.stat().st_size / max(benchmark_frames, 1)
+            chunk_sizes[name] = bytes_per_frame * chunk_frames * rendition_scale * settings['chunk_threads']
+            logger.debug(f'{name} intermediate format: prepared in {round(prepared - start, 2)} seconds, decoded {reads} times in {round(timings[name] - (prepared - start), 2)} seconds, '
+                         f'{round(bytes_per_frame)} bytes per frame')
+        except subprocess.CalledProcessError:
+            logger.debug(f'Could not decode the {name} intermediate format')
+        finally:
+            benchmark_file.unlink(missing_ok=True)
+
+    if not timings:
+        logger.warning('Could not benchmark any intermediate format. Using x264')
+        return 'x264'
+
+    space = disk_usage(settings['tmp_folder']).free
+    if settings['tmp_budget']:
+        space = min(space, settings['tmp_budget'] * 1024 * 1024)
+    fitting = [name for name in timings if chunk_sizes[name] <= space]
+    for name in timings:
+        if name not in fitting:
+            logger.debug(f'Skipping the {name} intermediate format, as the prepared chunks would take {round(chunk_sizes[name] / 1024 / 1024)} MB of {round(space / 1024 / 1024)} MB')
+    if not fitting:
+        smallest = min(chunk_sizes, key=chunk_sizes.get)
+        logger.warning(f'None of the intermediate formats fit in the temporary folder. Using the smallest, {smallest}')
+        return smallest
+    fastest = min(fitting, key=timings.get)
+    logger.info(f'Using the {fastest} intermediate format for prepared chunks, the fastest on this machine that fits in the temporary folder')
+    return fastest
+
+
+if __name__ == '__main__':
+    print('This file should not be run as a standalone script!')
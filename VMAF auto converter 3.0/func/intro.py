@@ -0,0 +1,129 @@
+from fractions import Fraction
+from hashlib import sha1, sha256
+from pathlib import Path
+import logging
+import subprocess
+import os
+
+from func.cache import SEGMENTS_FOLDER, CacheKey
+
+# The content hash of each intro and outro, by the cache key of the file, so each is only read once per run
+segment_hashes = {}
+
+
+def SegmentPath(settings: dict, segment_file: str, rendition: dict) -> Path:
+    """
+    Create the path of the cached AV1 stream of an intro or outro.
+
+    The path is unique to the content of the segment, and every setting that changes how it is encoded,
+    so the segment is only encoded again if one of them changes, no matter how many files it is attached to.
+    The content is only hashed again if the file is moved, resized or modified.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings, including the frame rate of the file.
+        segment_file (str): The path to the intro or outro.
+        rendition (dict): The rendition the segment is attached to.
+
+    Returns:
+        Path: The path of the cached stream, in the cache folder.
+    """
+    file_key = CacheKey(segment_file)
+    if file_key not in segment_hashes:
+        with open(segment_file, 'rb') as f:
+            file_hash = sha256()
+            while block := f.read(1024 * 1024):
+                file_hash.update(block)
+        segment_hashes[file_key] = file_hash.hexdigest()
+    key = '|'.join(str(item) for item in (segment_hashes[file_key], rendition['output_width'], rendition['output_height'], settings['pixel_format'],
+                                          settings['av1_preset'], settings['keyframe_interval'], settings['tune_mode'], settings['initial_crf_value'], settings['fps']))
+    return Path(settings['cache_dir']) / SEGMENTS_FOLDER / f'{sha1(key.encode()).hexdigest()}.obu'
+
+
+def CachedSegment(settings: dict, segment_file: str, rendition: dict, logger: logging.Logger) -> Path:
+    """
+    Get the AV1 stream of an intro or outro for a rendition, encoding it first if it isn't cached.
+
+    The stream is encoded with the same encoder settings, resolution and frame rate as the chunks,
+    so it can be joined to the stream of appended chunks by copying it.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings, including the frame rate of the file.
+        segment_file (str): The path to the intro or outro.
+        rendition (dict): The rendition the segment is attached to.
+        logger (logging.Logger): The logger object used for logging messages.
+
+    Returns:
+        Path: The path of the cached stream.
+
+    Raises:
+        ValueError: If FFmpeg failed to encode the segment.
+    """
+    cached_file = SegmentPath(settings, segment_file, rendition)
+    if cached_file.exists():
+        # Mark the segment as recently used, so it is the last to be pruned
+        os.utime(cached_file)
+        logger.debug(f'Using cached {Path(segment_file).name} for {rendition["output_width"]}x{rendition["output_height"]}')
+        return cached_file
+
+    logger.info(f'Encoding {Path(segment_file).name} for {rendition["output_width"]}x{rendition["output_height"]}...')
+    cached_file.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file first and then rename it, so other processes never read a partially written stream
+    tmp_file = cached_file.with_suffix(f'.{os.getpid()}.tmp')
+    # Without -y, which can't be combined with the -n in ffmpeg_print, so a file a crashed run with the same process id left behind is removed
+    tmp_file.unlink(missing_ok=True)
+    arg = ['ffmpeg', '-nostdin', '-i', str(segment_file), '-vf', f'scale={rendition["output_width"]}:{rendition["output_height"]},fps={settings["fps"]}', '-an',
+           '-c:v', 'libsvtav1', '-crf', str(settings['initial_crf_value']), '-b:v', '0', '-g', str(settings['keyframe_interval']), '-preset', str(settings['av1_preset']),
+           '-pix_fmt', settings['pixel_format'], '-svtav1-params', f'tune={str(settings["tune_mode"])}', '-f', 'obu', str(tmp_file)]
+    if settings['ffmpeg_verbose_level'] == 0:
+        p = subprocess.Popen(arg, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    else:
+        arg[1:1] = settings['ffmpeg_print']
+        p = subprocess.Popen(arg)
+    p.wait()
+    if p.returncode != 0:
+        tmp_file.unlink(missing_ok=True)
+        raise ValueError(f'Could not encode {segment_file} with command: {" ".join(str(item) for item in arg)}')
+    os.replace(tmp_file, cached_file)
+    return cached_file
+
+
+def SegmentFrames(cached_file: Path) -> int:
+    """
+    Count the frames of a cached intro or outro.
+
+    Args:
+        cached_file (Path): The path of the cached stream.
+
+    Returns:
+        int: The number of frames.
+
+    Raises:
+        ValueError: If ffprobe could not read the stream.
+    """
+    # Each packet of a raw AV1 stream is one frame
+    arg = ['ffprobe', '-v', 'quiet', '-f', 'obu', '-select_streams', 'v:0', '-count_packets', '-show_entries', 'stream=nb_read_packets', '-of', 'csv=p=0', str(cached_file)]
+    p = subprocess.run(arg, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    if p.returncode != 0 or not p.stdout.strip().isnumeric():
+        raise ValueError(f'Could not count the frames of {cached_file}')
+    return int(p.stdout.strip())
+
+
+def SegmentDuration(settings: dict, cached_file: Path) -> Fraction:
+    """
+    Get the duration of a cached intro or outro, from its number of frames.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings, including the frame rate of the file.
+        cached_file (Path): The path of the cached stream.
+
+    Returns:
+        Fraction: The duration, in seconds.
+
+    Raises:
+        ValueError: If ffprobe could not read the stream.
+    """
+    return SegmentFrames(cached_file) / Fraction(settings['fps'])
+
+
+if __name__ == '__main__':
+    print('This file should not be run as a standalone script!')
@@ -0,0 +1,170 @@
+from json import dumps, loads
+from pathlib import Path
+from time import time
+import sqlite3
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+ATTENTION = 'attention'
+
+
+class NeedsAttention(Exception):
+    """Raised when a file can't be converted without a person looking at it, e.g. when its frame rate is unknown in non-interactive mode."""
+
+
+class JobQueue:
+    """
+    Persistent queue of the files to convert, stored in an SQLite database.
+
+    Each file is a job with a priority, a state, the number of times it has been started, and the result of its conversion.
+    Jobs are handed out by priority, and then in the order they were added. Since the state survives a restart,
+    finished and permanently failed files are skipped by a single lookup, and a file that was being converted
+    when the script stopped is picked up again, until it has been started max_attempts times.
+
+    Args:
+        path (str): The path to the database. It is created if it doesn't exist.
+        max_attempts (int): How many times a file can be started, before it is marked as failed.
+    """
+
+    def __init__(self, path: str, max_attempts: int):
+        self.connection = sqlite3.connect(path)
+        self.max_attempts = max_attempts
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                                    'path TEXT PRIMARY KEY, '
+                                    'priority INTEGER NOT NULL, '
+                                    'state TEXT NOT NULL, '
+                                    'attempts INTEGER NOT NULL DEFAULT 0, '
+                                    'added REAL NOT NULL, '
+                                    'started REAL, '
+                                    'finished REAL, '
+                                    'result TEXT)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS pending_jobs ON jobs (state, priority, added)')
+
+    def recover(self) -> int:
+        """
+        Returns the jobs that were running when the script last stopped to the queue,
+        or marks them as failed if they have used all of their attempts.
+
+        Returns:
+            int: The number of jobs that were running.
+        """
+        with self.connection:
+            self.connection.execute('UPDATE jobs SET state = ?, finished = ? WHERE state = ? AND attempts >= ?', (FAILED, time(), RUNNING, self.max_attempts))
+            cursor = self.connection.execute('UPDATE jobs SET state = ? WHERE state = ?', (PENDING, RUNNING))
+        return cursor.rowcount
+
+    def state(self, file: Path) -> str | None:
+        """
+        Get the state of a file's job.
+
+        Args:
+            file (Path): The path to the file.
+
+        Returns:
+            str | None: The state of the job, or None if the file has never been added.
+        """
+        row = self.connection.execute('SELECT state FROM jobs WHERE path = ?', (str(file),)).fetchone()
+        return row[0] if row else None
+
+    def add(self, file: Path, priority: int, state: str = PENDING) -> bool:
+        """
+        Add a file to the queue, unless it has already been added.
+
+        Args:
+            file (Path): The path to the file.
+            priority (int): The priority of the file. Lower is converted first.
+            state (str): The state of the new job, e.g. DONE for files that were converted before the queue existed.
+
+        Returns:
+            bool: True if the file was added, False if it was already known.
+        """
+        with self.connection:
+            cursor = self.connection.execute('INSERT OR IGNORE INTO jobs (path, priority, state, added) VALUES (?, ?, ?, ?)', (str(file), priority, state, time()))
+        return cursor.rowcount > 0
+
+    def next(self) -> Path | None:
+        """
+        Take the pending job with the highest priority, and mark it as running.
+
+        Returns:
+            Path | None: The path to the file, or None if no jobs are pending.
+        """
+        with self.connection:
+            row = self.connection.execute('SELECT path FROM jobs WHERE state = ? ORDER BY priority, added LIMIT 1', (PENDING,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute('UPDATE jobs SET state = ?, attempts = attempts + 1, started = ? WHERE path = ?', (RUNNING, time(), row[0]))
+        return Path(row[0])
+
+    def finish(self, file: Path, result: dict) -> None:
+        """
+        Mark a job as done.
+
+        Args:
+            file (Path): The path to the file.
+            result (dict): The result of the conversion, stored as JSON.
+
+        Returns:
+            None
+        """
+        with self.connection:
+            self.connection.execute('UPDATE jobs SET state = ?, finished = ?, result = ? WHERE path = ?', (DONE, time(), dumps(result), str(file)))
+
+    def fail(self, file: Path, error: str) -> str:
+        """
+        Return a failed job to the queue, or mark it as failed if it has used all of its attempts.
+
+        Args:
+            file (Path): The path to the file.
+            error (str): A description of the error, stored as the result.
+
+        Returns:
+            str: The new state of the job.
+        """
+        with self.connection:
+            attempts = self.connection.execute('SELECT attempts FROM jobs WHERE path = ?', (str(file),)).fetchone()[0]
+            state = FAILED if attempts >= self.max_attempts else PENDING
+            self.connection.execute('UPDATE jobs SET state = ?, finished = ?, result = ? WHERE path = ?', (state, time(), dumps({'error': error}), str(file)))
+        return state
+
+    def defer(self, file: Path, reason: str) -> None:
+        """
+        Set a job aside for a person to look at, instead of retrying it.
+
+        Args:
+            file (Path): The path to the file.
+            reason (str): Why the file needs attention, stored as the result.
+
+        Returns:
+            None
+        """
+        with self.connection:
+            self.connection.execute('UPDATE jobs SET state = ?, finished = ?, result = ? WHERE path = ?', (ATTENTION, time(), dumps({'error': reason}), str(file)))
+
+    def needing_attention(self) -> list[tuple[Path, str]]:
+        """
+        List the jobs that have been set aside.
+
+        Returns:
+            list[tuple[Path, str]]: The path to each file, and why it needs attention.
+        """
+        return [(Path(path), loads(result)['error']) for path, result in self.connection.execute('SELECT path, result FROM jobs WHERE state = ? ORDER BY finished', (ATTENTION,))]
+
+    def counts(self) -> dict[str, int]:
+        """
+        Count the jobs in each state.
+
+        Returns:
+            dict[str, int]: The number of jobs, by state.
+        """
+        return dict(self.connection.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    print('This file should not be run as a standalone script!')
@@ -1,24 +1,141 @@
 import multiprocessing
+from queue import Empty
+from time import monotonic
 from func.logger import create_logger
 import traceback
 from types import TracebackType
 from typing import Type
 
 
+class EndOfStream:
+    """Marker sent through a NamedQueue once every producer of the queue has finished."""
+
+
 class NamedQueue:
-    """A wrapper for the multiprocessing.Queue class that adds a name attribute to the queue."""
-    def __init__(self, name):
-        self.queue = multiprocessing.Queue()
+    """
+    A wrapper for the multiprocessing.Queue class that adds a name attribute, an optional capacity,
+    statistics and an end-of-stream protocol to the queue.
+
+    Producers call finish() when they are done, and once the last one has, an EndOfStream marker is sent.
+    Consumers iterating over the queue stop at the marker, and pass it on to the next consumer.
+
+    Args:
+        name (str): The name of the queue.
+        maxsize (int): The capacity of the queue. Producers block when it is full. 0 = unbounded.
+    """
+    def __init__(self, name, maxsize=0):
+        self.queue = multiprocessing.Queue(maxsize)
         self.name = name
+        self.maxsize = maxsize
+        self.producers = multiprocessing.Value('i', 0)
+        # Shared statistics, updated by every process using the queue
+        self.started = multiprocessing.Value('d', 0)
+        self.put_count = multiprocessing.Value('q', 0)
+        self.get_count = multiprocessing.Value('q', 0)
+        self.put_wait = multiprocessing.Value('d', 0)
+        self.get_wait = multiprocessing.Value('d', 0)
+        self.max_depth = multiprocessing.Value('i', 0)
 
     def put(self, item):
+        start = monotonic()
         self.queue.put(item)
+        with self.put_count.get_lock():
+            self.put_count.value += 1
+            self.put_wait.value += monotonic() - start
+            if not self.started.value:
+                self.started.value = start
+        self.record_depth()
 
     def put_nowait(self, item):
         self.queue.put_nowait(item)
 
-    def get(self, block=True):
-        return self.queue.get(block=block)
+    def get(self, block=True, timeout=None):
+        start = monotonic()
+        item = self.queue.get(block=block, timeout=timeout)
+        with self.get_count.get_lock():
+            self.get_count.value += 1
+            self.get_wait.value += monotonic() - start
+        return item
+
+    def __iter__(self):
+        """Yields items until the end of the stream, which is passed on to the next consumer."""
+        while True:
+            item = self.get(block=True)
+            if isinstance(item, EndOfStream):
+                self.queue.put(item)
+                return
+            yield item
+
+    def reset(self, producers):
+        """
+        Prepares the queue for a new stream, by discarding any remaining items and statistics.
+
+        Args:
+            producers (int): The number of producers that have to finish before the stream ends.
+        """
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                break
+        self.producers.value = producers
+        for value in (self.started, self.put_count, self.get_count, self.put_wait, self.get_wait, self.max_depth):
+            value.value = 0
+
+    def renew(self):
+        """
+        Replaces the underlying queue with an empty one, discarding any remaining items.
+
+        A process that is terminated while it is using the queue can leave it locked, which reset can't recover from.
+        Only processes started after this use the new queue.
+        """
+        self.queue.cancel_join_thread()
+        self.queue.close()
+        self.queue = multiprocessing.Queue(self.maxsize)
+
+    def finish(self):
+        """Tells the queue a producer is done, and ends the stream if it was the last one."""
+        with self.producers.get_lock():
+            self.producers.value -= 1
+            last_producer = self.producers.value == 0
+        if last_producer:
+            self.queue.put(EndOfStream())
+
+    def record_depth(self):
+        try:
+            depth = self.queue.qsize()
+        except NotImplementedError:  # Not available on macOS
+            return
+        with self.max_depth.get_lock():
+            self.max_depth.value = max(self.max_depth.value, depth)
+
+    def stats(self):
+        """
+        Returns the statistics of the queue.
+
+        Returns:
+            dict[str, int | float]: The number of items put and taken, the maximum depth, the total time
+                producers and consumers spent waiting, and the throughput in items per second.
+        """
+        elapsed = monotonic() - self.started.value if self.started.value else 0
+        return {'put': self.put_count.value,
+                'get': self.get_count.value,
+                'max_depth': self.max_depth.value,
+                'put_wait': round(self.put_wait.value, 2),
+                'get_wait': round(self.get_wait.value, 2),
+                'throughput': round(self.put_count.value / elapsed, 2) if elapsed else 0}
+
+    def report(self, logger):
+        """
+        Logs the statistics of the queue.
+
+        Args:
+            logger (logging.Logger): The logger object used for logging messages.
+        """
+        stats = self.stats()
+        capacity = self.maxsize if self.maxsize else 'unbounded'
+        logger.info(f'{self.name}: {stats["put"]} items at {stats["throughput"]} items/s, max depth {stats["max_depth"]} of {capacity}, '
+                    f'producers waited {stats["put_wait"]} s, consumers waited {stats["get_wait"]} s')
 
     def join_thread(self):
         self.queue.join_thread()
@@ -30,6 +147,46 @@ class NamedQueue:
         return self.queue.empty()
 
 
+class EncoderSlots:
+    """
+    Counts how many encodes are running across the chunk converters, out of one per chunk thread.
+
+    Each converter holds a slot while it works on a chunk. Slots left over, e.g. near the end of a file,
+    or with more chunk threads than chunks, can be borrowed to encode speculative CRF candidates.
+
+    Args:
+        slots (int): The number of slots, normally the number of chunk threads.
+    """
+    def __init__(self, slots):
+        self.slots = slots
+        self.used = multiprocessing.Value('i', 0)
+
+    def hold(self):
+        """Takes the slot of a converter starting on a chunk, which is always granted."""
+        with self.used.get_lock():
+            self.used.value += 1
+
+    def borrow(self, count):
+        """
+        Takes up to count of the spare slots, without waiting.
+
+        Args:
+            count (int): The number of slots wanted.
+
+        Returns:
+            int: The number of slots taken, which must be given back with release.
+        """
+        with self.used.get_lock():
+            borrowed = max(min(count, self.slots - self.used.value), 0)
+            self.used.value += borrowed
+        return borrowed
+
+    def release(self, count=1):
+        """Gives back slots taken with hold or borrow."""
+        with self.used.get_lock():
+            self.used.value -= count
+
+
 class ExceptionHandler:
     """
     Class to handle unhandled exceptions and log them.
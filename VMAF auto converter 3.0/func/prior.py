@@ -0,0 +1,70 @@
+from multiprocessing.managers import SyncManager
+from statistics import StatisticsError, linear_regression, median
+
+# How many of the most recently accepted chunks the prediction is based on.
+# Keeps the estimate responsive when the content of a file changes over time.
+PRIOR_WINDOW = 16
+
+
+class CRFPrior:
+    """
+    Shared per-file model of the CRF values that finished chunks were accepted with.
+
+    The samples live in a Manager-backed list, so the object can be passed to every chunk process,
+    where finished chunks post their accepted CRF and VMAF value, and new chunks ask for a starting CRF.
+
+    Args:
+        manager (SyncManager): A started multiprocessing manager used to create the shared sample list.
+        default_crf (int): The CRF value to start from, until a chunk has been accepted.
+    """
+
+    def __init__(self, manager: SyncManager, default_crf: int):
+        self.samples = manager.list()
+        self.default_crf = default_crf
+
+    def post(self, crf_value: int, vmaf_value: float, complexity: float | None = None) -> None:
+        """
+        Adds the result of an accepted chunk to the model.
+
+        Args:
+            crf_value (int): The CRF value the chunk was accepted with.
+            vmaf_value (float): The VMAF value of the accepted chunk.
+            complexity (float | None): The complexity score of the chunk, if it has been analysed.
+
+        Returns:
+            None
+        """
+        self.samples.append((crf_value, vmaf_value, complexity))
+
+    def predict(self, complexity: float | None = None) -> int:
+        """
+        Predicts the CRF value a new chunk should start from.
+
+        If the chunk's complexity is known, and enough accepted chunks with different complexities exist,
+        a linear regression from complexity to CRF value is used. Otherwise the median is used.
+
+        Args:
+            complexity (float | None): The complexity score of the new chunk, if it has been analysed.
+
+        Returns:
+            int: The predicted CRF value, or the default CRF value if no chunks have been accepted yet.
+        """
+        samples = list(self.samples)[-PRIOR_WINDOW:]
+        if not samples:
+            return self.default_crf
+
+        if complexity is not None:
+            analysed = [(sample_complexity, crf_value) for crf_value, _, sample_complexity in samples if sample_complexity is not None]
+            if len(analysed) >= 2:
+                try:
+                    slope, intercept = linear_regression(*zip(*analysed))
+                except StatisticsError:  # Raised when every sample has the same complexity
+                    pass
+                else:
+                    return min(max(round(slope * complexity + intercept), 1), 63)
+
+        return round(median(crf_value for crf_value, _, _ in samples))
+
+
+if __name__ == '__main__':
+    print('This file should not be run as a standalone script!')
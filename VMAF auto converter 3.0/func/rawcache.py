@@ -0,0 +1,158 @@
+from pathlib import Path
+import logging
+import multiprocessing
+import subprocess
+import os
+import signal
+
+from func.index import SeekArgs
+
+# Bytes per pixel of the most common pixel formats, used to estimate the size of a chunk before it is decoded.
+# Unknown formats use the largest value, so the estimate never falls short.
+BYTES_PER_PIXEL = {'yuv420p': 1.5, 'yuv420p10le': 3, 'yuv422p': 2, 'yuv422p10le': 4, 'yuv444p': 3, 'yuv444p10le': 6}
+
+
+class RawFrameCache:
+    """
+    Size-capped cache of the decoded and scaled frames of in-flight chunks, shared by all chunk converters.
+
+    Each chunk is decoded once into an uncompressed NUT file in the temporary folder, which every CRF attempt
+    and VMAF comparison of the chunk then reads, instead of decoding the source again. Placing the temporary
+    folder on a tmpfs keeps the frames in memory. When the cache is full, the least recently used chunks are evicted.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        lock (multiprocessing.Lock): A lock shared by all chunk converters, used to keep the size accounting consistent.
+    """
+
+    def __init__(self, settings: dict, lock: multiprocessing.Lock):
+        self.folder = Path(settings['tmp_folder']) / 'raw'
+        self.max_size = settings['raw_frame_cache_size'] * 1024 * 1024
+        self.lock = lock
+        # The estimated size of the chunks that are being decoded, which are reserved before decoding starts, guarded by the lock
+        self.reserved = multiprocessing.Value('q', 0, lock=False)
+
+    def store(self, settings: dict, file: str, start_frame: int, end_frame: int, name: str, logger: logging.Logger) -> Path | None:
+        """
+        Decodes and scales the frames of a chunk into the cache.
+
+        Args:
+            settings (dict): A dictionary containing the configuration settings, including the resolution of the chunk's rendition.
+            file (str): The path to the input video file.
+            start_frame (int): The first frame of the chunk.
+            end_frame (int): The frame after the last frame of the chunk.
+            name (str): The filename of the chunk, without its extension.
+            logger (logging.Logger): The logger object used for logging messages.
+
+        Returns:
+            Path | None: The path of the cached frames, or None if the chunk doesn't fit in the cache, or decoding it failed.
+        """
+        size = (end_frame - start_frame) * settings['output_width'] * settings['output_height'] * BYTES_PER_PIXEL.get(settings['pixel_format'], max(BYTES_PER_PIXEL.values()))
+        if size > self.max_size:
+            logger.debug(f'{name} is too large for the raw frame cache ({round(size / 1024 / 1024)} MB)')
+            return None
+
+        with self.lock:
+            # Evict the least recently used chunks until the new chunk fits.
+            # Finished chunks are counted, along with the space reserved for chunks that are being decoded.
+            # Chunks that are being read are never evicted
+            cached = []
+            for raw_file in self.folder.glob('*.nut'):
+                try:
+                    stat = raw_file.stat()
+                except FileNotFoundError:  # Released by its converter in the meantime
+                    continue
+                cached.append((stat.st_mtime, stat.st_size, raw_file))
+            cached.sort()
+            used = sum(raw_size for _, raw_size, _ in cached) + self.reserved.value
+            evictable = [entry for entry in cached if not entry[2].with_suffix('.pin').exists()]
+            while evictable and used + size > self.max_size:
+                _, raw_size, raw_file = evictable.pop(0)
+                used -= raw_size
+                logger.debug(f'Evicting {raw_file.name} from the raw frame cache')
+                self.release(raw_file)
+            if used + size > self.max_size:
+                logger.debug(f'The raw frame cache is full of chunks that are being read or decoded. Not caching {name}')
+                return None
+            self.reserved.value += int(size)
+
+        raw_file = self.folder / f'{name}.nut'
+        # Write to a partial file first, so other converters neither count nor evict it while it is being written
+        partial_file = raw_file.with_suffix('.part')
+        input_args, seek_filters, output_args = SeekArgs(settings, start_frame, end_frame)
+        arg = ['ffmpeg', '-nostdin', '-y'] + input_args + ['-i', str(file), '-vf', f'{seek_filters},scale={str(settings["output_width"])}:{str(settings["output_height"])}'] + output_args + ['-pix_fmt', settings['pixel_format'], '-c:v', 'rawvideo', '-an', '-f', 'nut', str(partial_file)]
+        logger.debug(f'Caching the raw frames of {name} with command: {" ".join(str(item) for item in arg)}')
+        try:
+            try:
+                p = subprocess.Popen(arg, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+                p.wait()
+            except KeyboardInterrupt:
+                p.terminate()
+                os.kill(os.getpid(), signal.SIGINT)
+
+            if p.returncode != 0:
+                logger.warning(f'Could not cache the raw frames of {name}. Decoding the source on every attempt instead.')
+                self.release(raw_file)
+                return None
+            os.replace(partial_file, raw_file)
+            return raw_file
+        finally:
+            # The chunk is now counted as a finished chunk, or it failed, so its reservation is given back
+            with self.lock:
+                self.reserved.value -= int(size)
+
+    def get(self, raw_file: Path | None) -> Path | None:
+        """
+        Marks cached frames as recently used, and pins them, so they aren't evicted until they are unpinned.
+
+        Args:
+            raw_file (Path | None): The path of the cached frames, as returned by store.
+
+        Returns:
+            Path | None: The path of the cached frames, or None if they have been evicted. Frames that are returned must be unpinned once they have been read.
+        """
+        if raw_file is None:
+            return None
+        # Check and pin while holding the lock, so the frames can't be evicted in between
+        with self.lock:
+            try:
+                os.utime(raw_file)
+            except FileNotFoundError:
+                return None
+            raw_file.with_suffix('.pin').touch()
+        return raw_file
+
+    def unpin(self, raw_file: Path | None) -> None:
+        """
+        Allows cached frames returned by get to be evicted again.
+
+        Args:
+            raw_file (Path | None): The path of the cached frames, as returned by get.
+
+        Returns:
+            None
+        """
+        if raw_file is not None:
+            raw_file.with_suffix('.pin').unlink(missing_ok=True)
+
+    def release(self, raw_file: Path | None) -> None:
+        """
+        Removes cached frames that are no longer needed.
+
+        Args:
+            raw_file (Path | None): The path of the cached frames, as returned by store.
+
+        Returns:
+            None
+        """
+        if raw_file is None:
+            return
+        for path in (raw_file, raw_file.with_suffix('.part'), raw_file.with_suffix('.pin')):
+            try:
+                os.remove(path)
+            except (FileNotFoundError, PermissionError):  # Already evicted, or still being read on Windows
+                pass
+
+
+if __name__ == '__main__':
+    print('This file should not be run as a standalone script!')
@@ -7,8 +7,9 @@ import multiprocessing
 import traceback
 import os
 import signal
+import sys
 
-from func.checks import IntOrFloat, custombool, IsPath, ParentExists
+from func.checks import IntOrFloat, custombool, IsPath, ParentExists, Ladder, Address, Patterns, ChunkLength, IntermediateFormat
 from func.logger import create_logger
 
 FFMPEG_VERBOSE_LEVEL_QUIET = 0
@@ -21,57 +22,97 @@ class EmptySettings(Exception):
     pass
 
 
-def CreateSettings(log_queue: multiprocessing.Queue) -> None:
+def DefaultSettings() -> ConfigParser:
     """
-    Creates a settings file with default configuration values.
-
-    Args:
-        log_queue (Queue): A queue for logging messages.
+    Creates the default configuration values, as written to a new settings file.
 
     Returns:
-        None
+        ConfigParser: The default settings, by section.
     """
     config = ConfigParser()
-    logger = create_logger(log_queue, 'CreateSettings')
 
     config['Input/Output settings'] = {'input_dir': 'lossless',
                                        'output_dir': 'AV1',
                                        'input_extension': 'mp4',
                                        'output_extension': 'mp4',
+                                       'fragmented_output': 'no',
                                        'use_intro': 'no',
                                        'use_outro': 'no',
                                        'intro_file': 'intro.mp4',
-                                       'outro_file': 'outro.mp4'}
+                                       'outro_file': 'outro.mp4',
+                                       'file_attempts': '2'}
 
     config['File chunking settings'] = {'chunk_size': '5',
                                         'chunk_length': '10',
-                                        'chunk_mode': '2'}
+                                        'chunk_mode': '2',
+                                        'min_chunk_length': '4',
+                                        'max_chunk_length': '20',
+                                        'one_pass_segmenting': 'no',
+                                        'intermediate_format': 'x264'}
 
     config['Encoder settings'] = {'AV1_preset': '6',
                                   'max_attempts': '10',
                                   'initial_crf_value': '44',
                                   'output_width': '1920',
                                   'output_height': '1080',
+                                  'ladder': '',
                                   'audio_bitrate': '192k',
                                   'detect_audio_bitrate': 'no',
                                   'pixel_format': 'yuv420p10le',
                                   'tune_mode': '0',
-                                  'keyframe_interval': '300'}
+                                  'keyframe_interval': '300',
+                                  'complexity_analysis': 'no'}
 
     config['VMAF settings'] = {'VMAF_min_value': '90.5',
                                'VMAF_max_value': '93',
                                'VMAF_offset_threshold': '2',
                                'VMAF_offset_multiplication': '1.3',
                                'VMAF_offset_mode': '2',
-                               'initial_crf_step': '1'}
+                               'initial_crf_step': '1',
+                               'VMAF_segments': '4'}
 
     config['Multiprocessor settings'] = {'file_threads': '1',
-                                         'chunk_threads': '2'}
+                                         'chunk_threads': '2',
+                                         'queue_size': '16',
+                                         'speculative_candidates': '2'}
 
-    config['Verbosity settings'] = {'ffmpeg_verbose_level': '0'}
+    config['Verbosity settings'] = {'ffmpeg_verbose_level': '0',
+                                    'interactive': 'yes'}
 
     config['Temporary settings'] = {'tmp_folder': Path(gettempdir()) / 'VMAF auto converter 3.0',
-                                    'keep_tmp_files': 'no'}
+                                    'keep_tmp_files': 'no',
+                                    'tmp_budget': '0',
+                                    'use_raw_frame_cache': 'no',
+                                    'raw_frame_cache_size': '4096'}
+
+    config['Cache settings'] = {'cache_dir': 'cache',
+                                'cache_size': '1024'}
+
+    config['Watch settings'] = {'watch': 'no',
+                                'watch_interval': '10',
+                                'watch_settle_time': '30',
+                                'priority_patterns': ''}
+
+    config['Distributed settings'] = {'distributed_mode': '0',
+                                      'coordinator_address': '127.0.0.1:50000',
+                                      'coordinator_authkey': 'change me',
+                                      'worker_timeout': '60'}
+
+    return config
+
+
+def CreateSettings(log_queue: multiprocessing.Queue) -> None:
+    """
+    Creates a settings file with default configuration values.
+
+    Args:
+        log_queue (Queue): A queue for logging messages.
+
+    Returns:
+        None
+    """
+    config = DefaultSettings()
+    logger = create_logger(log_queue, 'CreateSettings')
 
     with open('settings.ini', 'w') as configfile:  # Write or overwrite the settings file, with the dictionary data previously created and added to config
         config.write(configfile)
@@ -105,6 +146,13 @@ def ReadSettings(log_queue: multiprocessing.Queue, manager_queue: multiprocessin
                     settings[setting] = value  # Use key= to both find the value in the settings file, and create a new key with the same name in the dictionary variable
             if not settings:  # If the settings dictionary variable is empty e.g. due to the file being empty, or incorrectly being parsed, raise an exception
                 raise EmptySettings('Settings file is empty or incorrectly parsed')
+            # A settings file created by an earlier version lacks the settings added since, so they get their default value
+            defaults = DefaultSettings()
+            for section in defaults.sections():
+                for setting, value in defaults[section].items():
+                    if setting not in settings:
+                        logger.warning(f'{setting} is missing from settings.ini. Using the default value "{value}". Add it to the [{section}] section to change it')
+                        settings[setting] = value
             break
 
         except KeyError as e:
@@ -113,6 +161,10 @@ def ReadSettings(log_queue: multiprocessing.Queue, manager_queue: multiprocessin
             logger.error(e)
             if attempt < MAX_ATTEMPTS - 1:
                 logger.debug(f'Attempt {attempt + 1} of {MAX_ATTEMPTS} to re-create and read settings.ini')
+                # Without a terminal, nobody can answer, so stop instead of waiting forever
+                if not sys.stdin.isatty():
+                    logger.error('settings.ini can\'t be read, and there is no terminal to ask whether to create a new one. Closing')
+                    os.kill(os.getpid(), signal.SIGINT)
                 EmptySettings_menu = None
                 while EmptySettings_menu != 'Y' or EmptySettings_menu != 'N':
                     sleep(0.1)
@@ -141,37 +193,62 @@ def ReadSettings(log_queue: multiprocessing.Queue, manager_queue: multiprocessin
     # Throws KeyError if one of the settings are missing from the settings file.
     arguments = [
         {'names': ['-v', '--verbosity'], 'metavar': '0-2', 'dest': 'ffmpeg_verbose_level', 'default': settings['ffmpeg_verbose_level'], 'help': '0 = hide, 1 = basic, 2 = full. Above 0 is only recommended for debugging', 'type': int},
+        {'names': ['--interactive'], 'metavar': 'yes/no', 'dest': 'interactive', 'default': settings['interactive'], 'help': 'Ask for input when something can\'t be detected, such as the frame rate of a file. If no, or if there is no terminal, such files are set aside as needing attention, and the rest are still converted', 'type': custombool},
         {'names': ['-i', '--input'], 'metavar': 'PATH', 'dest': 'input_dir', 'default': settings['input_dir'], 'help': 'Absolute or relative path to the files', 'type': IsPath},
         {'names': ['-o', '--output'], 'metavar': 'PATH', 'dest': 'output_dir', 'default': settings['output_dir'], 'help': 'Absolute or relative path to where the file should be written', 'type': str},
         {'names': ['-iext', '--input-extension'], 'metavar': 'ext', 'dest': 'input_extension', 'default': settings['input_extension'], 'help': 'Container extension to convert from. Use * to specify all', 'type': str},
         {'names': ['-oext', '--output-extension'], 'metavar': 'ext', 'dest': 'output_extension', 'default': settings['output_extension'], 'help': 'Container extension to convert to', 'type': str},
-        {'names': ['-ui', '--use-intro'], 'metavar': 'yes/no', 'dest': 'use_intro', 'default': settings['use_intro'], 'help': 'Add intro', 'type': custombool},
-        {'names': ['-uo', '--use-outro'], 'metavar': 'yes/no', 'dest': 'use_outro', 'default': settings['use_outro'], 'help': 'Add outro', 'type': custombool},
+        {'names': ['--fragmented-output'], 'metavar': 'yes/no', 'dest': 'fragmented_output', 'default': settings['fragmented_output'], 'help': 'Write MP4/MOV outputs as fragmented files. Otherwise, space for the index is reserved at the start of the file, which also lets them start playing before they are fully downloaded', 'type': custombool},
+        {'names': ['-ui', '--use-intro'], 'metavar': 'yes/no', 'dest': 'use_intro', 'default': settings['use_intro'], 'help': 'Add the intro file before the video. It is encoded once per resolution and cached in the cache folder, and then copied into each output. Only its video is used, so the intro plays silent, and the audio of the file starts after it', 'type': custombool},
+        {'names': ['-uo', '--use-outro'], 'metavar': 'yes/no', 'dest': 'use_outro', 'default': settings['use_outro'], 'help': 'Add the outro file after the video. It is encoded once per resolution and cached in the cache folder, and then copied into each output. Only its video is used, so the outro plays silent', 'type': custombool},
         {'names': ['-if', '--intro-file'], 'metavar': 'FILE', 'dest': 'intro_file', 'default': settings['intro_file'], 'help': 'Absolute or relative path to the intro file, including filename', 'type': str},
         {'names': ['-of', '--outro-file'], 'metavar': 'FILE', 'dest': 'outro_file', 'default': settings['outro_file'], 'help': 'Absolute or relative path to the outro file, including filename', 'type': str},
+        {'names': ['--file-attempts'], 'metavar': 'N', 'dest': 'file_attempts', 'default': settings['file_attempts'], 'help': 'How many times a file is started, including runs that were interrupted, before it is marked as failed in the job queue and skipped', 'type': int},
         {'names': ['-cm', '--chunk-mode'], 'metavar': '0-3', 'dest': 'chunk_mode', 'default': settings['chunk_mode'], 'help': 'Disable, split N amount of times, split into N second long chunks or split by the input keyframe interval', 'type': int},
         {'names': ['-cs', '--chunk-splits'], 'metavar': 'N splits', 'dest': 'chunk_size', 'default': settings['chunk_size'], 'help': 'How many chunks the video should be divided into', 'type': int},
         {'names': ['-cd', '--chunk-duration'], 'metavar': 'N seconds', 'dest': 'chunk_length', 'default': settings['chunk_length'], 'help': 'Chunk duration in seconds', 'type': int},
+        {'names': ['--min-chunk-length'], 'metavar': 'N seconds/Nf', 'dest': 'min_chunk_length', 'default': settings['min_chunk_length'], 'help': 'Keyframe based chunking merges GOPs until a chunk is at least this long, in seconds, or in frames with an f suffix, e.g. 240f. 0 = one chunk per keyframe', 'type': ChunkLength},
+        {'names': ['--max-chunk-length'], 'metavar': 'N seconds/Nf', 'dest': 'max_chunk_length', 'default': settings['max_chunk_length'], 'help': 'Keyframe based chunking stops merging GOPs before a chunk gets longer than this, unless a single GOP is longer. 0 = unlimited', 'type': ChunkLength},
+        {'names': ['--one-pass'], 'metavar': 'yes/no', 'dest': 'one_pass_segmenting', 'default': settings['one_pass_segmenting'], 'help': 'Generate every chunk from a single decode of the source with the segment muxer, instead of a seeking FFmpeg process per chunk. Saves decoding overlapping GOPs on long-GOP sources, but waits for every chunk to be calculated first, and is not bound by the temporary folder budget', 'type': custombool},
+        {'names': ['--intermediate-format'], 'metavar': 'x264/ffv1/raw/auto', 'dest': 'intermediate_format', 'default': settings['intermediate_format'], 'help': 'Lossless format of the prepared chunks, which every attempt and VMAF comparison decodes. x264 is small but slow to decode, ffv1 decodes in parallel slices, and raw needs no decoding but is large, so is best with the temporary folder on a tmpfs. auto benchmarks them on the first file and picks the fastest whose prepared chunks fit in the temporary folder', 'type': IntermediateFormat},
         {'names': ['-pr', '--av1-preset'], 'metavar': '0-12', 'dest': 'av1_preset', 'default': settings['av1_preset'], 'help': 'Encoding preset for the AV1 encoder', 'type': int},
         {'names': ['-ma', '--max-attempts'], 'metavar': 'N', 'dest': 'max_attempts', 'default': settings['max_attempts'], 'help': 'Max attempts before the script skips (but keeps) the file', 'type': int},
         {'names': ['-crf'], 'metavar': '1-63', 'dest': 'initial_crf_value', 'default': settings['initial_crf_value'], 'help': 'Encoder CRF value to be used', 'type': int},
         {'names': ['-vw', '--width'], 'metavar': 'N pixels', 'dest': 'output_width', 'default': settings['output_width'], 'help': 'The desired width of the output file', 'type': int},
         {'names': ['-vh', '--height'], 'metavar': 'N pixels', 'dest': 'output_height', 'default': settings['output_height'], 'help': 'The desired height of the output file', 'type': int},
+        {'names': ['--ladder'], 'metavar': 'WxH@MIN-MAX,...', 'dest': 'ladder', 'default': settings['ladder'], 'help': 'Encode several renditions from a single run, sharing the chunk plan and decoded source, e.g. 1920x1080@90.5-93,1280x720@90-92.5. Renditions without a VMAF range use the minimum and maximum quality. Empty to only encode the width and height', 'type': Ladder},
         {'names': ['-ab', '--audio-bitrate'], 'metavar': 'bitrate(B/K/M)', 'dest': 'audio_bitrate', 'default': settings['audio_bitrate'], 'help': 'Encoder audio bitrate. Use B/K/M to specify bits, kilobits, or megabits', 'type': str},
         {'names': ['-dab', '--detect-audio-bitrate'], 'metavar': 'yes/no', 'dest': 'detect_audio_bitrate', 'default': settings['detect_audio_bitrate'], 'help': 'If the script should detect and instead use the audio bitrate from input file', 'type': custombool},
         {'names': ['-pxf', '--pixel-format'], 'metavar': 'pix_fmt', 'dest': 'pixel_format', 'default': settings['pixel_format'], 'help': 'Encoder pixel format to use. yuv420p for 8-bit, and yuv420p10le for 10-bit', 'type': str},
         {'names': ['-tune'], 'metavar': '0-1', 'dest': 'tune_mode', 'default': settings['tune_mode'], 'help': 'Encoder tune mode. 0 = VQ (subjective), 1 = PSNR (objective)', 'type': int},
         {'names': ['-g', '--keyframe-interval'], 'metavar': 'N frames', 'dest': 'keyframe_interval', 'default': settings['keyframe_interval'], 'help': 'Encoder keyframe interval in frames', 'type': int},
+        {'names': ['-ca', '--complexity-analysis'], 'metavar': 'yes/no', 'dest': 'complexity_analysis', 'default': settings['complexity_analysis'], 'help': 'Analyse the complexity of each chunk before encoding, and use it to predict the starting CRF value of each chunk. Decodes the whole file once before the first chunk is generated, so it only pays off when it saves more retries than that', 'type': custombool},
         {'names': ['-minq', '--minimum-quality'], 'metavar': 'N', 'dest': 'vmaf_min_value', 'default': settings['vmaf_min_value'], 'help': 'Minimum allowed quality for the output file/chunk, calculated using VMAF. Allows decimal for precision', 'type': IntOrFloat},
         {'names': ['-maxq', '--maximum-quality'], 'metavar': 'N', 'dest': 'vmaf_max_value', 'default': settings['vmaf_max_value'], 'help': 'Maximum allowed quality for the output file/chunk, calculated using VMAF. Allows decimal for precision', 'type': IntOrFloat},
         {'names': ['-vomode', '--vmaf-offset-mode'], 'metavar': '0-1', 'dest': 'vmaf_offset_mode', 'default': settings['vmaf_offset_mode'], 'help': 'Algorithm to use to exponentially adjust the CRF value. 0 = standard and slow threshold-based, 1 = aggressive but can overshoot multiplier-based', 'type': int},
         {'names': ['-vot', '--vmaf-offset-threshold'], 'metavar': 'N', 'dest': 'vmaf_offset_threshold', 'default': settings['vmaf_offset_threshold'], 'help': 'How many whole percent the VMAF should deviate before CRF value will exponentially increase or decrease', 'type': int},
         {'names': ['-vom', '--vmaf-offset-multiplier'], 'metavar': 'N', 'dest': 'vmaf_offset_multiplication', 'default': settings['vmaf_offset_multiplication'], 'help': 'How much to multiply the VMAF deviation with, exponentially increasing/decreasing the CRF value. Allows decimal for precision', 'type': IntOrFloat},
+        {'names': ['--vmaf-segments'], 'metavar': 'N', 'dest': 'vmaf_segments', 'default': settings['vmaf_segments'], 'help': 'Split long VMAF comparisons, e.g. of whole files, into up to this many segments of at least 30 seconds, compared in parallel. 1 = disabled', 'type': int},
         {'names': ['--crf-step'], 'metavar': 'N', 'dest': 'initial_crf_step', 'default': settings['initial_crf_step'], 'help': 'How much it should adjust the CRF value on each retry', 'type': int},
         {'names': ['--file-threads'], 'metavar': 'N', 'dest': 'file_threads', 'default': settings['file_threads'], 'help': "Control how many files should be processed at the same time, with multiprocessing. Higher = more CPU usage", 'type': int},
         {'names': ['--chunk-threads'], 'metavar': 'N', 'dest': 'chunk_threads', 'default': settings['chunk_threads'], 'help': 'Control how many chunks should be processed at the same time, with multiprocessing. Higher = more CPU usage', 'type': int},
+        {'names': ['--speculative-candidates'], 'metavar': '0-2', 'dest': 'speculative_candidates', 'default': settings['speculative_candidates'], 'help': 'When chunk threads are idle, encode up to this many extra CRF values around each retry at the same time, and score them together. 0 = disabled', 'type': int},
+        {'names': ['--queue-size'], 'metavar': 'N', 'dest': 'queue_size', 'default': settings['queue_size'], 'help': 'How many items each queue between the chunk stages can hold, before the stage feeding it waits. 0 = unbounded', 'type': int},
         {'names': ['--tmp-dir'], 'metavar': 'PATH', 'dest': 'tmp_folder', 'default': settings['tmp_folder'], 'help': 'Folder to store the temporary files used by the script. Note: Folder and all content will be deleted on exit, if keep_tmp_files is off', 'type': ParentExists},
-        {'names': ['--keep-tmp-files'], 'metavar': 'yes/no', 'dest': 'keep_tmp_files', 'default': settings['keep_tmp_files'], 'help': 'If 0/False, delete when done. If 1/True, keep when done', 'type': custombool}
+        {'names': ['--keep-tmp-files'], 'metavar': 'yes/no', 'dest': 'keep_tmp_files', 'default': settings['keep_tmp_files'], 'help': 'If 0/False, delete when done. If 1/True, keep when done', 'type': custombool},
+        {'names': ['--tmp-budget'], 'metavar': 'N MB', 'dest': 'tmp_budget', 'default': settings['tmp_budget'], 'help': 'Maximum size of the prepared and converted chunks in the temporary folder. Chunk generators wait for the converters to catch up when it is reached. 0 = unlimited', 'type': int},
+        {'names': ['--raw-frame-cache'], 'metavar': 'yes/no', 'dest': 'use_raw_frame_cache', 'default': settings['use_raw_frame_cache'], 'help': 'Decode each chunk once into uncompressed frames in the temporary folder, which every attempt and VMAF comparison reads instead of decoding the source again. Works best with the temporary folder on a tmpfs', 'type': custombool},
+        {'names': ['--raw-frame-cache-size'], 'metavar': 'N MB', 'dest': 'raw_frame_cache_size', 'default': settings['raw_frame_cache_size'], 'help': 'Maximum size of the raw frame cache. The least recently used chunks are evicted when it is full', 'type': int},
+        {'names': ['--cache-dir'], 'metavar': 'PATH', 'dest': 'cache_dir', 'default': settings['cache_dir'], 'help': 'Folder to store data that can be reused between runs, such as the complexity analysis of each file. Unlike the temporary folder, it is never deleted', 'type': ParentExists},
+        {'names': ['--cache-size'], 'metavar': 'N MB', 'dest': 'cache_size', 'default': settings['cache_size'], 'help': 'The size the cache folder is pruned to after each file, removing the data of the least recently used files first. The data of changed or deleted files is always removed. 0 = unlimited', 'type': int},
+        {'names': ['-w', '--watch'], 'metavar': 'yes/no', 'dest': 'watch', 'default': settings['watch'], 'help': 'Keep running, and convert files as they are added to the input folder', 'type': custombool},
+        {'names': ['--watch-interval'], 'metavar': 'N seconds', 'dest': 'watch_interval', 'default': settings['watch_interval'], 'help': 'How often the input folder is checked for new files in watch mode. On Linux, new files are also noticed right away', 'type': IntOrFloat},
+        {'names': ['--settle-time'], 'metavar': 'N seconds', 'dest': 'watch_settle_time', 'default': settings['watch_settle_time'], 'help': 'How long a new file must stay unchanged before it is converted in watch mode, to skip files that are still being copied', 'type': IntOrFloat},
+        {'names': ['--priority-patterns'], 'metavar': 'PATTERN,...', 'dest': 'priority_patterns', 'default': settings['priority_patterns'], 'help': 'Comma separated filename patterns, e.g. news_*,*_urgent*. Files matching an earlier pattern are converted first, and files matching none are converted last', 'type': Patterns},
+        {'names': ['--distributed-mode'], 'metavar': '0-2', 'dest': 'distributed_mode', 'default': settings['distributed_mode'], 'help': '0 = off, 1 = coordinator: hand the chunks to workers instead of converting them, 2 = worker: convert chunks handed out by a coordinator, with a process for each chunk thread. The temporary folder and input files must be reachable at the same path from every machine', 'type': int},
+        {'names': ['--coordinator-address'], 'metavar': 'HOST:PORT', 'dest': 'coordinator_address', 'default': settings['coordinator_address'], 'help': 'Address the coordinator listens on, and workers connect to. Use 0.0.0.0 on the coordinator to accept workers from other machines, together with a secret authkey', 'type': Address},
+        {'names': ['--coordinator-authkey'], 'metavar': 'KEY', 'dest': 'coordinator_authkey', 'default': settings['coordinator_authkey'], 'help': 'Shared secret workers use to connect to the coordinator. Anyone who has it can run code on the coordinator. If it is left at the default, and the coordinator can be reached from other machines, a random one is generated and logged', 'type': str},
+        {'names': ['--worker-timeout'], 'metavar': 'N seconds', 'dest': 'worker_timeout', 'default': settings['worker_timeout'], 'help': 'How long a worker can go without a heartbeat, before its chunk is handed to another worker', 'type': int}
     ]
 
     for arg in arguments:
@@ -188,6 +265,29 @@ def ReadSettings(log_queue: multiprocessing.Queue, manager_queue: multiprocessin
         manager_queue.put(('ArgumentTypeError', e.args, traceback.format_exc()))
         raise
 
+    # Each rendition is named after its resolution, which is also added to its output filename.
+    # Without a ladder, a single unnamed rendition is created from the width, height and VMAF range.
+    if settings['ladder']:
+        settings['renditions'] = [{'name': f'{rendition["output_width"]}x{rendition["output_height"]}',
+                                   'output_width': rendition['output_width'],
+                                   'output_height': rendition['output_height'],
+                                   'vmaf_min_value': settings['vmaf_min_value'] if rendition['vmaf_min_value'] is None else rendition['vmaf_min_value'],
+                                   'vmaf_max_value': settings['vmaf_max_value'] if rendition['vmaf_max_value'] is None else rendition['vmaf_max_value']}
+                                  for rendition in settings['ladder']]
+    else:
+        settings['renditions'] = [{'name': None,
+                                   'output_width': settings['output_width'],
+                                   'output_height': settings['output_height'],
+                                   'vmaf_min_value': settings['vmaf_min_value'],
+                                   'vmaf_max_value': settings['vmaf_max_value']}]
+
+    # A prompt without a terminal would either fail or wait forever
+    settings['interactive'] = settings['interactive'] and sys.stdin.isatty()
+
+    # The segment muxer writes every chunk in a single pass, without waiting for the converters to catch up
+    if settings['one_pass_segmenting'] and settings['tmp_budget'] and settings['chunk_mode']:
+        logger.warning(f'one_pass_segmenting ignores tmp_budget, so the prepared chunks can take more than {settings["tmp_budget"]} MB in the temporary folder')
+
     if settings['ffmpeg_verbose_level'] == FFMPEG_VERBOSE_LEVEL_QUIET:
         settings['ffmpeg_print'] = ['-n', '-hide_banner', '-v', 'quiet']
     elif settings['ffmpeg_verbose_level'] == FFMPEG_VERBOSE_LEVEL_STATS:
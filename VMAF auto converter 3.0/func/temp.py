@@ -1,6 +1,7 @@
 import os
 from pathlib import Path
 from shutil import rmtree
+import logging
 import multiprocessing
 from func.logger import create_logger
 
@@ -71,7 +72,7 @@ def CreateTempFolder(tmp_folder: str, log_queue: multiprocessing.Queue) -> None:
         None
     """
     logger = create_logger(log_queue, 'CreateTempFolder')
-    directories = [tmp_folder, Path(tmp_folder) / 'prepared', Path(tmp_folder) / 'converted']
+    directories = [tmp_folder, Path(tmp_folder) / 'prepared', Path(tmp_folder) / 'converted', Path(tmp_folder) / 'raw']
 
     for directory in directories:
         if Path(directory).exists():
@@ -81,5 +82,127 @@ def CreateTempFolder(tmp_folder: str, log_queue: multiprocessing.Queue) -> None:
         os.mkdir(directory)
 
 
+class TempStorage:
+    """
+    Byte budget for the chunks in the temporary folder, shared by all chunk processes.
+
+    Chunk generators wait for space before preparing the next chunk, and chunks are deleted as soon as they are no longer needed,
+    so the prepared and converted chunks never grow far past the budget, no matter how far the generators could run ahead.
+    The chunks the output is currently waiting for are always allowed, so the budget can never stall the pipeline.
+
+    Args:
+        budget (int): The budget in bytes. 0 disables the budget, but keeps the accounting.
+        keep_tmp_files (bool): Flag indicating whether to keep temporary files. If set, chunks are only released from the budget, not deleted.
+        chunk_threads (int): The number of chunk generators, and thereby how many of the next chunks the output waits for are always allowed.
+    """
+
+    def __init__(self, budget: int, keep_tmp_files: bool, chunk_threads: int):
+        self.budget = budget
+        self.keep_tmp_files = keep_tmp_files
+        self.chunk_threads = chunk_threads
+        self.used = multiprocessing.Value('q', 0)
+        self.high_water_mark = multiprocessing.Value('q', 0)
+        # The number of chunks that have been added to the output, in order
+        self.appended = multiprocessing.Value('i', 0)
+        self.condition = multiprocessing.Condition(self.used.get_lock())
+
+    def wait_for_space(self, i: int, process_failure: multiprocessing.Event) -> None:
+        """
+        Blocks until there is space in the budget for another chunk.
+
+        Args:
+            i (int): The chunk number, which is allowed immediately if the output is waiting for it.
+            process_failure (multiprocessing.Event): An event indicating if an error has occurred across a process.
+
+        Returns:
+            None
+        """
+        with self.condition:
+            while (self.budget and self.used.value >= self.budget
+                   and i > self.appended.value + self.chunk_threads
+                   and not process_failure.is_set()):
+                self.condition.wait(timeout=1)
+
+    def add(self, path: str) -> None:
+        """
+        Adds a file written to the temporary folder to the budget.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            None
+        """
+        size = os.path.getsize(path)
+        with self.condition:
+            self.used.value += size
+            self.high_water_mark.value = max(self.high_water_mark.value, self.used.value)
+
+    def remove(self, path: str) -> None:
+        """
+        Deletes a file that is no longer needed, and releases it from the budget.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            None
+        """
+        try:
+            size = os.path.getsize(path)
+            if not self.keep_tmp_files:
+                os.remove(path)
+        except FileNotFoundError:
+            return
+        with self.condition:
+            self.used.value -= size
+            self.condition.notify_all()
+
+    def release(self, path: str) -> None:
+        """
+        Releases a file from the budget, without deleting it, e.g. before it is renamed and added again under its new path.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            None
+        """
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return
+        with self.condition:
+            self.used.value -= size
+            self.condition.notify_all()
+
+    def advance(self, appended: int) -> None:
+        """
+        Records how many chunks have been added to the output, in order.
+
+        Args:
+            appended (int): The number of chunks.
+
+        Returns:
+            None
+        """
+        with self.condition:
+            self.appended.value = appended
+            self.condition.notify_all()
+
+    def report(self, logger: logging.Logger) -> None:
+        """
+        Logs the high-water mark of the temporary folder.
+
+        Args:
+            logger (logging.Logger): The logger object used for logging messages.
+
+        Returns:
+            None
+        """
+        budget = f'{round(self.budget / 1024 / 1024)} MB' if self.budget else 'unlimited'
+        logger.info(f'Temporary storage high-water mark: {round(self.high_water_mark.value / 1024 / 1024)} MB (budget: {budget})')
+
+
 if __name__ == '__main__':
     print('This file should not be run as a standalone script!')
@@ -1,5 +1,7 @@
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
 from json import loads
-from os import remove
+from math import ceil
 from pathlib import Path
 import subprocess
 import logging
@@ -7,34 +9,54 @@ import os
 import signal
 
 
+# The shortest segment the segmented VMAF scorer splits a file into, in seconds, so the seeking and process startup stay small next to the comparison
+MIN_SEGMENT_LENGTH = 30
+# The percentiles of the per-frame VMAF values reported by the segmented VMAF scorer
+PERCENTILES = (1, 5, 10, 50)
+
+
 class VMAFError(Exception):
     pass
 
 
-def CheckVMAF(settings: dict,
-              crf_value: int,
-              crf_step: int,
-              input_file: str,
-              output_file: str,
-              attempt: int,
-              logger: logging.Logger) -> bool:
+def ScoreVMAFBatch(settings: dict, input_file: str, output_files: list[str], logger: logging.Logger) -> list[float]:
     """
-    Check the VMAF (Video Multimethod Assessment Fusion) value of a video file and adjust the CRF (Constant Rate Factor) value based on the VMAF range.
+    Measure the VMAF value of several video files, compared to the same reference, in a single FFmpeg run.
+
+    The reference is decoded once and split between one libvmaf filter per distorted file,
+    so scoring several attempts of a chunk costs one reference decode and one process, instead of one per attempt.
 
     Args:
         settings (dict): A dictionary containing various settings for the VMAF check.
-        crf_value (int): The current CRF value.
-        crf_step (int): The step size for adjusting the CRF value.
-        input_file (str): The path to the input video file.
-        output_file (str): The path to the output video file.
-        attempt (int): The number of attempts made to adjust the CRF value.
+        input_file (str): The path to the reference video file.
+        output_files (list[str]): The paths to the distorted video files.
         logger (logging.Logger): The logger object used for logging messages.
 
     Returns:
-        bool: True if the CRF value was adjusted and the file should be reprocessed, False if the file should be skipped and the next one should be processed.
+        list[float]: The harmonic mean of the VMAF value of every frame, for each distorted file, in the same order.
+
+    Raises:
+        VMAFError: If FFmpeg failed to compare the files.
     """
-    logger.info(f'Comparing video quality of {Path(output_file).stem}...')
-    arg = ['ffmpeg', '-nostdin', '-i', output_file, '-i', input_file, '-lavfi', f'libvmaf=log_path=log.json:log_fmt=json:n_threads={settings["physical_cores"]}', '-f', 'null', '-']
+    logger.info(f'Comparing video quality of {", ".join(Path(output_file).stem for output_file in output_files)}...')
+    # Each comparison gets its own log next to its distorted file, so parallel comparisons don't overwrite each other's results
+    log_files = [Path(output_file).with_suffix('.vmaf.json') for output_file in output_files]
+    count = len(output_files)
+    # Split the threads between the comparisons, as they run at the same time
+    threads = max(settings['physical_cores'] // count, 1)
+
+    arg = ['ffmpeg', '-nostdin']
+    for output_file in output_files:
+        arg += ['-i', str(output_file)]
+    arg += ['-i', str(input_file)]
+    # Scale the reference to the resolution of the distorted files, in case it is the source itself, and not a prepared chunk
+    graph = f'[{count}:v]scale={settings["output_width"]}:{settings["output_height"]},split={count}' + ''.join(f'[ref{i}]' for i in range(count))
+    for i, log_file in enumerate(log_files):
+        graph += f';[{i}:v][ref{i}]libvmaf=log_path={FilterPath(log_file)}:log_fmt=json:n_threads={threads}[vmaf{i}]'
+    arg += ['-filter_complex', graph]
+    for i in range(count):
+        arg += ['-map', f'[vmaf{i}]', '-f', 'null', '-']
+
     try:
         if settings['ffmpeg_verbose_level'] == 0:
             p = subprocess.Popen(arg, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
@@ -46,14 +68,168 @@ def CheckVMAF(settings: dict,
         p.terminate()
         os.kill(os.getpid(), signal.SIGINT)
 
-    if p.returncode != 0:
-        logger.error(f'Error comparing quality of {Path(output_file).stem} with {Path(input_file).stem} using arg: {" ".join(str(item) for item in arg)}')
+    try:
+        if p.returncode != 0:
+            logger.error(f'Error comparing quality of {", ".join(Path(output_file).stem for output_file in output_files)} with {Path(input_file).stem} using arg: {" ".join(str(item) for item in arg)}')
+            raise VMAFError('Error comparing quality')
+
+        # Open each json file and get the "mean" VMAF value
+        vmaf_values = []
+        for log_file in log_files:
+            with open(log_file) as f:
+                vmaf_values.append(float(loads(f.read())['pooled_metrics']['vmaf']['harmonic_mean']))
+        return vmaf_values
+    finally:
+        for log_file in log_files:
+            log_file.unlink(missing_ok=True)
+
+
+def ScoreVMAFSegmented(settings: dict, input_file: str, output_file: str, total_frames: int, logger: logging.Logger) -> dict[str, float]:
+    """
+    Measure the VMAF value of a long video file by splitting it into segments that are compared in parallel.
+
+    A single libvmaf comparison doesn't scale past a few threads, as both files are decoded serially.
+    Each segment seeks to its own part of both files, and the per-frame VMAF values of every segment are pooled together,
+    so the result is the same as comparing the whole file at once. Both files must have a constant frame rate, and start on the same frame.
+
+    Args:
+        settings (dict): A dictionary containing various settings for the VMAF check, including the number of segments and the frame rate.
+        input_file (str): The path to the reference video file.
+        output_file (str): The path to the distorted video file.
+        total_frames (int): The number of frames in both files.
+        logger (logging.Logger): The logger object used for logging messages.
+
+    Returns:
+        dict[str, float]: The pooled metrics of the VMAF value of every frame: mean, harmonic_mean, min, max, and a pN for each of the percentiles.
+
+    Raises:
+        VMAFError: If FFmpeg failed to compare a segment, or no frames were compared.
+    """
+    fps = Fraction(settings['fps'])
+    # Don't split the file into more segments than there are minimum length segments in it
+    segments = max(min(settings['vmaf_segments'], int(total_frames / fps / MIN_SEGMENT_LENGTH)), 1)
+    segment_length = ceil(total_frames / segments)
+    bounds = [(start_frame, min(start_frame + segment_length, total_frames)) for start_frame in range(0, total_frames, segment_length)]
+    logger.info(f'Comparing video quality of {Path(output_file).stem} in {len(bounds)} segment(s)...')
+
+    with ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+        scores = list(executor.map(lambda bound: ScoreSegment(settings, input_file, output_file, bound[0], bound[1], max(settings['physical_cores'] // len(bounds), 1), logger), bounds))
+    vmaf_values = [vmaf_value for segment_scores in scores for vmaf_value in segment_scores]
+    if not vmaf_values:
+        logger.error(f'Error comparing quality of {Path(output_file).stem} with {Path(input_file).stem}: no frames were compared')
         raise VMAFError('Error comparing quality')
+    if len(vmaf_values) != total_frames:
+        logger.warning(f'Compared {len(vmaf_values)} frames of {Path(output_file).stem}, expected {total_frames}')
+
+    # Pool the per-frame values the same way libvmaf does for a single comparison
+    pooled = {'mean': sum(vmaf_values) / len(vmaf_values),
+              'harmonic_mean': len(vmaf_values) / sum(1 / (1 + vmaf_value) for vmaf_value in vmaf_values) - 1,
+              'min': min(vmaf_values),
+              'max': max(vmaf_values)}
+    vmaf_values.sort()
+    for percentile in PERCENTILES:
+        pooled[f'p{percentile}'] = Percentile(vmaf_values, percentile)
+    return pooled
+
+
+def ScoreSegment(settings: dict, input_file: str, output_file: str, start_frame: int, end_frame: int, threads: int, logger: logging.Logger) -> list[float]:
+    """
+    Measure the VMAF value of every frame in a segment of a video file.
+
+    Args:
+        settings (dict): A dictionary containing various settings for the VMAF check.
+        input_file (str): The path to the reference video file.
+        output_file (str): The path to the distorted video file.
+        start_frame (int): The first frame of the segment.
+        end_frame (int): The frame after the last frame of the segment.
+        threads (int): The number of threads libvmaf uses.
+        logger (logging.Logger): The logger object used for logging messages.
+
+    Returns:
+        list[float]: The VMAF value of each frame in the segment, in order.
+
+    Raises:
+        VMAFError: If FFmpeg failed to compare the segment.
+    """
+    log_file = Path(output_file).with_suffix(f'.vmaf{start_frame}.json')
+    # Seek half a frame before the segment, so rounding can't drop its first frame, or include the one before it
+    seek_args = ['-ss', str(float(max(start_frame - Fraction(1, 2), 0) / Fraction(settings['fps'])))] if start_frame > 0 else []
+    graph = f'[1:v]scale={settings["output_width"]}:{settings["output_height"]}[ref];[0:v][ref]libvmaf=log_path={FilterPath(log_file)}:log_fmt=json:n_threads={threads}'
+    arg = ['ffmpeg', '-nostdin'] + seek_args + ['-i', str(output_file)] + seek_args + ['-i', str(input_file), '-lavfi', graph, '-frames:v', str(end_frame - start_frame), '-f', 'null', '-']
+    logger.debug(f'Comparing frames {start_frame}-{end_frame} of {Path(output_file).stem} with command: {" ".join(str(item) for item in arg)}')
+    try:
+        if settings['ffmpeg_verbose_level'] == 0:
+            p = subprocess.Popen(arg, stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        else:
+            arg[1:1] = settings['ffmpeg_print']
+            p = subprocess.Popen(arg)
+        p.wait()
+    except KeyboardInterrupt:
+        p.terminate()
+        os.kill(os.getpid(), signal.SIGINT)
+
+    try:
+        if p.returncode != 0:
+            logger.error(f'Error comparing frames {start_frame}-{end_frame} of {Path(output_file).stem} with {Path(input_file).stem} using arg: {" ".join(str(item) for item in arg)}')
+            raise VMAFError('Error comparing quality')
+        with open(log_file) as f:
+            return [float(frame['metrics']['vmaf']) for frame in loads(f.read())['frames']]
+    finally:
+        log_file.unlink(missing_ok=True)
+
+
+def Percentile(values: list[float], percentile: float) -> float:
+    """
+    Get a percentile of sorted values, interpolating linearly between the closest two.
+
+    Args:
+        values (list[float]): The values, sorted in ascending order.
+        percentile (float): The percentile, from 0 to 100.
+
+    Returns:
+        float: The value below which the given percent of the values fall.
+    """
+    position = (len(values) - 1) * percentile / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def FilterPath(path: Path) -> str:
+    """
+    Escape a path for use as an option value in an FFmpeg filter graph.
+
+    Args:
+        path (Path): The path to escape.
+
+    Returns:
+        str: The escaped path, with forward slashes, and its colons escaped for both the filter option and the filter graph.
+    """
+    return Path(path).as_posix().replace(':', '\\\\:')
+
+
+def AdjustCRF(settings: dict,
+              crf_value: int,
+              crf_step: int,
+              vmaf_value: float,
+              output_file: str,
+              attempt: int,
+              logger: logging.Logger) -> tuple[bool, int]:
+    """
+    Adjust the CRF value based on how far a measured VMAF value is from the VMAF range.
 
-    # Open the json file and get the "mean" VMAF value
-    with open('log.json') as f:
-        vmaf_value = float(loads(f.read())['pooled_metrics']['vmaf']['harmonic_mean'])
+    Args:
+        settings (dict): A dictionary containing various settings for the VMAF check.
+        crf_value (int): The CRF value the file was encoded with.
+        crf_step (int): The step size for adjusting the CRF value.
+        vmaf_value (float): The measured VMAF value.
+        output_file (str): The path to the output video file, used in log messages.
+        attempt (int): The number of attempts made to adjust the CRF value.
+        logger (logging.Logger): The logger object used for logging messages.
 
+    Returns:
+        tuple[bool, int]: Whether the file should be reprocessed, and the (possibly adjusted) CRF value.
+    """
     # If VMAF value is not inside the VMAF range
     if not settings["vmaf_min_value"] <= vmaf_value <= settings["vmaf_max_value"]:
         # If VMAF value is below the minimum range
@@ -82,8 +258,6 @@ def CheckVMAF(settings: dict,
                 logger.info('CRF value out of range (1-63). Skipping...')
                 # Return False instead of True to skip the file and continue with the next one
                 return False, crf_value
-            # Delete converted file to avoid FFmpeg skipping it
-            remove(output_file)
             return True, crf_value
 
         # If VMAF value is above the maximum range
@@ -111,8 +285,6 @@ def CheckVMAF(settings: dict,
                 logger.info('CRF value out of range (1-63). Skipping...')
                 # Return False instead of True to skip the file and continue with the next one
                 return False, crf_value
-            # Delete converted file to avoid FFmpeg skipping it
-            remove(output_file)
             return True, crf_value
     else:
         message = f"""
@@ -0,0 +1,134 @@
+from fnmatch import fnmatch
+from pathlib import Path
+from time import monotonic, sleep
+import ctypes
+import ctypes.util
+import logging
+import select
+import sys
+import os
+
+# inotify events that can mean a new or changed file in the watched folder
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+class DirectoryWatcher:
+    """
+    Waits for changes to a folder.
+
+    On Linux, inotify is used, so waiting ends as soon as a file is created, written or moved into the folder.
+    Elsewhere, or if inotify is unavailable, waiting always lasts the full timeout, and the folder is simply polled.
+
+    Args:
+        folder (str): The path to the folder to watch.
+        logger (logging.Logger): The logger object used for logging messages.
+    """
+
+    def __init__(self, folder: str, logger: logging.Logger):
+        self.fd = None
+        if sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+                fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+                if fd >= 0:
+                    if libc.inotify_add_watch(fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) >= 0:
+                        self.fd = fd
+                    else:
+                        os.close(fd)
+            except (OSError, AttributeError):
+                pass
+        logger.debug(f'Watching {folder} with {"inotify" if self.fd is not None else "polling"}')
+
+    def wait(self, timeout: float) -> None:
+        """
+        Waits until the folder changes, or the timeout runs out.
+
+        Args:
+            timeout (float): The maximum time to wait, in seconds.
+
+        Returns:
+            None
+        """
+        if self.fd is None:
+            sleep(timeout)
+            return
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if ready:
+            # Only the wake up matters, so the events themselves are discarded
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+
+class StableFiles:
+    """
+    Tracks the size and modification time of files, to tell when they are no longer being written to.
+
+    Args:
+        settle_time (float): How long a file must stay unchanged before it is considered stable, in seconds.
+    """
+
+    def __init__(self, settle_time: float):
+        self.settle_time = settle_time
+        self.files = {}  # The size and modification time of each unsettled file, and since when they have been unchanged
+
+    def update(self, files: list[Path]) -> list[Path]:
+        """
+        Checks the given files, and returns the ones that have become stable.
+
+        Stable files are no longer tracked, and files that disappeared are forgotten.
+
+        Args:
+            files (list[Path]): The files to check.
+
+        Returns:
+            list[Path]: The files that have been unchanged for the settle time.
+        """
+        now = monotonic()
+        stable = []
+        current = {}
+        for file in files:
+            try:
+                stat = os.stat(file)
+            except FileNotFoundError:
+                continue
+            state = (stat.st_size, stat.st_mtime_ns)
+            previous_state, since = self.files.get(file, (None, now))
+            if state != previous_state:
+                since = now
+            if now - since >= self.settle_time:
+                stable.append(file)
+            else:
+                current[file] = (state, since)
+        self.files = current
+        return stable
+
+    @property
+    def pending(self) -> bool:
+        """bool: Whether any file is still waiting to become stable."""
+        return bool(self.files)
+
+
+def FilePriority(settings: dict, file: Path) -> int:
+    """
+    Get the priority of a file, from the first of the priority patterns its filename matches.
+
+    Args:
+        settings (dict): A dictionary containing the configuration settings.
+        file (Path): The path to the file.
+
+    Returns:
+        int: The index of the first matching pattern, or the number of patterns if none match. Lower is converted first.
+    """
+    for priority, pattern in enumerate(settings['priority_patterns']):
+        if fnmatch(file.name, pattern):
+            return priority
+    return len(settings['priority_patterns'])
+
+
+if __name__ == '__main__':
+    print('This file should not be run as a standalone script!')